@@ -0,0 +1,114 @@
+#! /usr/bin/python3
+
+import re, sys, math
+from collections import Counter
+
+# BLEU as computed by nltk corpus_bleu and sentence_bleu
+# with default weights and no smoothing, but with n-gram counts
+# of each sentence made once for both corpus and sentence scores
+
+word_re = re.compile('\w+')
+max_order = 4
+
+def tokenize(line):
+    return word_re.findall(line)
+
+def ngram_counts(words, n):
+    return Counter(zip(*(words[i:] for i in range(n))))
+
+def modified_precisions(references, hypothesis):
+    """
+    Return lists of clipped n-gram match counts
+    and of n-gram counts (at least 1) for n up to max_order.
+    """
+    numerators, denominators = [], []
+    for n in range(1, max_order + 1):
+        counts = ngram_counts(hypothesis, n)
+        max_ref_counts = {}
+        for reference in references:
+            ref_counts = ngram_counts(reference, n)
+            for ngram in counts:
+                max_ref_counts[ngram] = max(max_ref_counts.get(ngram, 0), ref_counts[ngram])
+        numerators.append(sum(min(count, max_ref_counts[ngram]) for ngram, count in counts.items()))
+        denominators.append(max(1, sum(counts.values())))
+    return numerators, denominators
+
+def closest_ref_length(references, hyp_len):
+    return min((len(reference) for reference in references),
+               key=lambda ref_len: (abs(ref_len - hyp_len), ref_len))
+
+def brevity_penalty(ref_len, hyp_len):
+    if hyp_len > ref_len:
+        return 1.
+    if hyp_len == 0:
+        return 0.
+    return math.exp(1 - ref_len / hyp_len)
+
+def bleu(numerators, denominators, ref_len, hyp_len):
+    """
+    Compute BLEU from n-gram statistics.
+    """
+    if numerators[0] == 0:
+        return 0.
+    # precisions with no matches are replaced by the smallest float like in nltk
+    log_precisions = (math.log(numerator / denominator) if numerator != 0
+                          else math.log(sys.float_info.min)
+                              for numerator, denominator in zip(numerators, denominators))
+    return brevity_penalty(ref_len, hyp_len) * \
+           math.exp(math.fsum(log_precision / max_order for log_precision in log_precisions))
+
+class BleuScorer:
+    """
+    Incremental BLEU scorer: sentences are added one by one,
+    corpus statistics are summed up along the way.
+    """
+    def __init__(self):
+        self.numerators = [0] * max_order
+        self.denominators = [0] * max_order
+        self.ref_len, self.hyp_len = 0, 0
+
+    def add(self, references, hypothesis):
+        """
+        Add tokenized hypothesis with the list of tokenized
+        references to corpus statistics and return its sentence BLEU.
+        """
+        numerators, denominators = modified_precisions(references, hypothesis)
+        hyp_len = len(hypothesis)
+        ref_len = closest_ref_length(references, hyp_len)
+
+        for i in range(max_order):
+            self.numerators[i] += numerators[i]
+            self.denominators[i] += denominators[i]
+        self.ref_len += ref_len
+        self.hyp_len += hyp_len
+
+        return bleu(numerators, denominators, ref_len, hyp_len)
+
+    def corpus_bleu(self):
+        return bleu(self.numerators, self.denominators, self.ref_len, self.hyp_len)
+
+def evaluate(ref_fname, hyp_fname):
+    """
+    Return corpus BLEU and average sentence BLEU of translation
+    in hyp_fname against reference in ref_fname. Sentences with
+    empty reference or translation count as zero in the average.
+    """
+    scorer, sentence_total, sentence_count = BleuScorer(), 0., 0
+    with open(ref_fname, 'r', encoding='utf-8') as rfile, \
+         open(hyp_fname, 'r', encoding='utf-8') as hfile:
+        for ref_line, hyp_line in zip(rfile, hfile):
+            reference, hypothesis = tokenize(ref_line), tokenize(hyp_line)
+            sentence_bleu = scorer.add([reference], hypothesis)
+            if reference != [] and hypothesis != []:
+                sentence_total += sentence_bleu
+            sentence_count += 1
+    return scorer.corpus_bleu(), sentence_total / sentence_count if sentence_count > 0 else 0.
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: ./bleu.py REFERENCE TRANSLATION [TRANSLATION ...]")
+        sys.exit(1)
+
+    for hyp_fname in sys.argv[2:]:
+        corpus_bleu, average_bleu = evaluate(sys.argv[1], hyp_fname)
+        print("{}\nCorpus BLEU: {}\nAverage sentence BLEU: {}".format(hyp_fname, corpus_bleu, average_bleu))
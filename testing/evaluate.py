@@ -0,0 +1,220 @@
+#! /usr/bin/python3
+
+import os, sys
+from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
+from optparse import OptionParser
+from time import perf_counter as clock
+
+from bleu import evaluate
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools.pipelines import pair_paths, RejectedInput
+from tools import trserver
+
+unweighted_name = 'unweighted'
+
+# number of lines sent to translator server at once for default translation
+server_batch_size = 100
+
+def run_chain(commands, ifname, ofname, errfname=None):
+    """
+    Run commands connected with pipes, reading ifname
+    and writing ofname, and wait for them to finish.
+    Return True if all of them succeeded.
+    """
+    with open(ifname, 'rb') as ifile, open(ofname, 'wb') as ofile, \
+         open(errfname or os.devnull, 'wb') as errfile:
+        processes = []
+        for i, command in enumerate(commands):
+            processes.append(Popen(command,
+                                   stdin = ifile if i == 0 else processes[-1].stdout,
+                                   stdout = ofile if i == len(commands) - 1 else PIPE,
+                                   stderr = errfile))
+            if i > 0:
+                # let previous process get SIGPIPE if this one exits
+                processes[-2].stdout.close()
+        return all(process.wait() == 0 for process in reversed(processes))
+
+def tag_corpus(pair_folder, pair_name, source_corpus, ofname, bilingual=True):
+    """
+    Tag source corpus and look it up in bilingual dictionary
+    (the part of translation which does not depend on weights).
+    Translator server looks it up itself, so if bilingual
+    is False, corpus is only tagged.
+    """
+    print('Tagging test corpus.')
+    btime = clock()
+    commands = [['apertium', '-d', pair_folder, pair_name + '-tagger'],
+                ['apertium-pretransfer']]
+    if bilingual:
+        commands.append(['lt-proc', '-b', os.path.join(pair_folder, pair_name + '.autobil.bin')])
+    ok = run_chain(commands, source_corpus, ofname)
+    print('Done in {:.2f}'.format(clock() - btime))
+    return ok
+
+def translate(pair_folder, pair_name, biltrans_fname, ofname, weights_fname=None):
+    """
+    Translate tagged corpus from biltrans_fname
+    with transfer weights from weights_fname if provided.
+    """
+    pair_prefix = os.path.join(pair_folder, '{}.{}'.format(os.path.basename(pair_folder), pair_name))
+    bin_prefix = os.path.join(pair_folder, pair_name)
+    if weights_fname is None:
+        transfer = ['apertium-transfer', '-b']
+    else:
+        transfer = ['apertium-transfer', '-bw', weights_fname]
+    transfer += [pair_prefix + '.t1x', bin_prefix + '.t1x.bin']
+
+    return run_chain([transfer,
+                      ['apertium-interchunk', pair_prefix + '.t2x', bin_prefix + '.t2x.bin'],
+                      ['apertium-postchunk', pair_prefix + '.t3x', bin_prefix + '.t3x.bin'],
+                      ['lt-proc', '-g', bin_prefix + '.autogen.bin'],
+                      ['apertium-retxt'],
+                      ['sed', 's/[*#@~]//g']],
+                     biltrans_fname, ofname, ofname + '.log')
+
+def translate_remotely(socket_fname, pair_folder, pair_name, tagged_fname, ofname,
+                       weights_fname=None):
+    """
+    Translate tagged corpus from tagged_fname line by line
+    on translator server (see tools/trserver.py) listening
+    on socket_fname, with transfer weights from weights_fname
+    if provided. Lines rejected by the server are left empty.
+    """
+    tixbasepath, binbasepath = pair_paths(pair_folder, *pair_name.split('-'))
+    raw_fname = ofname + '.raw'
+    with open(ofname + '.log', 'w', encoding='utf-8') as logfile:
+        try:
+            translators = trserver.connect(socket_fname, tixbasepath, binbasepath,
+                                           ofname + '.rejected', default=weights_fname is None)
+        except (OSError, ValueError) as e:
+            print(e, file=logfile)
+            return False
+        translator = translators[0]
+        try:
+            with open(tagged_fname, 'rb') as ifile, open(raw_fname, 'wb') as ofile:
+                lines = [line.rstrip(b'\n') for line in ifile]
+                for start in range(0, len(lines), server_batch_size):
+                    batch = lines[start:start + server_batch_size]
+                    if weights_fname is None:
+                        translations = translator.translate_batch(batch)
+                    else:
+                        translations = []
+                        for line in batch:
+                            try:
+                                translations.append(translator.translate(line, weights_fname))
+                            except RejectedInput:
+                                translations.append(None)
+                    for translation in translations:
+                        ofile.write((translation or b'').replace(b'\n', b' ') + b'\n')
+        except (OSError, RuntimeError) as e:
+            # server stopped or reloaded its pipelines with changed pair files
+            print(e, file=logfile)
+            return False
+        finally:
+            for translator in translators:
+                translator.close()
+
+    ok = run_chain([['apertium-retxt'],
+                    ['sed', 's/[*#@~]//g']],
+                   raw_fname, ofname, ofname + '.log')
+    os.remove(raw_fname)
+    return ok
+
+def compare(pair_folder, pair_name, source_corpus, reference_corpus,
+            weights_fnames, prefix, jobs=None, socket_fname=None):
+    """
+    Tag test corpus once, translate it without weights
+    and with each of weights files concurrently (on translator
+    server listening on socket_fname if provided),
+    and compare BLEU of translations.
+    """
+    biltrans_fname = prefix + ('.biltrans' if socket_fname is None else '.tagged')
+    if not tag_corpus(pair_folder, pair_name, source_corpus, biltrans_fname,
+                      bilingual=socket_fname is None):
+        print('Tagging failed.')
+        return False
+
+    # weights files from different folders may have the same base name,
+    # so output files are numbered and systems are shown by full name
+    systems = [(unweighted_name, None)] + \
+              [(weights_fname, weights_fname) for weights_fname in weights_fnames]
+    ofnames = ['{}.{}-{}.txt'.format(prefix, i, os.path.basename(name))
+                   for i, (name, weights_fname) in enumerate(systems)]
+
+    print('Translating with {} systems.'.format(len(systems)))
+    btime = clock()
+    with ThreadPoolExecutor(max_workers=jobs or len(systems)) as executor:
+        if socket_fname is None:
+            oks = list(executor.map(lambda system, ofname:
+                                        translate(pair_folder, pair_name, biltrans_fname,
+                                                  ofname, system[1]),
+                                    systems, ofnames))
+        else:
+            oks = list(executor.map(lambda system, ofname:
+                                        translate_remotely(socket_fname, pair_folder, pair_name,
+                                                           biltrans_fname, ofname, system[1]),
+                                    systems, ofnames))
+    print('Done in {:.2f}'.format(clock() - btime))
+
+    print('\n{:<40} {:>12} {:>12} {:>12}'.format('System', 'Corpus BLEU', 'Diff', 'Avg sent BLEU'))
+    baseline = None
+    for (name, weights_fname), ofname, ok in zip(systems, ofnames, oks):
+        if not ok:
+            print('{:<40} translation failed, see {}'.format(name, ofname + '.log'))
+            continue
+        corpus_bleu, average_bleu = evaluate(reference_corpus, ofname)
+        if baseline is None and weights_fname is None:
+            baseline = corpus_bleu
+        diff = '' if baseline is None else '{:+.6f}'.format(corpus_bleu - baseline)
+        print('{:<40} {:>12.6f} {:>12} {:>12.6f}'.format(name, corpus_bleu, diff, average_bleu))
+    return all(oks)
+
+def get_options():
+    """
+    Parse commandline arguments and options
+    """
+    usage = "USAGE: python3 %prog [options] [WEIGHTS_FILE ...]"
+    op = OptionParser(usage=usage)
+
+    op.add_option("-d", "--pair-folder", dest="pair_folder",
+                  help="apertium language pair data folder", metavar="PAIR_FOLDER")
+    op.add_option("-p", "--pair-name", dest="pair_name",
+                  help="translation direction, e.g. en-es", metavar="PAIR_NAME")
+    op.add_option("-s", "--source", dest="source_corpus",
+                  help="source language test corpus", metavar="SOURCE_CORPUS")
+    op.add_option("-r", "--reference", dest="reference_corpus",
+                  help="reference translation of test corpus", metavar="REFERENCE_CORPUS")
+    op.add_option("-o", "--output-prefix", dest="prefix",
+                  help="common prefix of output files (source corpus name by default)",
+                  metavar="PREFIX")
+    op.add_option("-j", "--jobs", dest="jobs", type="int", default=None,
+                  help="run at most JOBS translations at once (all by default)", metavar="JOBS")
+    op.add_option("-S", "--translator-server", dest="socket_fname", default=None,
+                  help="translate on translator server listening on SOCKET_FILE "
+                       "(see tools/trserver.py) instead of starting apertium for each system",
+                  metavar="SOCKET_FILE")
+
+    (opts, args) = op.parse_args()
+
+    for option in ('pair_folder', 'pair_name', 'source_corpus', 'reference_corpus'):
+        if getattr(opts, option) is None:
+            op.error("option --{} is required.".format(option.replace('_', '-').replace('-corpus', '')))
+
+    missing = [fname for fname in [opts.source_corpus, opts.reference_corpus] + args
+                   if not os.path.exists(fname)]
+    if missing != []:
+        op.error("files not found: {}".format(', '.join(missing)))
+
+    if opts.prefix is None:
+        opts.prefix = opts.source_corpus
+
+    return opts, args
+
+if __name__ == "__main__":
+    opts, weights_fnames = get_options()
+    if not compare(opts.pair_folder, opts.pair_name, opts.source_corpus,
+                   opts.reference_corpus, weights_fnames, opts.prefix, opts.jobs,
+                   opts.socket_fname):
+        sys.exit(1)
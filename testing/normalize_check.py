@@ -0,0 +1,83 @@
+#! /usr/bin/python3
+
+import os, re, sys, random
+from time import perf_counter as clock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools.simpletok import normalize, normalize_many
+
+# reference implementation: normalize as it was
+# before it was made into a single pass
+beforepunc_re = re.compile(r'([¿("/])(\w)')
+afterpunc_re = re.compile(r'(\w)([;:,.!?)"/—])')
+quot_re = re.compile("[«»`'“”„‘’‛]|&quot;")
+numfix_re = re.compile('([0-9]) ([,.:][0-9])')
+beforedash_re = re.compile(r'(\W)-(\w)')
+afterdash_re = re.compile(r'(\w)-(\W)')
+
+def reference_normalize(line):
+    line = line.lower().replace('--', '—').replace(' - ', ' — ')
+    line = quot_re.sub('"', line)
+    line = beforedash_re.sub(r'\1— \2', afterdash_re.sub(r'\1 —\2', line))
+    line = beforepunc_re.sub(r'\1 \2', afterpunc_re.sub(r'\1 \2', line))
+    line = numfix_re.sub(r'\1\2', line)
+    return line.lower()
+
+# characters normalize cares about, and some it does not
+alphabet = list('aZ09_ -—.,:;!?¿()"/«»`\'“”„‘’‛&\nΣσİß') + ['&quot;', '&QUOT;', '--', ' - ']
+
+def random_line(max_length=30):
+    return ''.join(random.choice(alphabet) for i in range(random.randint(0, max_length)))
+
+def check(iterations):
+    """
+    Compare normalize and normalize_many with reference
+    implementation on random lines. Return number of mismatches.
+    """
+    mismatches = 0
+    for i in range(iterations):
+        line = random_line()
+        if normalize(line) != reference_normalize(line):
+            print('Mismatch on {!r}:\n{!r}\n{!r}'.format(line, normalize(line), reference_normalize(line)))
+            mismatches += 1
+
+        lines = [random_line().replace('\n', '') + '\n' for j in range(random.randint(1, 5))]
+        if normalize_many(lines) != [reference_normalize(line) for line in lines]:
+            print('Mismatch on lines {!r}'.format(lines))
+            mismatches += 1
+    return mismatches
+
+def benchmark(fname):
+    """
+    Time both implementations on lines from fname.
+    """
+    with open(fname, 'r', encoding='utf-8') as ifile:
+        lines = ifile.readlines()
+
+    btime = clock()
+    reference = [reference_normalize(line) for line in lines]
+    print('Reference: {:.2f}'.format(clock() - btime))
+
+    btime = clock()
+    normalized = [normalize(line) for line in lines]
+    print('normalize: {:.2f}'.format(clock() - btime))
+
+    btime = clock()
+    normalized_many = normalize_many(lines)
+    print('normalize_many: {:.2f}'.format(clock() - btime))
+
+    print('Same output:', normalized == reference and normalized_many == reference)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print("Usage: ./normalize_check.py [CORPUS]")
+        sys.exit(1)
+
+    mismatches = check(100000)
+    print('{} mismatches on random lines'.format(mismatches))
+
+    if len(sys.argv) == 2:
+        benchmark(sys.argv[1])
+
+    if mismatches > 0:
+        sys.exit(1)
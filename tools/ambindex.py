@@ -0,0 +1,193 @@
+#! /usr/bin/python3
+
+import os, struct
+# process pool (and multiprocessing) is loaded only when it is used
+from concurrent import futures
+from time import perf_counter as clock
+
+try: # imported as part of tools package
+    from tools import coverage
+    from tools.corpus import map_corpus, iter_tagged_spans
+    from tools.chunkweights import encode_varint, decode_varint
+except ImportError: # run from inside tools folder
+    import coverage
+    from corpus import map_corpus, iter_tagged_spans
+    from chunkweights import encode_varint, decode_varint
+
+# index of ambiguous sentences in tagged corpus, made by FST-only pre-scan:
+#   magic, header: numbers of lines, sentences, botched coverages,
+#   ambiguous sentences, ambiguous chunks and predicted weighted
+#   translations (little-endian uint64 each),
+#   records, one per ambiguous sentence (varints):
+#     offset of the sentence from the end of previous one, sentence length,
+#     line number difference from previous sentence, number of chunks,
+#     and for each ambiguous chunk: start token, chunk length, rule group number
+index_magic = b'TWAI\x01'
+header_struct = struct.Struct('<6Q')
+header_fields = ('lines', 'sentences', 'botched', 'sentences_ambiguous',
+                 'chunks', 'translations')
+
+# size of a piece of corpus scanned by one worker at once
+default_chunk_size = 4 * 1024 * 1024
+
+# state of scanning worker process
+scanner = {}
+
+def init_scanner(cat_dict, pattern_FST, ambiguous_rules):
+    """
+    Set up FST and rules for scanning in worker process.
+    """
+    scanner['cat_dict'] = coverage.get_bytes_cat_dict(cat_dict)
+    scanner['FST'] = pattern_FST
+    scanner['ambiguous_rules'] = ambiguous_rules
+
+def split_corpus(buf, chunk_size=default_chunk_size):
+    """
+    Split memory-mapped corpus into byte ranges
+    of about chunk_size bytes which end at line boundaries.
+    """
+    start = 0
+    while start < len(buf):
+        end = buf.find(b'\n', min(start + chunk_size, len(buf)) - 1)
+        end = len(buf) if end < 0 else end + 1
+        yield start, end
+        start = end
+
+def scan_range(corpus, start, end):
+    """
+    Find sentences with ambiguous chunks between start and end bytes
+    of corpus. Return a list of (line number, offset, length,
+    [(start token, end token, rule group number), ...]) records
+    with line numbers counted from start, and statistics.
+    """
+    pattern_FST, cat_dict = scanner['FST'], scanner['cat_dict']
+    ambiguous_rules = scanner['ambiguous_rules']
+    records, stats = [], dict.fromkeys(header_fields, 0)
+    with map_corpus(corpus) as buf:
+        for line_number, offset, sentence in iter_tagged_spans(buf, start, end):
+            stats['sentences'] += 1
+            coverage_list = pattern_FST.get_lrlm(sentence, cat_dict)
+            if coverage_list == []:
+                stats['botched'] += 1
+                continue
+            chunks = coverage.find_ambiguous(ambiguous_rules, coverage_list[0])
+            if chunks != []:
+                stats['sentences_ambiguous'] += 1
+                stats['chunks'] += len(chunks)
+                stats['translations'] += sum(len(ambiguous_rules[rule_group_number])
+                                                 for chunk_start, chunk_end, rule_group_number in chunks)
+                records.append((line_number, offset, len(sentence), chunks))
+        stats['lines'] = buf[start:end].count(b'\n')
+    return records, stats
+
+def scan_range_worker(args):
+    return scan_range(*args)
+
+def encode_record(record, prev_end, prev_line, out):
+    line_number, offset, length, chunks = record
+    encode_varint(offset - prev_end, out)
+    encode_varint(length, out)
+    encode_varint(line_number - prev_line, out)
+    encode_varint(len(chunks), out)
+    for chunk_start, chunk_end, rule_group_number in chunks:
+        encode_varint(chunk_start, out)
+        encode_varint(chunk_end - chunk_start, out)
+        encode_varint(int(rule_group_number), out)
+
+def prescan(corpus, index_fname, cat_dict, pattern_FST, ambiguous_rules,
+            jobs=None, chunk_size=default_chunk_size):
+    """
+    Find sentences with ambiguous chunks in tagged corpus
+    with pattern FST only (no translation), on jobs processes,
+    and write their index to index_fname. Return statistics.
+    """
+    print('Pre-scanning corpus for ambiguous sentences.')
+    btime = clock()
+    jobs = jobs or os.cpu_count()
+    totals = dict.fromkeys(header_fields, 0)
+
+    with map_corpus(corpus) as buf:
+        ranges = [(corpus, start, end) for start, end in split_corpus(buf, chunk_size)]
+
+    with open(index_fname, 'wb') as ofile:
+        ofile.write(index_magic + header_struct.pack(*(0 for field in header_fields)))
+        if jobs == 1:
+            init_scanner(cat_dict, pattern_FST, ambiguous_rules)
+            results = map(scan_range_worker, ranges)
+            executor = None
+        else:
+            # language model may be loaded by another thread meanwhile,
+            # and forked workers could inherit its locks taken
+            import multiprocessing
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() \
+                               else 'spawn'
+            executor = futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_scanner,
+                                                   initargs=(cat_dict, pattern_FST, ambiguous_rules),
+                                                   mp_context=multiprocessing.get_context(start_method))
+            results = executor.map(scan_range_worker, ranges)
+
+        # results come in corpus order, line numbers are made global
+        prev_end, prev_line = 0, 0
+        for records, stats in results:
+            out = bytearray()
+            for line_number, offset, length, chunks in records:
+                line_number += totals['lines']
+                encode_record((line_number, offset, length, chunks), prev_end, prev_line, out)
+                prev_end, prev_line = offset + length, line_number
+            ofile.write(out)
+            for field in header_fields:
+                totals[field] += stats[field]
+        if executor is not None:
+            executor.shutdown()
+
+        # write statistics to the header
+        ofile.seek(len(index_magic))
+        ofile.write(header_struct.pack(*(totals[field] for field in header_fields)))
+
+    elapsed = clock() - btime
+    print('{} of {} sentences are ambiguous, {} chunks, {} weighted translations to do'.format(
+              totals['sentences_ambiguous'], totals['sentences'],
+              totals['chunks'], totals['translations']))
+    print('Done in {:.2f}, {:.0f} sentences/s'.format(elapsed, totals['sentences'] / max(elapsed, 1e-9)))
+    return totals
+
+def read_index(index_fname):
+    """
+    Read statistics of index and return them with
+    generator of (line number, offset, length,
+    [(start token, end token, rule group number), ...]) records.
+    """
+    with open(index_fname, 'rb') as ifile:
+        data = ifile.read()
+    if data[:len(index_magic)] != index_magic:
+        raise ValueError('"{}" is not an index of ambiguous sentences'.format(index_fname))
+    pos = len(index_magic) + header_struct.size
+    stats = dict(zip(header_fields, header_struct.unpack_from(data, len(index_magic))))
+
+    def iter_records(pos):
+        prev_end, prev_line = 0, 0
+        while pos < len(data):
+            offset_delta, pos = decode_varint(data, pos)
+            length, pos = decode_varint(data, pos)
+            line_delta, pos = decode_varint(data, pos)
+            chunk_count, pos = decode_varint(data, pos)
+            chunks = []
+            for i in range(chunk_count):
+                chunk_start, pos = decode_varint(data, pos)
+                chunk_length, pos = decode_varint(data, pos)
+                rule_group_number, pos = decode_varint(data, pos)
+                chunks.append((chunk_start, chunk_start + chunk_length, str(rule_group_number)))
+            offset, line_number = prev_end + offset_delta, prev_line + line_delta
+            prev_end, prev_line = offset + length, line_number
+            yield line_number, offset, length, chunks
+
+    return stats, iter_records(pos)
+
+def make_coverage(sentence):
+    """
+    Tokenize sentence into coverage without chunks,
+    which is enough to cut segments out of it.
+    """
+    token_matches = list(coverage.apertium_token_bre.finditer(sentence))
+    return coverage.Coverage(sentence, token_matches,
+                             [token_match.group(1) for token_match in token_matches], None)
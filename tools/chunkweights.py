@@ -0,0 +1,291 @@
+#! /usr/bin/python3
+
+import sys, os, mmap, struct, heapq, pipes
+from contextlib import ExitStack
+
+try: # imported as part of tools package
+    from tools.memory import budget
+except ImportError: # run from inside tools folder
+    from memory import budget
+
+usage_line = 'Usage: python3 chunkweights.py INPUT_FILE OUTPUT_FILE'
+
+# chunk weights files are either tab-separated text,
+# one (rule group, rule, pattern, weight[, count]) row per line,
+# or binary, made of sorted runs of aggregated rows:
+#   magic, pattern count, row count, dictionary size, rows size (varints),
+#   dictionary: utf-8 encoded patterns (length varint, bytes) in sorted order,
+#   rows: group (varint), rule (varint), pattern id (varint),
+#         weight (little-endian float64), count (varint), sorted.
+# every run starts with magic, so binary files may be concatenated
+run_magic = b'TWCW\x01'
+weight_struct = struct.Struct('<d')
+
+# number of distinct rows aggregated in memory before they are written out as a run
+default_run_size = 200000
+
+# number of distinct rows between checks of memory budget
+budget_check_interval = 10000
+
+text_extension = '.txt'
+binary_extension = '.bin'
+
+def make_fname(prefix, binary=False):
+    """
+    Make chunk weights file name with extension for its format.
+    """
+    return prefix + (binary_extension if binary else text_extension)
+
+def is_binary(fname):
+    """
+    Check if chunk weights file is binary.
+    """
+    with open(fname, 'rb') as ifile:
+        return ifile.read(len(run_magic)) == run_magic
+
+def encode_varint(number, out):
+    """
+    Append unsigned number to bytearray out as varint.
+    """
+    while number > 0x7f:
+        out.append(number & 0x7f | 0x80)
+        number >>= 7
+    out.append(number)
+
+def decode_varint(buf, pos):
+    """
+    Decode varint from buf at pos.
+    Return decoded number and position after it.
+    """
+    number, shift = 0, 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, pos
+        shift += 7
+
+class TextWriter:
+    """
+    Writer of tab-separated chunk weights file.
+    """
+    def __init__(self, fname):
+        self.ofile = open(fname, 'w', encoding='utf-8')
+
+    def add(self, group, rule, pattern, weight, count=1):
+        if count == 1:
+            print(group, rule, pattern, weight, sep='\t', file=self.ofile)
+        else:
+            print(group, rule, pattern, weight, count, sep='\t', file=self.ofile)
+
+    def close(self):
+        self.ofile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class BinaryWriter:
+    """
+    Writer of binary chunk weights file.
+    Rows with the same rule group, rule and pattern are
+    aggregated in memory (weights are summed up and counted),
+    and written out as a sorted run every run_size distinct rows,
+    or earlier when memory budget is nearly used up.
+    """
+    def __init__(self, fname, run_size=default_run_size):
+        self.ofile = open(fname, 'wb')
+        self.run_size = run_size
+        self.rows = {}
+
+    def add(self, group, rule, pattern, weight, count=1):
+        key = (int(group), int(rule), pattern)
+        row = self.rows.get(key)
+        if row is None:
+            self.rows[key] = [float(weight), count]
+            if len(self.rows) >= self.run_size or \
+               len(self.rows) % budget_check_interval == 0 and budget.near_limit():
+                self.flush()
+        else:
+            row[0] += float(weight)
+            row[1] += count
+
+    def flush(self):
+        """
+        Write aggregated rows out as a sorted run.
+        """
+        if self.rows == {}:
+            return
+
+        # pattern ids follow sorted pattern order,
+        # so rows sorted by ids are sorted by patterns
+        patterns = sorted(set(pattern for group, rule, pattern in self.rows))
+        pattern_ids = {pattern: i for i, pattern in enumerate(patterns)}
+
+        dictionary = bytearray()
+        for pattern in patterns:
+            encoded_pattern = pattern.encode('utf-8')
+            encode_varint(len(encoded_pattern), dictionary)
+            dictionary += encoded_pattern
+
+        rows = bytearray()
+        for (group, rule, pattern), (weight, count) in sorted(self.rows.items()):
+            encode_varint(group, rows)
+            encode_varint(rule, rows)
+            encode_varint(pattern_ids[pattern], rows)
+            rows += weight_struct.pack(weight)
+            encode_varint(count, rows)
+
+        header = bytearray(run_magic)
+        for number in (len(patterns), len(self.rows), len(dictionary), len(rows)):
+            encode_varint(number, header)
+
+        self.ofile.write(header)
+        self.ofile.write(dictionary)
+        self.ofile.write(rows)
+        self.rows = {}
+
+    def close(self):
+        self.flush()
+        self.ofile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def open_writer(fname, binary=False):
+    """
+    Open chunk weights file for writing in text or binary format.
+    """
+    if binary:
+        return BinaryWriter(fname)
+    return TextWriter(fname)
+
+def find_runs(buf):
+    """
+    Go through binary chunk weights buf run by run
+    and return list of (patterns, rows position, rows count) tuples.
+    """
+    runs, pos = [], 0
+    while pos < len(buf):
+        if buf[pos:pos + len(run_magic)] != run_magic:
+            raise ValueError('Broken chunk weights run at {}.'.format(pos))
+        pos += len(run_magic)
+        patterns_count, pos = decode_varint(buf, pos)
+        rows_count, pos = decode_varint(buf, pos)
+        dictionary_size, pos = decode_varint(buf, pos)
+        rows_size, pos = decode_varint(buf, pos)
+
+        patterns = []
+        for i in range(patterns_count):
+            pattern_size, pos = decode_varint(buf, pos)
+            patterns.append(buf[pos:pos + pattern_size].decode('utf-8'))
+            pos += pattern_size
+
+        runs.append((patterns, pos, rows_count))
+        pos += rows_size
+    return runs
+
+def iter_run(buf, patterns, pos, rows_count):
+    """
+    Yield (group, rule, pattern, weight, count) rows of a run.
+    """
+    for i in range(rows_count):
+        group, pos = decode_varint(buf, pos)
+        rule, pos = decode_varint(buf, pos)
+        pattern_id, pos = decode_varint(buf, pos)
+        weight, = weight_struct.unpack_from(buf, pos)
+        count, pos = decode_varint(buf, pos + weight_struct.size)
+        yield group, rule, patterns[pattern_id], weight, count
+
+def read_binary(fnames):
+    """
+    Merge sorted runs from all binary chunk weights files in fnames
+    and yield aggregated (group, rule, pattern, weight, count) rows
+    sorted by rule group, rule and pattern.
+    Group and rule numbers are yielded as str like in text files.
+    """
+    with ExitStack() as stack:
+        runs = []
+        for fname in fnames:
+            ifile = stack.enter_context(open(fname, 'rb'))
+            if os.fstat(ifile.fileno()).st_size == 0:
+                continue
+            buf = stack.enter_context(mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ))
+            runs.extend(iter_run(buf, *run) for run in find_runs(buf))
+
+        # rows with the same key from different runs come together
+        prev_key, total_weight, total_count = None, 0., 0
+        for group, rule, pattern, weight, count in heapq.merge(*runs):
+            key = (group, rule, pattern)
+            if key != prev_key:
+                if prev_key is not None:
+                    yield str(prev_key[0]), str(prev_key[1]), prev_key[2], total_weight, total_count
+                prev_key, total_weight, total_count = key, 0., 0
+            total_weight += weight
+            total_count += count
+        if prev_key is not None:
+            yield str(prev_key[0]), str(prev_key[1]), prev_key[2], total_weight, total_count
+
+def read_text(fname, sorted_fname):
+    """
+    Sort text chunk weights file into sorted_fname
+    and yield its (group, rule, pattern, weight, count) rows.
+    """
+    # create pipeline
+    pipe = pipes.Template()
+    pipe.append('sort $IN > $OUT', 'ff')
+    pipe.copy(fname, sorted_fname)
+
+    with open(sorted_fname, 'r', encoding='utf-8') as ifile:
+        for line in ifile:
+            row = line.rstrip('\n').split('\t')
+            yield row[0], row[1], row[2], float(row[3]), int(row[4]) if len(row) > 4 else 1
+
+def read_sorted(fname, sorted_fname=None):
+    """
+    Yield (group, rule, pattern, weight, count) rows of chunk weights
+    file in either format, so that rows of each rule group
+    and of each rule within it come together.
+    Text files are sorted into sorted_fname first.
+    """
+    if is_binary(fname):
+        return read_binary([fname])
+    if sorted_fname is None:
+        sorted_fname = fname.rsplit('.', maxsplit=1)[0] + '-sorted' + text_extension
+    return read_text(fname, sorted_fname)
+
+def convert(ifname, ofname):
+    """
+    Convert text chunk weights file into binary one and vice versa.
+    """
+    binary = not is_binary(ifname)
+    if binary:
+        with open(ifname, 'r', encoding='utf-8') as ifile:
+            rows = (line.rstrip('\n').split('\t') for line in ifile)
+            with open_writer(ofname, binary) as writer:
+                for row in rows:
+                    writer.add(row[0], row[1], row[2], float(row[3]),
+                               int(row[4]) if len(row) > 4 else 1)
+    else:
+        with open_writer(ofname, binary) as writer:
+            for row in read_binary([ifname]):
+                writer.add(*row)
+    return ofname
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print(usage_line)
+        sys.exit(1)
+
+    ifname = sys.argv[1]
+    if not os.path.exists(ifname):
+        print('Input file not found')
+        sys.exit(1)
+
+    convert(ifname, sys.argv[2])
@@ -0,0 +1,96 @@
+from math import sqrt
+
+# default number of observations of a pattern
+# before its winning rule may be considered stable
+default_min_observations = 20
+
+class ConvergenceTracker:
+    """
+    Running estimates of rule weights for each (rule group, pattern) key,
+    kept with Welford's algorithm. Means are weighted by the number
+    of occurrences of each observation, but an observation of a line
+    occurring several times is one observation for min_observations,
+    cap and standard errors, as its occurrences share one context.
+    Once the winning rule of a pattern is stable, i.e. its mean weight
+    exceeds the mean weight of the runner-up by at least z standard errors
+    (after min_observations observations), or the pattern
+    has been observed cap times, the pattern converges,
+    and its chunks can be skipped for the rest of the corpus.
+    Skipped chunks are counted, so that they can still be added
+    to the statistics with the frozen mean weights of the pattern.
+    Zero z or cap disables the corresponding criterion.
+    """
+    def __init__(self, z=0., min_observations=default_min_observations, cap=0):
+        self.z, self.min_observations, self.cap = z, min_observations, cap
+        # key: [number of observations, number of occurrences,
+        #       {rule: [mean, sum of squared deviations]}]
+        self.estimates = {}
+        # converged key: {rule: frozen mean weight}
+        self.converged = {}
+        # converged key: number of occurrences of its skipped chunks
+        self.skipped = {}
+        self.skipped_chunks, self.saved_translations = 0, 0
+
+    def enabled(self):
+        return self.z > 0. or self.cap > 0
+
+    def is_stable(self, observations, occurrences, rule_estimates):
+        if self.cap > 0 and observations >= self.cap:
+            return True
+        if self.z <= 0. or observations < max(self.min_observations, 2) or len(rule_estimates) < 2:
+            return False
+        (best_mean, best_m2), (second_mean, second_m2) = \
+            sorted(rule_estimates.values(), reverse=True)[:2]
+        # weights of rules in one observation are not independent,
+        # so the standard error of their difference is bounded
+        # by the sum of their standard errors; sums of squared deviations
+        # are weighted by occurrences, while only observations are independent
+        scale = occurrences * (observations - 1)
+        standard_error = sqrt(best_m2 / scale) + sqrt(second_m2 / scale)
+        if standard_error == 0.:
+            return best_mean > second_mean
+        return (best_mean - second_mean) / standard_error >= self.z
+
+    def add(self, key, rule_weights, count=1):
+        """
+        Add an observation of (rule, weight) pairs for key
+        which occurred count times.
+        """
+        if key in self.converged:
+            return
+        estimate = self.estimates.setdefault(key, [0, 0, {}])
+        estimate[0] += 1
+        estimate[1] += count
+        observations, occurrences = estimate[0], estimate[1]
+        for rule, weight in rule_weights:
+            mean_m2 = estimate[2].setdefault(rule, [0., 0.])
+            delta = weight - mean_m2[0]
+            mean_m2[0] += delta * count / occurrences
+            mean_m2[1] += delta * count * (weight - mean_m2[0])
+        if self.is_stable(observations, occurrences, estimate[2]):
+            self.converged[key] = {rule: mean for rule, (mean, m2) in estimate[2].items()}
+            del self.estimates[key]
+
+    def skip(self, key, translations=0, count=1):
+        """
+        Check if chunk with key which occurred count times
+        should be skipped, and count the translations saved by it.
+        """
+        if key in self.converged:
+            self.skipped_chunks += 1
+            self.saved_translations += translations
+            self.skipped[key] = self.skipped.get(key, 0) + count
+            return True
+        return False
+
+    def iter_skipped(self):
+        """
+        Yield key, frozen mean weights of its rules
+        and the number of occurrences of its skipped chunks.
+        """
+        for key, count in self.skipped.items():
+            yield key, self.converged[key], count
+
+    def report(self):
+        return '{} patterns converged, {} chunks skipped, {} weighted translations saved'.format(
+                   len(self.converged), self.skipped_chunks, self.saved_translations)
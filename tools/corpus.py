@@ -0,0 +1,298 @@
+import os, re, io, mmap, glob, shutil, queue, threading, gzip, bz2, lzma
+from collections import deque
+from itertools import zip_longest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from subprocess import Popen, PIPE
+
+try: # see if zstandard is installed
+    import zstandard
+except ImportError: # it is not, zstd command is used for .zst files
+    zstandard = None
+
+# sentence in tagged corpus: anything up to <sent>$ within a line
+# or the rest of the line if it is not blank,
+# newlines are matched on their own to keep track of lines
+tagged_sent_bre = re.compile(rb'[^\n]*?<sent>\$|[^\n]*[^\s][^\n]*|\n')
+
+@contextmanager
+def map_corpus(fname):
+    """
+    Memory-map corpus file for reading.
+    Empty files can not be mapped, so b'' is used instead.
+    """
+    with open(fname, 'rb') as ifile:
+        if os.fstat(ifile.fileno()).st_size == 0:
+            yield b''
+        else:
+            with mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    buf.madvise(mmap.MADV_SEQUENTIAL)
+                yield buf
+
+def iter_tagged_sentences(buf):
+    """
+    Go through memory-mapped tagged corpus buf
+    and yield (line number, sentence) tuples,
+    where sentence is utf-8 encoded bytes.
+    """
+    line_number = 0
+    for sent_match in tagged_sent_bre.finditer(buf):
+        sentence = sent_match.group(0)
+        if sentence == b'\n':
+            line_number += 1
+        else:
+            yield line_number, sentence
+
+def iter_tagged_spans(buf, start=0, end=None):
+    """
+    Go through memory-mapped tagged corpus buf from start
+    to end byte (which should be at line boundaries) and yield
+    (line number, offset, sentence) tuples, where line numbers
+    are counted from start and sentence is utf-8 encoded bytes.
+    """
+    line_number = 0
+    for sent_match in tagged_sent_bre.finditer(buf, start, len(buf) if end is None else end):
+        sentence = sent_match.group(0)
+        if sentence == b'\n':
+            line_number += 1
+        else:
+            yield line_number, sent_match.start(), sentence
+
+def iter_lines(buf):
+    """
+    Go through memory-mapped corpus buf line by line.
+    """
+    if len(buf) == 0:
+        return iter([])
+    return iter(buf.readline, b'')
+
+# openers of compressed corpus files by their extension
+compressed_openers = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+zstd_extension = '.zst'
+
+# size of blocks in which corpus files are read
+default_block_size = 1024 * 1024
+
+# number of decompressed blocks of each file read ahead by decompression threads
+default_queue_blocks = 8
+
+def corpus_files(corpus):
+    """
+    Expand corpus, either a list of file names or a string
+    of file names and glob patterns separated by whitespace,
+    into the list of corpus files in order: files matched
+    by each pattern are sorted by name.
+    Raise ValueError for patterns which match nothing.
+    """
+    if type(corpus) != type(''):
+        return list(corpus)
+    fnames = []
+    for pattern in corpus.split():
+        if glob.has_magic(pattern):
+            matched = sorted(glob.glob(pattern))
+            if matched == []:
+                raise ValueError('No corpus files match "{}"'.format(pattern))
+            fnames.extend(matched)
+        else:
+            fnames.append(pattern)
+    return fnames
+
+def is_compressed(fname):
+    extension = os.path.splitext(fname)[1]
+    return extension in compressed_openers or extension == zstd_extension
+
+def is_plain_file(corpus):
+    """
+    Check if corpus is a single uncompressed file
+    which may be read (or memory-mapped) as is.
+    """
+    fnames = corpus_files(corpus)
+    return len(fnames) == 1 and not is_compressed(fnames[0])
+
+def can_decompress(fname):
+    """
+    Check if there is a way to decompress fname.
+    """
+    if os.path.splitext(fname)[1] != zstd_extension:
+        return True
+    return zstandard is not None or shutil.which('zstd') is not None
+
+class ZstdCommandReader(io.RawIOBase):
+    """
+    Decompressed stream of .zst file read from zstd command.
+    """
+    def __init__(self, fname):
+        self.process = Popen(['zstd', '-dcq', fname], stdout=PIPE)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self.process.stdout.readinto(b)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.process.stdout.close()
+        # zstd is killed by broken pipe if it is closed early
+        if self.process.wait() > 0:
+            raise OSError('zstd exited with code {}'.format(self.process.returncode))
+
+def open_file(fname):
+    """
+    Open corpus file for reading bytes,
+    decompressing it on the fly if it is compressed.
+    """
+    extension = os.path.splitext(fname)[1]
+    if extension in compressed_openers:
+        return compressed_openers[extension](fname, 'rb')
+    if extension == zstd_extension:
+        if zstandard is not None:
+            return zstandard.open(fname, 'rb')
+        return io.BufferedReader(ZstdCommandReader(fname))
+    return open(fname, 'rb')
+
+def iter_file_blocks(fname, block_size=default_block_size):
+    """
+    Read (decompressed) corpus file block by block.
+    The last block ends with newline, so that lines
+    of the next file do not run into its last line.
+    """
+    last_block = b'\n'
+    with open_file(fname) as ifile:
+        while True:
+            block = ifile.read(block_size)
+            if block == b'':
+                break
+            yield block
+            last_block = block
+    if not last_block.endswith(b'\n'):
+        yield b'\n'
+
+def put_block(blocks, item, stop):
+    """
+    Put item into blocks queue, waiting while it is full.
+    Return False if stop is set meanwhile.
+    """
+    while not stop.is_set():
+        try:
+            blocks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def read_file(fname, blocks, stop):
+    """
+    Put (decompressed) blocks of corpus file into blocks queue,
+    then None at the end of file (or the exception raised
+    while reading it), until stop is set.
+    """
+    try:
+        for block in iter_file_blocks(fname):
+            if not put_block(blocks, block, stop):
+                return
+    except Exception as e:
+        put_block(blocks, e, stop)
+    else:
+        put_block(blocks, None, stop)
+
+class CorpusReader(io.RawIOBase):
+    """
+    Stream of bytes of corpus files read one after another.
+    With jobs > 1, files are decompressed by a pool of jobs threads
+    (decompressors release interpreter lock) at most jobs files
+    ahead of reading, each of them through a queue of at most
+    queue_blocks blocks, so memory use does not depend on file sizes.
+    """
+    def __init__(self, fnames, jobs=1, queue_blocks=default_queue_blocks):
+        self.fnames = fnames
+        if jobs > 1 and len(fnames) > 1:
+            self.executor = ThreadPoolExecutor(max_workers=jobs)
+            self.stop = threading.Event()
+            self.queue_blocks = queue_blocks
+            self.pending = deque(self.start_file(fname) for fname in fnames[:jobs])
+            self.next_file = jobs
+        else:
+            self.executor = None
+            self.blocks = (block for fname in fnames for block in iter_file_blocks(fname))
+        self.block, self.pos = b'', 0
+
+    def start_file(self, fname):
+        """
+        Start decompressing file in the pool, return its blocks queue.
+        """
+        blocks = queue.Queue(maxsize=self.queue_blocks)
+        self.executor.submit(read_file, fname, blocks, self.stop)
+        return blocks
+
+    def readable(self):
+        return True
+
+    def next_block(self):
+        """
+        Get the next block of corpus,
+        return False at the end of corpus.
+        """
+        if self.executor is None:
+            block = next(self.blocks, None)
+        else:
+            block = None
+            while block is None and self.pending:
+                block = self.pending[0].get()
+                if block is None:
+                    # end of file, start the next one
+                    self.pending.popleft()
+                    if self.next_file < len(self.fnames):
+                        self.pending.append(self.start_file(self.fnames[self.next_file]))
+                        self.next_file += 1
+                elif isinstance(block, Exception):
+                    raise block
+        if block is None:
+            return False
+        self.block, self.pos = block, 0
+        return True
+
+    def readinto(self, b):
+        while self.pos >= len(self.block):
+            if not self.next_block():
+                return 0
+        size = min(len(b), len(self.block) - self.pos)
+        b[:size] = self.block[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+    def close(self):
+        if self.executor is not None:
+            self.stop.set()
+            self.executor.shutdown()
+            self.executor = None
+        super().close()
+
+def open_corpus(corpus, jobs=1):
+    """
+    Open corpus (see corpus_files) for reading bytes
+    as one stream: compressed files (.gz, .bz2, .xz, .zst)
+    are decompressed on the fly, by jobs threads at once.
+    """
+    if is_plain_file(corpus):
+        return open(corpus_files(corpus)[0], 'rb')
+    return io.BufferedReader(CorpusReader(corpus_files(corpus), jobs), default_block_size)
+
+def iter_aligned_lines(corpora, names):
+    """
+    Go through several corpora (e.g. source and target side
+    of parallel corpus, opened by open_corpus) at once,
+    yielding tuples of their aligned lines.
+    Raise ValueError if some of them ends before the others.
+    """
+    lines_count = 0
+    for lines in zip_longest(*corpora):
+        if None in lines:
+            raise ValueError('{} has {} lines, {} has more'.format(
+                                 names[lines.index(None)], lines_count,
+                                 names[[line is None for line in lines].index(False)]))
+        lines_count += 1
+        yield lines
@@ -2,7 +2,7 @@
 
 import re, sys
 from optparse import OptionParser, OptionGroup
-from time import clock
+from time import perf_counter as clock
 
 try: # see if lxml is installed
     from lxml import etree as ET
@@ -21,6 +21,7 @@ any_num_of_any_tags_re = '({})*'.format(any_tag_re)
 
 # apertium token (anything between ^ and $)
 apertium_token_re = re.compile(r'\^(.*?)\$')
+apertium_token_bre = re.compile(rb'\^(.*?)\$')
 
 def cat_item_to_re(cat_item):
     """
@@ -78,12 +79,23 @@ def get_cat_dict(transtree):
         cat_dict[re_line].append(def_cat.attrib['n'])
     return cat_dict
 
+def get_bytes_cat_dict(cat_dict):
+    """
+    Convert cat_dict to match tokens represented
+    as utf-8 encoded bytes with precompiled regexes.
+    """
+    return {re.compile(cat_re.encode('utf-8')): cat_list
+                for cat_re, cat_list in cat_dict.items()}
+
 def get_cats_by_line(line, cat_dict):
     """
     Return all possible categories for each apertium token in line.
+    Line may be either str or utf-8 encoded bytes
+    (with cat_dict made by get_bytes_cat_dict).
     """
+    token_re = apertium_token_bre if type(line) == bytes else apertium_token_re
     return [get_cat(token, cat_dict)
-                for token in apertium_token_re.findall(line)]
+                for token in token_re.findall(line)]
 
 def get_cat(token, cat_dict):
     """
@@ -200,97 +212,93 @@ class FST:
         Build all lrlm coverages for line.
         
         """
-        # tokenize line and get all possible categories for each token
-        line = get_cats_by_line(line, cat_dict)
+        # tokenize line and get all possible categories for each token,
+        # line may be either str or utf-8 encoded bytes
+        if type(line) == bytes:
+            token_re, unknown_mark = apertium_token_bre, b'*'
+        else:
+            token_re, unknown_mark = apertium_token_re, '*'
+        token_matches = list(token_re.finditer(line))
+        tokens = [token_match.group(1) for token_match in token_matches]
+        cats_by_line = [get_cat(token, cat_dict) for token in tokens]
 
-        # coverage and state lists are built dinamically
-        # each state from state_list is the state of FST
-        # at the end of corresponding coverage from coverage_list
-        coverage_list, state_list = [[]], [self.start_state]
+        # coverages are built dinamically as paths through the FST
+        # each path is (last closed chunk, start of open pattern, state),
+        # where closed chunks are linked lists with tails shared
+        # between all the paths that continue them
+        path_list = [(None, 0, self.start_state)]
 
         # go through all tokens in line
-        for token, cat_list in line:
-            new_coverage_list, new_state_list = [], []
+        for position, (token, cat_list) in enumerate(cats_by_line):
+            new_path_list = []
 
             # go through all cats for the token
             for cat in cat_list:
 
                 # try to continue each coverage obtained on the previous step
-                for coverage, state in zip(coverage_list, state_list):
+                for last, open_start, state in path_list:
 
                     # first, check if we can go further along current pattern
                     if (state, cat) in self.transitions:
                         # current pattern can be made longer: add one more token
-                        new_coverage_list.append(coverage + [('w', token)])
-                        new_state_list.append(self.transitions[(state, cat)])
+                        new_path_list.append((last, open_start, self.transitions[(state, cat)]))
 
                     # if not, check if we can finalize current pattern
                     elif state in self.final_states:
                         # current state is one of the final states: close previous pattern
-                        new_coverage = coverage + [('r', self.final_states[state])]
+                        closed = Chunk(open_start, position, self.final_states[state], last)
 
                         if (self.start_state, cat) in self.transitions:
                             # can start new pattern
-                            new_coverage_list.append(new_coverage + [('w', token)])
-                            new_state_list.append(self.transitions[(self.start_state, cat)])
-                        elif '*' in token:
+                            new_path_list.append((closed, position,
+                                                  self.transitions[(self.start_state, cat)]))
+                        elif unknown_mark in token:
                             # can not start new pattern because of an unknown word
-                            new_coverage_list.append(new_coverage + [('w', token), ('r', 'unknown')])
-                            new_state_list.append(self.start_state)
+                            new_path_list.append((Chunk(position, position+1, 'unknown', closed),
+                                                  position+1, self.start_state))
 
                     # if not, check if it is just an unknown word
-                    elif state == self.start_state and '*' in token:
+                    elif state == self.start_state and unknown_mark in token:
                         # unknown word at start state: add it to pattern, start new
-                        new_coverage_list.append(coverage + [('w', token), ('r', 'unknown')])
-                        new_state_list.append(self.start_state)
+                        new_path_list.append((Chunk(position, position+1, 'unknown', last),
+                                              position+1, self.start_state))
 
                     # if nothing worked, just discard this coverage
 
-            if len(new_coverage_list) > 1024:
+            if len(new_path_list) > 1024:
                 return []
 
-            coverage_list, state_list = new_coverage_list, new_state_list
+            path_list = new_path_list
 
         # finalize coverages
-        new_coverage_list = []
-        for coverage, state in zip(coverage_list, state_list):
+        coverage_list = []
+        for last, open_start, state in path_list:
             if state in self.final_states:
                 # current state is one of the final states: close the last pattern
-                new_coverage_list.append(coverage + [('r', self.final_states[state])])
-            elif coverage != [] and coverage[-1][0] == 'r':
+                coverage_list.append(Coverage(line, token_matches, tokens,
+                                              Chunk(open_start, len(tokens),
+                                                    self.final_states[state], last)))
+            elif last is not None and open_start == len(tokens):
                 # the last pattern is already closed
-                new_coverage_list.append(coverage)
+                coverage_list.append(Coverage(line, token_matches, tokens, last))
             # if nothing worked, just discard this coverage as incomplete
 
-        if new_coverage_list == []:
+        if coverage_list == []:
             # no coverages detected: no need to go further
             return []
 
-        # convert coverage representation:
-        # [('r'/'w', rule_number/token), ...] -> [([token, token, ... ], rule_number), ...]
-        formatted_coverage_list = []
-        for coverage in new_coverage_list:
-            pattern, formatted_coverage = [], []
-            for element in coverage:
-                if element[0] == 'w':
-                    pattern.append(element[1])
-                else:
-                    formatted_coverage.append((pattern, element[1]))
-                    pattern = []
-            formatted_coverage_list.append(formatted_coverage)
-
         # now we filter out some not-lrlm coverages
         # that still got into
 
         # sort coverages by signature, which is a tuple
         # of coverage part lengths
-        formatted_coverage_list.sort(key=signature, reverse=True)
-        signature_max = signature(formatted_coverage_list[0])
+        coverage_list.sort(key=signature, reverse=True)
+        signature_max = signature(coverage_list[0])
 
         # keep only those with top signature
         # they would be the LRLM ones
         LRLM_list = []
-        for coverage in formatted_coverage_list:
+        for coverage in coverage_list:
             if signature(coverage) == signature_max:
                 # keep adding
                 LRLM_list.append(coverage)
@@ -299,13 +307,108 @@ class FST:
                 return LRLM_list
         return LRLM_list
 
+class Chunk:
+    """
+    Closed chunk of a coverage covering tokens[start:end]
+    with rule, linked to the chunk preceding it.
+    """
+    __slots__ = ('start', 'end', 'rule', 'prev')
+
+    def __init__(self, start, end, rule, prev):
+        self.start, self.end, self.rule, self.prev = start, end, rule, prev
+
+class Coverage:
+    """
+    Coverage of a tokenized line stored as a linked list of chunks.
+    It is converted to [([token, token, ... ], rule_number), ...]
+    representation only when accessed as a sequence.
+    """
+    __slots__ = ('line', 'token_matches', 'tokens', 'last', '_spans', '_chunks')
+
+    def __init__(self, line, token_matches, tokens, last):
+        self.line, self.token_matches = line, token_matches
+        self.tokens, self.last = tokens, last
+        self._spans, self._chunks = None, None
+
+    def segment(self, start, end):
+        """
+        Return the part of the line from the beginning of token start
+        to the end of token end-1 with original blanks between tokens.
+        For bytes line, return memoryview slice to avoid copying.
+        """
+        begin_pos = self.token_matches[start].start()
+        end_pos = self.token_matches[end-1].end()
+        if type(self.line) == bytes:
+            return memoryview(self.line)[begin_pos:end_pos]
+        return self.line[begin_pos:end_pos]
+
+    def spans(self):
+        """
+        Return a list of (start, end, rule_number) tuples
+        with token index spans of the chunks.
+        """
+        if self._spans is None:
+            spans, chunk = [], self.last
+            while chunk is not None:
+                spans.append((chunk.start, chunk.end, chunk.rule))
+                chunk = chunk.prev
+            spans.reverse()
+            self._spans = spans
+        return self._spans
+
+    def chunks(self):
+        """
+        Return coverage in [([token, token, ... ], rule_number), ...] format.
+        """
+        if self._chunks is None:
+            self._chunks = [(self.tokens[start:end], rule)
+                                for start, end, rule in self.spans()]
+        return self._chunks
+
+    def __len__(self):
+        return len(self.spans())
+
+    def __getitem__(self, index):
+        return self.chunks()[index]
+
+    def __iter__(self):
+        return iter(self.chunks())
+
+    def __repr__(self):
+        return repr(self.chunks())
+
 def signature(coverage):
     """
     Get coverage signature which is just a tuple
     of lengths of groups comprising the coverage.
     """
+    if isinstance(coverage, Coverage):
+        return tuple([end - start for start, end, rule in coverage.spans()])
     return tuple([len(group[0]) for group in coverage])
 
+def find_ambiguous(ambiguous_rules, coverage):
+    """
+    Find chunks of coverage covered by one of the ambiguous rules
+    in ambiguous_rules, and return their (start, end, rule_number)
+    token index spans.
+    """
+    return [(start, end, rule_number) for start, end, rule_number in coverage.spans()
+                if rule_number in ambiguous_rules]
+
+def context_window(coverage, start, end, context):
+    """
+    Extend (start, end) token span of a chunk of coverage
+    by at least context tokens on each side, cutting the window
+    at the chunk boundaries of coverage, and return its span.
+    """
+    window_start, window_end = max(start - context, 0), min(end + context, len(coverage.tokens))
+    for chunk_start, chunk_end, rule_number in coverage.spans():
+        if chunk_start < window_start < chunk_end:
+            window_start = chunk_start
+        if chunk_start < window_end < chunk_end:
+            window_end = chunk_end
+    return window_start, window_end
+
 if __name__ == "__main__":
     cat_dict, rules, ambiguous_rules, rule_id_map, rule_xmls = prepare(sys.argv[1])
     pattern_FST = FST(rules)
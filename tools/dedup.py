@@ -0,0 +1,190 @@
+#! /usr/bin/python3
+
+import sys, os, mmap, struct, hashlib, tempfile
+from array import array
+from contextlib import ExitStack
+from optparse import OptionParser
+from time import perf_counter as clock
+
+try: # imported as part of tools package
+    from tools.corpus import open_corpus, iter_aligned_lines as iter_corpus_lines
+except ImportError: # run from inside tools folder
+    from corpus import open_corpus, iter_aligned_lines as iter_corpus_lines
+
+usage_line = 'Usage: python3 dedup.py [options] INPUT_FILE OUTPUT_FILE COUNTS_FILE'
+
+# counts file: number of occurrences of each unique line (in order
+# of their first occurrence) as little-endian uint32
+count_struct = struct.Struct('<I')
+
+# hashes spilled to partition files: line hash, line number
+spilled_struct = struct.Struct('<16sQ')
+
+# number of line hashes kept in memory at once
+default_max_lines = 5000000
+
+def line_hash(lines):
+    """
+    Hash a tuple of aligned lines.
+    """
+    key = hashlib.blake2b(digest_size=16)
+    for line in lines:
+        key.update(line)
+        key.update(b'\0')
+    return key.digest()
+
+# names of corpora in alignment errors
+corpus_names = ['Source corpus', 'Target corpus']
+
+def iter_aligned_lines(ifiles):
+    """
+    Yield tuples of aligned lines of ifiles,
+    each ending with newline.
+    """
+    for lines in iter_corpus_lines(ifiles, corpus_names):
+        yield tuple(line if line.endswith(b'\n') else line + b'\n' for line in lines)
+
+def write_counts(counts, counts_fname):
+    if sys.byteorder != 'little':
+        counts.byteswap()
+    with open(counts_fname, 'wb') as ofile:
+        counts.tofile(ofile)
+
+def load_counts(counts_fname):
+    """
+    Load numbers of occurrences of unique lines from counts file.
+    """
+    counts = array('I')
+    with open(counts_fname, 'rb') as ifile:
+        counts.frombytes(ifile.read())
+    if sys.byteorder != 'little':
+        counts.byteswap()
+    return counts
+
+def dedup_in_memory(ifiles, ofiles):
+    """
+    Copy unique lines to ofiles in one pass
+    and return their numbers of occurrences.
+    """
+    first_occurrences, counts = {}, array('I')
+    for lines in iter_aligned_lines(ifiles):
+        key = line_hash(lines)
+        unique_number = first_occurrences.get(key)
+        if unique_number is None:
+            first_occurrences[key] = len(counts)
+            counts.append(1)
+            for ofile, line in zip(ofiles, lines):
+                ofile.write(line)
+        else:
+            counts[unique_number] += 1
+    return counts
+
+def dedup_with_spill(ifnames, ofiles, partitions_count, tmp_folder, jobs=1):
+    """
+    Spill line hashes into partitions_count partition files,
+    find the first occurrence of each line and count its occurrences
+    one partition at a time (in memory-mapped array of per-line counts),
+    then copy unique lines to ofiles.
+    Return their numbers of occurrences.
+    """
+    with ExitStack() as stack:
+        # spill hashes with line numbers into partitions
+        partition_files = [stack.enter_context(tempfile.TemporaryFile(dir=tmp_folder))
+                               for i in range(partitions_count)]
+        lines_count = 0
+        with ExitStack() as istack:
+            ifiles = [istack.enter_context(open_corpus(ifname, jobs)) for ifname in ifnames]
+            for lines in iter_aligned_lines(ifiles):
+                key = line_hash(lines)
+                partition = int.from_bytes(key[:4], 'little') % partitions_count
+                partition_files[partition].write(spilled_struct.pack(key, lines_count))
+                lines_count += 1
+
+        # count occurrences at first occurrences of lines
+        counts_file = stack.enter_context(tempfile.TemporaryFile(dir=tmp_folder))
+        counts_file.truncate(max(lines_count, 1) * count_struct.size)
+        counts_map = stack.enter_context(mmap.mmap(counts_file.fileno(), 0))
+        line_counts = memoryview(counts_map).cast('I')
+        try:
+            for partition_file in partition_files:
+                partition_file.seek(0)
+                first_occurrences = {}
+                for key, line_number in spilled_struct.iter_unpack(partition_file.read()):
+                    first_line_number = first_occurrences.setdefault(key, line_number)
+                    line_counts[first_line_number] += 1
+                partition_file.close()
+
+            # copy lines at their first occurrences
+            # (compressed corpora can not seek, so they are read again)
+            counts = array('I')
+            ifiles = [stack.enter_context(open_corpus(ifname, jobs)) for ifname in ifnames]
+            for line_number, lines in enumerate(iter_aligned_lines(ifiles)):
+                if line_counts[line_number] > 0:
+                    counts.append(line_counts[line_number])
+                    for ofile, line in zip(ofiles, lines):
+                        ofile.write(line)
+        finally:
+            line_counts.release()
+    return counts
+
+def dedup_corpus(ifnames, ofnames, counts_fname, max_lines=default_max_lines, jobs=1):
+    """
+    Copy unique lines of corpus (tuples of aligned lines of ifnames,
+    e.g. source and target side of parallel corpus, each of them
+    one or more possibly compressed files, see corpus.open_corpus,
+    decompressed by jobs threads) to ofnames in order
+    of their first occurrence, and write the number of occurrences
+    of each of them to counts_fname. Lines are told apart by hashes,
+    at most max_lines of which are kept in memory: hashes of bigger
+    corpora are spilled into partition files next to counts_fname.
+    Return numbers of lines and unique lines.
+    """
+    print('Deduplicating corpus.')
+    btime = clock()
+
+    with open_corpus(ifnames[0], jobs) as ifile:
+        lines_count = sum(1 for line in ifile)
+    partitions_count = -(-lines_count // max_lines)
+
+    with ExitStack() as stack:
+        ofiles = [stack.enter_context(open(ofname, 'wb')) for ofname in ofnames]
+        if partitions_count <= 1:
+            ifiles = [stack.enter_context(open_corpus(ifname, jobs)) for ifname in ifnames]
+            counts = dedup_in_memory(ifiles, ofiles)
+        else:
+            counts = dedup_with_spill(ifnames, ofiles, partitions_count,
+                                      os.path.dirname(os.path.abspath(counts_fname)), jobs)
+    write_counts(counts, counts_fname)
+
+    print('{} lines, {} unique ({:.2%})'.format(lines_count, len(counts),
+                                                len(counts) / max(lines_count, 1)))
+    print('Done in {:.2f}'.format(clock() - btime))
+    return lines_count, len(counts)
+
+def get_options():
+    """
+    Parse commandline arguments and options
+    """
+    op = OptionParser(usage=usage_line)
+    op.add_option("-m", "--max-lines", dest="max_lines", type="int",
+                  default=default_max_lines,
+                  help="keep at most N line hashes in memory, spill the rest "
+                       "to temporary files (default {})".format(default_max_lines),
+                  metavar="N")
+    op.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                  help="decompress N compressed input files at once (default 1)",
+                  metavar="N")
+
+    (opts, args) = op.parse_args()
+    if len(args) != 3:
+        op.error("wrong number of arguments.")
+    if opts.max_lines < 1:
+        op.error("maximum number of lines must be positive.")
+    if opts.jobs < 1:
+        op.error("number of jobs must be positive.")
+
+    return opts, args
+
+if __name__ == "__main__":
+    opts, args = get_options()
+    dedup_corpus([args[0]], [args[1]], args[2], opts.max_lines, opts.jobs)
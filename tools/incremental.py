@@ -0,0 +1,205 @@
+import os, re, glob, json, shutil, hashlib
+
+try: # see if lxml is installed
+    from lxml import etree
+except ImportError: # it is not
+    import xml.etree.ElementTree as etree
+
+try: # imported as part of tools package
+    from tools import chunkweights
+except ImportError: # run from inside tools folder
+    import chunkweights
+
+# statistics of rule groups from the last run are kept
+# in chunk weights file with all rows of the last run,
+# and its index: setup of the run and signature of each
+# rule group with the numbers of its rules in the rows
+stats_suffix = '-group-stats'
+index_suffix = '-group-stats.json'
+
+whitespace_re = re.compile(r'\s')
+
+def rule_md5(et_rule):
+    """
+    Calculate md5 sum of rule text without whitespace.
+    """
+    rule_text = etree.tostring(et_rule, encoding='unicode')
+    clean_rule_text = whitespace_re.sub('', rule_text)
+    return hashlib.md5(clean_rule_text.encode()).hexdigest()
+
+def file_identity(fname):
+    """
+    Identify file by its absolute path, size and modification time.
+    """
+    return [os.path.abspath(fname), os.path.getsize(fname), os.stat(fname).st_mtime_ns]
+
+def pair_identity(tixbasepath, binbasepath):
+    """
+    Identify compiled pair files (dictionaries, tagger,
+    later transfer stages) and later transfer rules files
+    of the direction, which are used to translate chunks
+    of all rule groups. Compiled t1x rules are left out,
+    as they change with every edit of the ambiguous rules.
+    """
+    fnames = glob.glob(glob.escape(binbasepath) + '.*') \
+           + glob.glob(glob.escape(tixbasepath) + '.t[2-9]x')
+    return [file_identity(fname) for fname in sorted(fnames)
+                if not fname.endswith(('.t1x', '.t1x.bin'))]
+
+def transfer_md5(t1x_fname, ambiguous_rules):
+    """
+    Calculate md5 sum of t1x rules file without ambiguous rules
+    and def-cats (which are in signatures of their groups):
+    rules which cover chunks around ambiguous ones, macros,
+    variables, attributes and lists.
+    """
+    root = etree.parse(t1x_fname).getroot()
+    ambiguous_numbers = set(rule_number for rule_group in ambiguous_rules.values()
+                                for rule_number in rule_group)
+    md5s = []
+    for section in root:
+        if not isinstance(section.tag, str) or section.tag == 'section-def-cats':
+            continue
+        if section.tag == 'section-rules':
+            md5s.extend(rule_md5(rule) for i, rule in enumerate(section.findall('rule'))
+                            if str(i) not in ambiguous_numbers)
+        else:
+            md5s.append(rule_md5(section))
+    return hashlib.md5(' '.join(md5s).encode()).hexdigest()
+
+def shared_md5(ambiguous_rules, rule_xmls, cat_dict):
+    """
+    Calculate md5 sum of what translations of every rule group
+    depend on besides its own rules: default rules of all groups
+    (which translate the other chunks of the sentence), patterns
+    of all groups and def-cats (which segment the sentence into chunks).
+    Rule numbers are left out, so moving rules does not change it.
+    """
+    default_md5s = sorted(rule_md5(rule_xmls[rule_group[0]])
+                              for rule_group in ambiguous_rules.values())
+    patterns = sorted([pattern_item.attrib['n'] for pattern_item
+                           in rule_xmls[rule_group[0]].find('pattern').findall('pattern-item')]
+                          for rule_group in ambiguous_rules.values())
+    cat_definitions = sorted([cat_re, sorted(cat_list)] for cat_re, cat_list in cat_dict.items())
+    shared_text = json.dumps([default_md5s, patterns, cat_definitions], ensure_ascii=False)
+    return hashlib.md5(shared_text.encode('utf-8')).hexdigest()
+
+def group_signatures(ambiguous_rules, rule_xmls, cat_dict):
+    """
+    Make signature of each group of ambiguous rules: md5 sum
+    of md5 sums of its rules (in order) and of the definitions
+    (cat_dict regexes) of the categories in their pattern,
+    so that it changes when a rule of the group is added, removed
+    or edited, or when a def-cat of its pattern is edited.
+    """
+    cat_res = {}
+    for cat_re, cat_list in cat_dict.items():
+        for cat in cat_list:
+            cat_res.setdefault(cat, []).append(cat_re)
+
+    signatures = {}
+    for group_number, rule_group in ambiguous_rules.items():
+        rule_md5s = [rule_md5(rule_xmls[rule_number]) for rule_number in rule_group]
+        # all rules of the group have the same pattern
+        pattern = [pattern_item.attrib['n'] for pattern_item
+                       in rule_xmls[rule_group[0]].find('pattern').findall('pattern-item')]
+        cat_definitions = [(cat, sorted(cat_res.get(cat, []))) for cat in pattern]
+        signature_text = json.dumps([rule_md5s, cat_definitions], ensure_ascii=False)
+        signatures[group_number] = hashlib.md5(signature_text.encode('utf-8')).hexdigest()
+    return signatures
+
+class GroupStatistics:
+    """
+    Chunk weights statistics of rule groups kept between runs
+    with prefix, so that only the rule groups changed since
+    the last run (by their signatures) are learned again,
+    and statistics of the others are reused.
+    Statistics are reused only if setup (dict of whatever
+    else the statistics depend on: corpus, language model,
+    learning options) is the same as in the last run.
+    """
+    def __init__(self, prefix, setup, binary=False):
+        self.prefix = prefix
+        self.stats_fname = chunkweights.make_fname(prefix + stats_suffix, binary)
+        self.index_fname = prefix + index_suffix
+        self.setup = setup
+        # signature: numbers of rules of the group in stored rows
+        self.stored_groups = {}
+        # number of reused group: numbers of its rules in stored rows
+        self.reused = {}
+        self.ambiguous_rules, self.signatures = {}, {}
+
+        if os.path.exists(self.index_fname) and os.path.exists(self.stats_fname):
+            with open(self.index_fname, 'r', encoding='utf-8') as ifile:
+                index = json.load(ifile)
+            if index.get('setup') == setup:
+                self.stored_groups = index['groups']
+            else:
+                changed = sorted(set(key for key in set(setup) | set(index.get('setup', {}))
+                                         if setup.get(key) != index.get('setup', {}).get(key)))
+                print('Warning: {} changed since the last run, '
+                      'statistics of all rule groups are thrown away.'.format(', '.join(changed)))
+
+    def plan(self, ambiguous_rules, rule_xmls, cat_dict):
+        """
+        Find rule groups whose statistics can be reused.
+        Return ambiguous rules of the groups to learn.
+        """
+        self.ambiguous_rules = ambiguous_rules
+        self.signatures = group_signatures(ambiguous_rules, rule_xmls, cat_dict)
+        self.reused = {group_number: self.stored_groups[signature]
+                           for group_number, signature in self.signatures.items()
+                               if signature in self.stored_groups}
+        return {group_number: rule_group for group_number, rule_group in ambiguous_rules.items()
+                    if group_number not in self.reused}
+
+    def report(self):
+        return '{} of {} rule groups unchanged, {} to learn'.format(
+                   len(self.reused), len(self.ambiguous_rules),
+                   len(self.ambiguous_rules) - len(self.reused))
+
+    def add_reused(self, scores_fname):
+        """
+        Append stored rows of reused rule groups to chunk weights file
+        scores_fname, renumbered to the current numbers of their rules.
+        """
+        if self.reused == {}:
+            return
+        # rules of a group with the same signature are the same rules in the same order
+        rule_numbers = {}
+        for group_number, stored_rules in self.reused.items():
+            for stored_rule, rule_number in zip(stored_rules, self.ambiguous_rules[group_number]):
+                rule_numbers[stored_rule] = (group_number, rule_number)
+
+        binary = self.stats_fname.endswith(chunkweights.binary_extension)
+        reused_fname = chunkweights.make_fname(self.prefix + stats_suffix + '-reused', binary)
+        sorted_fname = self.prefix + stats_suffix + '-sorted' + chunkweights.text_extension
+        rows = chunkweights.read_sorted(self.stats_fname, sorted_fname)
+        with chunkweights.open_writer(reused_fname, binary) as writer:
+            for stored_group, stored_rule, pattern, weight, count in rows:
+                if stored_rule in rule_numbers:
+                    group_number, rule_number = rule_numbers[stored_rule]
+                    writer.add(group_number, rule_number, pattern, weight, count)
+
+        # both text and binary chunk weights files may be concatenated
+        with open(scores_fname, 'ab') as ofile, \
+             open(reused_fname, 'rb') as ifile:
+            shutil.copyfileobj(ifile, ofile)
+        for fname in (reused_fname, sorted_fname):
+            if os.path.exists(fname):
+                os.remove(fname)
+
+    def store(self, scores_fname):
+        """
+        Keep chunk weights file with rows of all rule groups
+        (learned and reused) as statistics for the next run.
+        """
+        # index is removed first, so that interrupted store leaves no statistics
+        if os.path.exists(self.index_fname):
+            os.remove(self.index_fname)
+        shutil.copyfile(scores_fname, self.stats_fname)
+        index = {'setup': self.setup,
+                 'groups': {signature: self.ambiguous_rules[group_number]
+                                for group_number, signature in self.signatures.items()}}
+        with open(self.index_fname, 'w', encoding='utf-8') as ofile:
+            json.dump(index, ofile, indent=2)
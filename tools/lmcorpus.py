@@ -0,0 +1,219 @@
+#! /usr/bin/python3
+
+import os, hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from optparse import OptionParser
+from time import perf_counter as clock
+
+try: # imported as part of tools package
+    from tools.simpletok import normalize_many
+    from tools.corpus import open_file, is_compressed, can_decompress
+except ImportError: # run from inside tools folder
+    from simpletok import normalize_many
+    from corpus import open_file, is_compressed, can_decompress
+
+# size of a piece of corpus normalized by one worker at once
+default_chunk_size = 16
+# memory for hashes of lines when deduplicating
+default_dedup_memory = 1024
+# approximate memory taken by one hash in a set
+hash_memory = 64
+
+def split_file(fname, chunk_size):
+    """
+    Split plain file into byte ranges of about chunk_size bytes
+    which start and end at line boundaries.
+    """
+    size = os.path.getsize(fname)
+    with open(fname, 'rb') as ifile:
+        start = 0
+        while start < size:
+            ifile.seek(min(start + chunk_size, size))
+            ifile.readline()
+            end = min(ifile.tell(), size)
+            yield start, end
+            start = end
+
+def read_range(fname, start, end):
+    with open(fname, 'rb') as ifile:
+        ifile.seek(start)
+        return ifile.read(end - start)
+
+def split_lines(data):
+    """
+    Decode data and split it into lines
+    the same way as text file iteration does.
+    """
+    text = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+    lines = [line + '\n' for line in text.split('\n')]
+    lines[-1] = lines[-1][:-1]
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+def line_hash(line):
+    return hashlib.blake2b(line, digest_size=8).digest()
+
+def normalize_chunk(source, dedup=False):
+    """
+    Normalize a chunk of corpus, which is either
+    a (file name, start, end) byte range or data itself.
+    Return normalized data (as list of lines with their hashes
+    if dedup is True), and size of chunk in bytes.
+    """
+    data = read_range(*source) if type(source) == type(()) else source
+    normalized = normalize_many(split_lines(data))
+    if dedup:
+        lines = [line.encode('utf-8') for line in normalized]
+        return (lines, [line_hash(line) for line in lines]), len(data)
+    return ''.join(normalized).encode('utf-8'), len(data)
+
+def iter_chunks(fnames, chunk_size):
+    """
+    Go through files in order and yield their chunks.
+    Plain files are yielded as byte ranges read by workers,
+    compressed ones are decompressed and yielded as data.
+    None is yielded at the end of each file.
+    """
+    for fname in fnames:
+        if is_compressed(fname):
+            with open_file(fname) as ifile:
+                lines = ifile.readlines(chunk_size)
+                while lines != []:
+                    yield b''.join(lines)
+                    lines = ifile.readlines(chunk_size)
+        else:
+            for start, end in split_file(fname, chunk_size):
+                yield (fname, start, end)
+        yield None
+
+class LineDeduplicator:
+    """
+    Set of hashes of already seen lines with bounded memory.
+    When it is full, new lines are not remembered any more,
+    but lines seen before are still dropped.
+    """
+    def __init__(self, memory=default_dedup_memory):
+        self.max_size = memory * 1024 * 1024 // hash_memory
+        self.hashes = set()
+        self.duplicates = 0
+        self.full = False
+
+    def filter(self, lines, hashes):
+        kept = []
+        for line, hash_value in zip(lines, hashes):
+            if line.strip() == b'':
+                # empty lines separate documents, they are always kept
+                kept.append(line)
+            elif hash_value in self.hashes:
+                self.duplicates += 1
+            else:
+                if len(self.hashes) < self.max_size:
+                    self.hashes.add(hash_value)
+                elif not self.full:
+                    print('Deduplication memory is full, new lines are not remembered any more.')
+                    self.full = True
+                kept.append(line)
+        return b''.join(kept)
+
+def prepare_corpus(fnames, ofname, jobs=None, chunk_size=default_chunk_size,
+                   dedup=False, dedup_memory=default_dedup_memory, separate_files=False):
+    """
+    Normalize files from fnames (plain, or compressed ones
+    which corpus.open_file reads: gzip, bzip2, xz or zstandard)
+    on jobs processes and write the result to ofname in the same order.
+    If separate_files is True, empty line is written after each file.
+    If dedup is True, repeated lines are written only once,
+    remembering at most dedup_memory megabytes of them.
+    """
+    print('Preparing language model corpus from {} files.'.format(len(fnames)))
+    btime = clock()
+    jobs = jobs or os.cpu_count()
+    deduplicator = LineDeduplicator(dedup_memory) if dedup else None
+    total_bytes = 0
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor, \
+         open(ofname, 'wb') as ofile:
+        # keep a bounded number of chunks in work, and write them out in order
+        pending = deque()
+
+        def write_next():
+            future = pending.popleft()
+            if future is None:
+                if separate_files:
+                    ofile.write(b'\n')
+                return 0
+            normalized, size = future.result()
+            if dedup:
+                normalized = deduplicator.filter(*normalized)
+            ofile.write(normalized)
+            return size
+
+        for chunk in iter_chunks(fnames, chunk_size * 1024 * 1024):
+            if chunk is None:
+                pending.append(None)
+            else:
+                pending.append(executor.submit(normalize_chunk, chunk, dedup))
+            while len([future for future in pending if future is not None]) > 2 * jobs:
+                total_bytes += write_next()
+        while pending:
+            total_bytes += write_next()
+
+    elapsed = clock() - btime
+    print('Done in {:.2f}, {:.1f} MB/s'.format(elapsed, total_bytes / 1024 / 1024 / max(elapsed, 1e-9)))
+    if dedup:
+        print('Dropped {} duplicate lines.'.format(deduplicator.duplicates))
+    return ofname
+
+def list_files(paths):
+    """
+    Expand folders in paths into sorted lists of files in them.
+    """
+    fnames = []
+    for path in paths:
+        if os.path.isdir(path):
+            fnames.extend(os.path.join(path, fname) for fname in sorted(os.listdir(path)))
+        else:
+            fnames.append(path)
+    return fnames
+
+def get_options():
+    """
+    Parse commandline arguments and options
+    """
+    usage = "USAGE: python3 %prog [options] OUTPUT_FILE INPUT [INPUT ...]"
+    op = OptionParser(usage=usage)
+
+    op.add_option("-j", "--jobs", dest="jobs", type="int", default=None,
+                  help="normalize on JOBS processes (all processors by default)", metavar="JOBS")
+    op.add_option("--chunk-size", dest="chunk_size", type="int", default=default_chunk_size,
+                  help="normalize corpus in chunks of MB megabytes", metavar="MB")
+    op.add_option("--dedup", dest="dedup", action="store_true", default=False,
+                  help="write repeated lines only once")
+    op.add_option("--dedup-memory", dest="dedup_memory", type="int", default=default_dedup_memory,
+                  help="remember at most MB megabytes of lines for deduplication", metavar="MB")
+    op.add_option("--separate", dest="separate_files", action="store_true", default=False,
+                  help="write empty line after each input file")
+
+    (opts, args) = op.parse_args()
+
+    if len(args) < 2:
+        op.error("output file and at least one input are required.")
+
+    missing = [path for path in args[1:] if not os.path.exists(path)]
+    if missing != []:
+        op.error("inputs not found: {}".format(', '.join(missing)))
+
+    fnames = list_files(args[1:])
+    undecompressable = [fname for fname in fnames if not can_decompress(fname)]
+    if undecompressable != []:
+        op.error("neither zstandard library nor zstd command is found "
+                 "to decompress {}".format(', '.join(undecompressable)))
+
+    return opts, args[0], fnames
+
+if __name__ == "__main__":
+    opts, ofname, fnames = get_options()
+    prepare_corpus(fnames, ofname, opts.jobs, opts.chunk_size,
+                   opts.dedup, opts.dedup_memory, opts.separate_files)
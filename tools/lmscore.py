@@ -0,0 +1,295 @@
+import os, struct, hashlib
+from collections import OrderedDict
+
+try: # imported as part of tools package
+    from tools.memory import budget
+except ImportError: # run from inside tools folder
+    from memory import budget
+
+# kenlm is imported only when a language model is used
+# (it is not needed in parallel mode)
+kenlm = None
+
+end_of_sentence = '</s>'
+
+# default number of sentence scores kept in cache
+default_cache_size = 100000
+
+# number of scores put into cache between checks of memory budget
+budget_check_interval = 10000
+
+# persistent cache file: identity line of language model file,
+# then (sentence hash, log10 probability) records
+cache_record = struct.Struct('<16sd')
+
+def import_kenlm():
+    """
+    Import kenlm on first use and return it,
+    or return None if it is not installed.
+    """
+    global kenlm
+    if kenlm is None:
+        try: # see if kenlm is installed
+            import kenlm
+        except ImportError: # it is not, only full scoring is possible
+            return None
+    return kenlm
+
+def prefault(lm_fname, block_size=16*1024*1024):
+    """
+    Read language model file through once, so that it is
+    in page cache when it is loaded or memory-mapped.
+    Reading does not hold the interpreter lock,
+    so it may be done in background thread.
+    """
+    buf = bytearray(block_size)
+    with open(lm_fname, 'rb', buffering=0) as ifile:
+        while ifile.readinto(buf):
+            pass
+
+def common_prefix_length(variants):
+    """
+    Count words shared by all variants at the beginning.
+    """
+    length = 0
+    for words in zip(*variants):
+        if any(word != words[0] for word in words[1:]):
+            break
+        length += 1
+    return length
+
+def common_suffix_length(variants, prefix_length):
+    """
+    Count words shared by all variants at the end
+    that do not belong to common prefix.
+    """
+    max_length = min(len(words) for words in variants) - prefix_length
+    length = 0
+    while length < max_length and \
+          all(words[-length - 1] == variants[0][-length - 1] for words in variants[1:]):
+        length += 1
+    return length
+
+def cache_sentence(sentence, bos=True, eos=True):
+    """
+    Make the sentence under which the score of sentence is cached:
+    scores without beginning or end of sentence are kept apart.
+    """
+    if bos and eos:
+        return sentence
+    return '{:d}{:d}\t{}'.format(bos, eos, sentence)
+
+def model_identity(lm_fname):
+    """
+    Identify language model file by its path, size and modification time.
+    """
+    stat = os.stat(lm_fname)
+    return '{}\t{}\t{}\n'.format(os.path.abspath(lm_fname), stat.st_size, stat.st_mtime_ns).encode('utf-8')
+
+class ScoreCache:
+    """
+    Bounded cache of language model scores of normalized sentences.
+    Sentences are stored as their hashes, and the least recently
+    used scores are dropped when there are more than size of them.
+    When memory budget is nearly used up, the cache is halved.
+    """
+    def __init__(self, size=default_cache_size):
+        self.size = size
+        self.scores = OrderedDict()
+        self.hits, self.misses = 0, 0
+        self.puts = 0
+
+    @staticmethod
+    def key(sentence):
+        return hashlib.blake2b(sentence.encode('utf-8'), digest_size=16).digest()
+
+    def get(self, sentence):
+        """
+        Return cached score of sentence or None.
+        """
+        key = self.key(sentence)
+        score = self.scores.get(key)
+        if score is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.scores.move_to_end(key)
+        return score
+
+    def put(self, sentence, score):
+        self.scores[self.key(sentence)] = score
+        self.puts += 1
+        if self.puts % budget_check_interval == 0 and budget.near_limit():
+            self.resize(max(len(self.scores) // 2, 1))
+        else:
+            self.resize(self.size)
+
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return self.hits / requests if requests > 0 else 0.
+
+    def load(self, fname, lm_fname):
+        """
+        Load scores saved for the same language model file.
+        Return True if scores were loaded.
+        """
+        if not os.path.exists(fname):
+            return False
+        with open(fname, 'rb') as ifile:
+            if ifile.readline() != model_identity(lm_fname):
+                return False
+            data = ifile.read()
+        for key, score in cache_record.iter_unpack(data[:len(data) - len(data) % cache_record.size]):
+            self.scores[key] = score
+        self.resize(self.size)
+        return True
+
+    def resize(self, size):
+        """
+        Change the size of the cache,
+        dropping the least recently used scores over it.
+        """
+        self.size = size
+        while len(self.scores) > self.size:
+            self.scores.popitem(last=False)
+
+    def save(self, fname, lm_fname):
+        """
+        Save scores with identity of the language model file.
+        File is replaced at once, so concurrent jobs
+        never see it written in part.
+        """
+        tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+        with open(tmp_fname, 'wb') as ofile:
+            ofile.write(model_identity(lm_fname))
+            for key, score in self.scores.items():
+                ofile.write(cache_record.pack(key, score))
+        os.replace(tmp_fname, fname)
+
+class VariantScorer:
+    """
+    Language model scorer for variants of a sentence
+    which differ only in some segment.
+
+    Common prefix of the variants is scored once,
+    and its state is branched for each variant.
+    In common suffix, each variant is scored only
+    until its n-gram context (kenlm state) converges
+    with the context of the first variant at the same word,
+    as the rest of its score is the same from there on.
+    Models without stateful API (including remote models
+    of language model server) are scored in full.
+    If cache is provided, only sentences missing from it are scored.
+    """
+    def __init__(self, model, cache=None):
+        self.model = model
+        self.cache = cache
+        self.stateful = hasattr(model, 'BaseScore') and hasattr(model, 'BeginSentenceWrite') \
+                            and import_kenlm() is not None
+        # statistics: words in variants (with end of sentence)
+        # and words actually scored by language model
+        self.words_total, self.words_scored = 0, 0
+
+    def score_full(self, sentences, bos=True, eos=True):
+        """
+        Score each sentence separately
+        (in one request if model is served by language model server).
+        """
+        words_count = sum(len(sentence.split()) + eos for sentence in sentences)
+        self.words_total += words_count
+        self.words_scored += words_count
+        if hasattr(self.model, 'score_batch'):
+            return self.model.score_batch(sentences, bos, eos)
+        return [self.model.score(sentence, bos=bos, eos=eos) for sentence in sentences]
+
+    def score(self, sentences, bos=True, eos=True):
+        """
+        Return log10 probabilities of normalized sentences
+        with beginning and end of sentence (unless bos or eos
+        is False, e.g. for pieces of sentences), like model.score.
+        """
+        if self.cache is None:
+            return self.score_variants(sentences, bos, eos)
+
+        keys = [cache_sentence(sentence, bos, eos) for sentence in sentences]
+        scores = [self.cache.get(key) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        self.words_total += sum(len(sentence.split()) + eos
+                                    for sentence, score in zip(sentences, scores)
+                                        if score is not None)
+        if missing != []:
+            missing_scores = self.score_variants([sentences[i] for i in missing], bos, eos)
+            for i, score in zip(missing, missing_scores):
+                scores[i] = score
+                self.cache.put(keys[i], score)
+        return scores
+
+    def score_variants(self, sentences, bos=True, eos=True):
+        """
+        Score variants sharing their common parts.
+        """
+        if not self.stateful or len(sentences) < 2:
+            return self.score_full(sentences, bos, eos)
+
+        variants = [sentence.split() for sentence in sentences]
+        prefix_length = common_prefix_length(variants)
+        suffix_length = common_suffix_length(variants, prefix_length)
+
+        # score common prefix once
+        prefix_state = kenlm.State()
+        if bos:
+            self.model.BeginSentenceWrite(prefix_state)
+        else:
+            self.model.NullContextWrite(prefix_state)
+        prefix_score = 0.
+        for word in variants[0][:prefix_length]:
+            out_state = kenlm.State()
+            prefix_score += self.model.BaseScore(prefix_state, word, out_state)
+            prefix_state = out_state
+        self.words_scored += prefix_length
+
+        # states before each word of common suffix of the first variant
+        # and scores of the rest of the sentence from that word on
+        reference_states, reference_rests = [], []
+
+        scores = []
+        for words in variants:
+            self.words_total += len(words) + eos
+
+            # score the segment of the variant branching from common prefix
+            score, state = prefix_score, prefix_state
+            for word in words[prefix_length:len(words) - suffix_length]:
+                out_state = kenlm.State()
+                score += self.model.BaseScore(state, word, out_state)
+                state = out_state
+                self.words_scored += 1
+
+            # score common suffix until context converges
+            suffix = words[len(words) - suffix_length:] + [end_of_sentence] * eos
+            if reference_states == []:
+                suffix_scores = []
+                for word in suffix:
+                    reference_states.append(state)
+                    out_state = kenlm.State()
+                    suffix_scores.append(self.model.BaseScore(state, word, out_state))
+                    state = out_state
+                self.words_scored += len(suffix)
+                rest = 0.
+                for word_score in reversed(suffix_scores):
+                    rest += word_score
+                    reference_rests.append(rest)
+                reference_rests.reverse()
+                score += rest
+            else:
+                for i, word in enumerate(suffix):
+                    if state == reference_states[i]:
+                        score += reference_rests[i]
+                        break
+                    out_state = kenlm.State()
+                    score += self.model.BaseScore(state, word, out_state)
+                    state = out_state
+                    self.words_scored += 1
+
+            scores.append(score)
+
+        return scores
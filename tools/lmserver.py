@@ -0,0 +1,246 @@
+#! /usr/bin/python3
+
+import sys, os, stat, signal, socket, socketserver, struct, threading
+from optparse import OptionParser
+from time import perf_counter as clock
+
+try: # imported as part of tools package
+    from tools.lmscore import VariantScorer, ScoreCache, import_kenlm, model_identity
+    from tools.sockets import send_frame, recv_frame
+except ImportError: # run from inside tools folder
+    from lmscore import VariantScorer, ScoreCache, import_kenlm, model_identity
+    from sockets import send_frame, recv_frame
+
+usage_line = 'Usage: python3 lmserver.py [options] LANGUAGE_MODEL SOCKET_FILE'
+
+# requests (one frame each):
+#   identity: command, answered with identity line of language model file
+#   score: command, flags (1 for beginning, 2 for end of sentence),
+#          number of sentences (little-endian uint32),
+#          then utf-8 sentences separated by newlines,
+#          answered with their log10 probabilities (little-endian doubles)
+# answers start with status, error answers carry the message
+identity_command, score_command = b'I', b'S'
+ok_status, error_status = b'+', b'-'
+score_header = struct.Struct('<BI')
+bos_flag, eos_flag = 1, 2
+
+# default number of seconds between reports of served requests
+default_report_interval = 60
+
+class ServerStats:
+    """
+    Numbers of requests and scored sentences since the start
+    and since the last report (idle periods are not reported).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = self.last_report = clock()
+        self.requests, self.sentences, self.max_batch = 0, 0, 0
+        self.last_requests, self.last_sentences = 0, 0
+
+    def add(self, batch_size):
+        with self.lock:
+            self.requests += 1
+            self.sentences += batch_size
+            self.max_batch = max(self.max_batch, batch_size)
+
+    def report(self, total=False):
+        with self.lock:
+            now = clock()
+            if total:
+                elapsed, requests, sentences = now - self.start, self.requests, self.sentences
+            else:
+                elapsed = now - self.last_report
+                requests = self.requests - self.last_requests
+                sentences = self.sentences - self.last_sentences
+                self.last_report = now
+                self.last_requests, self.last_sentences = self.requests, self.sentences
+                if requests == 0: # nothing to report while idle
+                    return
+        print('{} requests ({:.1f}/s), {} sentences ({:.1f}/s), '
+              'mean batch {:.1f}, max batch {}'.format(
+                  requests, requests / max(elapsed, 1e-9),
+                  sentences, sentences / max(elapsed, 1e-9),
+                  sentences / max(requests, 1), self.max_batch))
+        sys.stdout.flush()
+
+class ScoringHandler(socketserver.BaseRequestHandler):
+    """
+    Answer requests of one client until it disconnects.
+    """
+    def handle(self):
+        server = self.server
+        while True:
+            request = recv_frame(self.request)
+            if request is None:
+                break
+            try:
+                answer = ok_status + server.answer(request)
+            except Exception as e:
+                answer = error_status + str(e).encode('utf-8')
+            send_frame(self.request, answer)
+
+class ScoringServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Language model scoring server, one thread per client.
+    Batches of variants of a sentence are scored
+    sharing their common parts, like in the learner.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_fname, model, identity, cache=None):
+        super().__init__(socket_fname, ScoringHandler)
+        self.scorer = VariantScorer(model, cache)
+        self.identity = identity
+        self.stats = ServerStats()
+        # kenlm holds interpreter lock while scoring anyway,
+        # the lock keeps scorer statistics consistent
+        self.scoring_lock = threading.Lock()
+
+    def answer(self, request):
+        command = request[:1]
+        if command == identity_command:
+            return self.identity
+        if command != score_command:
+            raise ValueError('Unknown command {!r}'.format(command))
+        flags, count = score_header.unpack_from(request, 1)
+        sentences = request[1 + score_header.size:].decode('utf-8').split('\n') if count else []
+        if len(sentences) != count:
+            raise ValueError('Expected {} sentences, got {}'.format(count, len(sentences)))
+        with self.scoring_lock:
+            scores = self.scorer.score(sentences, bool(flags & bos_flag), bool(flags & eos_flag))
+        self.stats.add(count)
+        return struct.pack('<{}d'.format(count), *scores)
+
+class RemoteModel:
+    """
+    Client of language model server. Scores sentences
+    like kenlm model, and whole batches of them at once
+    with score_batch, which takes one round-trip.
+    """
+    def __init__(self, socket_fname):
+        self.socket_fname = socket_fname
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_fname)
+
+    def request(self, payload):
+        send_frame(self.sock, payload)
+        answer = recv_frame(self.sock)
+        if answer is None:
+            raise ConnectionError('Language model server {} closed connection'.format(self.socket_fname))
+        if answer[:1] != ok_status:
+            raise RuntimeError('Language model server {} failed: {}'.format(
+                                   self.socket_fname, answer[1:].decode('utf-8', 'replace')))
+        return answer[1:]
+
+    def identity(self):
+        """
+        Return identity line of the language model file served.
+        """
+        return self.request(identity_command)
+
+    def score_batch(self, sentences, bos=True, eos=True):
+        """
+        Return log10 probabilities of sentences.
+        """
+        flags = bos_flag * bos | eos_flag * eos
+        payload = score_command + score_header.pack(flags, len(sentences)) + \
+                  '\n'.join(sentence.replace('\n', ' ') for sentence in sentences).encode('utf-8')
+        return list(struct.unpack('<{}d'.format(len(sentences)), self.request(payload)))
+
+    def score(self, sentence, bos=True, eos=True):
+        return self.score_batch([sentence], bos, eos)[0]
+
+    def close(self):
+        self.sock.close()
+
+def connect(socket_fname, lm_fname):
+    """
+    Connect to language model server and check
+    that it serves language model from lm_fname.
+    """
+    model = RemoteModel(socket_fname)
+    if model.identity() != model_identity(lm_fname):
+        model.close()
+        raise ValueError('Language model server {} does not serve {}'.format(socket_fname, lm_fname))
+    return model
+
+def serve(lm_fname, socket_fname, cache_size=0, report_interval=default_report_interval):
+    """
+    Load language model and answer scoring requests
+    on socket_fname until interrupted.
+    """
+    print('Loading language model.')
+    btime = clock()
+    model = import_kenlm().LanguageModel(lm_fname)
+    print('Done in {:.2f}'.format(clock() - btime))
+
+    # remove socket left by server that was not shut down
+    if os.path.exists(socket_fname) and stat.S_ISSOCK(os.stat(socket_fname).st_mode):
+        os.remove(socket_fname)
+
+    cache = ScoreCache(cache_size) if cache_size > 0 else None
+    server = ScoringServer(socket_fname, model, model_identity(lm_fname), cache)
+    stop = threading.Event()
+
+    def report_periodically():
+        while not stop.wait(report_interval):
+            server.stats.report()
+
+    if report_interval > 0:
+        threading.Thread(target=report_periodically, daemon=True).start()
+
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+
+    # shut down the same way on kill as on ctrl+c
+    signal.signal(signal.SIGTERM, interrupt)
+
+    print('Serving language model on {}.'.format(socket_fname))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        os.remove(socket_fname)
+
+    print('Served in total:')
+    server.stats.report(total=True)
+    print('Language model scored {} of {} words'.format(server.scorer.words_scored,
+                                                        server.scorer.words_total))
+    if cache is not None:
+        print('Score cache hit rate {:.2%} ({} hits, {} misses)'.format(cache.hit_rate(),
+                                                                         cache.hits, cache.misses))
+
+def get_options():
+    """
+    Parse commandline arguments and options
+    """
+    op = OptionParser(usage=usage_line)
+    op.add_option("-c", "--cache-size", dest="cache_size", type="int", default=0,
+                  help="keep scores of N sentences shared by all clients "
+                       "(default 0, no cache)",
+                  metavar="N")
+    op.add_option("-r", "--report-interval", dest="report_interval", type="int",
+                  default=default_report_interval,
+                  help="report requests served every N seconds, 0 only at exit "
+                       "(default {})".format(default_report_interval),
+                  metavar="N")
+
+    (opts, args) = op.parse_args()
+    if len(args) != 2:
+        op.error("wrong number of arguments.")
+    if not os.path.exists(args[0]):
+        op.error('language model "{}" not found.'.format(args[0]))
+    if import_kenlm() is None:
+        op.error("kenlm library not found.")
+
+    return opts, args
+
+if __name__ == "__main__":
+    opts, args = get_options()
+    serve(args[0], args[1], opts.cache_size, opts.report_interval)
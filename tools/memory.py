@@ -0,0 +1,151 @@
+import sys, os, gc, resource, tracemalloc, threading
+from contextlib import contextmanager
+from time import perf_counter as clock
+
+# share of memory budget at which large structures are spilled to disk
+spill_share = 0.8
+
+# garbage collector thresholds for learning: objects made per sentence
+# (coverages, segments) are freed by reference counting, so young
+# generation is collected less often than by default (700)
+gc_thresholds = (50000, 20, 100)
+
+page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def current_rss():
+    """
+    Return resident set size of the process in bytes
+    (peak resident set size where it is not available).
+    """
+    try:
+        with open('/proc/self/statm') as ifile:
+            return int(ifile.read().split()[1]) * page_size
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+def peak_rss():
+    """
+    Return peak resident set size of the process in bytes
+    since its start or since the last reset_peak_rss.
+    """
+    try:
+        with open('/proc/self/status') as ifile:
+            for line in ifile:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    # kilobytes on linux, bytes on mac os
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def reset_peak_rss():
+    """
+    Reset peak resident set size to the current one (linux only).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as ofile:
+            ofile.write('5')
+    except OSError:
+        pass
+
+def megabytes(size):
+    return '{:.1f} MB'.format(size / 1024 / 1024)
+
+class MemoryBudget:
+    """
+    Memory use of learning stages: peak resident set size of each stage
+    and, if tracing is on, peak size of memory blocks allocated by python
+    (tracemalloc slows learning down, so it is off by default).
+    If max_memory (in megabytes) is set, large structures check near_limit
+    and spill to disk when resident set size approaches it.
+    """
+    def __init__(self):
+        self.max_memory = None
+        self.trace = False
+        # name, seconds, peak rss, peak traced size (None if not traced)
+        self.stages = []
+        # peaks of stages being run in each thread, outer first
+        self.local = threading.local()
+        # number of stages being run in all threads
+        self.running_count = 0
+        self.lock = threading.Lock()
+
+    def configure(self, max_memory=None, trace=False):
+        self.max_memory = None if max_memory is None else max_memory * 1024 * 1024
+        self.trace = trace
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def near_limit(self):
+        return self.max_memory is not None and current_rss() >= spill_share * self.max_memory
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Measure memory use of the code run in with block
+        (or of decorated function).
+        Stages run at once in several threads share the peak
+        resident set size of the process: peaks are not reset
+        while stages of other threads are running, so that their
+        peaks are not lost (a stage may then report a peak reached
+        before it started).
+        """
+        if not hasattr(self.local, 'running'):
+            self.local.running = []
+        running = self.local.running
+        with self.lock:
+            # peaks are reset for the stage, so outer stage keeps its peak so far
+            if running != []:
+                running[-1][0] = max(running[-1][0], peak_rss())
+                if self.trace:
+                    running[-1][1] = max(running[-1][1], tracemalloc.get_traced_memory()[1])
+            if self.running_count == len(running):
+                reset_peak_rss()
+                if self.trace:
+                    tracemalloc.reset_peak()
+            self.running_count += 1
+        peaks = [0, 0]
+        running.append(peaks)
+        btime = clock()
+        try:
+            yield
+        finally:
+            running.pop()
+            with self.lock:
+                self.running_count -= 1
+            peaks[0] = max(peaks[0], peak_rss())
+            if self.trace:
+                peaks[1] = max(peaks[1], tracemalloc.get_traced_memory()[1])
+            self.stages.append((name, clock() - btime, peaks[0], peaks[1] if self.trace else None))
+            if running != []:
+                running[-1][0] = max(running[-1][0], peaks[0])
+                running[-1][1] = max(running[-1][1], peaks[1])
+
+    def report(self, first=0):
+        """
+        Print memory use of stages run so far (from first stage on).
+        """
+        stages = self.stages[first:]
+        if stages == []:
+            return
+        print('\nMemory summary{}:'.format('' if self.max_memory is None else
+                                           ' (budget {})'.format(megabytes(self.max_memory))))
+        for name, seconds, rss, traced in stages:
+            print('{}: {:.2f} s, peak RSS {}{}'.format(name, seconds, megabytes(rss),
+                      '' if traced is None else ', peak traced {}'.format(megabytes(traced))))
+        print('Peak RSS of all stages {}'.format(megabytes(max(rss for name, seconds, rss, traced
+                                                                 in stages))))
+
+# memory budget of the process
+budget = MemoryBudget()
+
+def tune_gc():
+    """
+    Move objects which live through learning (rules, pattern FST,
+    language model wrappers) out of garbage collector's sight
+    and make young generation collections rarer.
+    """
+    gc.collect()
+    gc.freeze()
+    gc.set_threshold(*gc_thresholds)
@@ -1,8 +1,120 @@
-import sys, re
-from subprocess import Popen, PIPE
+import sys, re, os, select
+from subprocess import Popen, PIPE, TimeoutExpired
+from time import monotonic
 
 # apertium special symbols for removal 
-apertium_re = re.compile(r'[@#~*]')
+apertium_re = re.compile(rb'[@#~*]')
+
+# superblank delimiting segments translated in one round-trip
+# (apertium passes superblanks through the pipeline untouched)
+segment_sep = b'[|]'
+
+# end of input marker
+end_marker = b'[][\n]'
+
+# default time limit for one translation request (in seconds)
+default_timeout = 60.
+# how often stages are checked while waiting for their output
+poll_interval = 0.5
+
+class PipelineError(Exception):
+    """
+    Pipeline stage died, stalled, or produced unexpected output.
+    """
+
+class RejectedInput(PipelineError):
+    """
+    Input failed the pipeline even after it was restarted.
+    """
+
+def pair_paths(pair_data, source, target):
+    """
+    Make base paths of t1x rules file and compiled pair files
+    in pair_data folder in source-target direction.
+    """
+    tixbasename = '{}.{}-{}'.format(os.path.basename(pair_data), source, target)
+    tixbasepath = os.path.join(pair_data, tixbasename)
+    binbasepath = os.path.join(pair_data, '{}-{}'.format(source, target))
+    return tixbasepath, binbasepath
+
+def to_bytes(string):
+    """
+    Return bytes-like object for string.
+    Bytes and memoryviews are passed as is to avoid copying.
+    """
+    if type(string) == type(''):
+        return bytes(string.strip(), 'utf-8')
+    return string
+
+def check_alive(processes):
+    """
+    Raise PipelineError if any of processes has exited.
+    """
+    for process in processes:
+        if process.poll() is not None:
+            raise PipelineError('{} exited with code {}'.format(process.args[0],
+                                                                process.returncode))
+
+def write_input(stream, data):
+    """
+    Write data to stream of pipeline stage and flush it.
+    """
+    try:
+        stream.write(data)
+        stream.flush()
+    except (BrokenPipeError, OSError) as error:
+        raise PipelineError('writing to pipeline failed: {}'.format(error))
+
+def read_null_flushed(stream, timeout=None, processes=()):
+    """
+    Read stream of null flushed pipeline up to the null character.
+    If timeout (in seconds) is given, wait for the output at most
+    that long, checking all the while that processes are alive.
+    """
+    fd = stream.fileno()
+    deadline = None if timeout is None else monotonic() + timeout
+    output = []
+    while True:
+        if deadline is not None:
+            ready = []
+            while ready == []:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise PipelineError('no output in {} seconds'.format(timeout))
+                ready, _, _ = select.select([fd], [], [], min(remaining, poll_interval))
+                if ready == []:
+                    check_alive(processes)
+        chunk = os.read(fd, 65536)
+        if chunk == b'':
+            check_alive(processes)
+            raise PipelineError('pipeline closed its output')
+        end = chunk.find(b'\0')
+        if end >= 0:
+            if end != len(chunk) - 1:
+                # null flushed pipeline waits for input after the null character
+                raise PipelineError('unexpected output after the null character')
+            output.append(chunk[:end])
+            return b''.join(output)
+        output.append(chunk)
+
+def close_processes(processes):
+    """
+    Kill processes of a pipeline and wait for them.
+    """
+    for process in processes:
+        if process.poll() is None:
+            process.kill()
+    for process in processes:
+        process.wait()
+        for stream in (process.stdin, process.stdout):
+            if stream is not None:
+                stream.close()
+
+def clean_output(output):
+    """
+    Remove end of input marker and apertium special symbols.
+    """
+    return apertium_re.sub(b'', output.replace(end_marker, b''))
 
 class partialTranslator():
     """
@@ -38,31 +150,47 @@ class partialTranslator():
                               binfname + '.autogen.bin'
                              ],
                              stdin = self.postchunk.stdout, stdout = PIPE)
+        self.processes = [self.autobil, self.transfer, self.interchunk,
+                          self.postchunk, self.autogen]
 
-    def translate(self, string):
+    def translate(self, string, timeout=None):
         """
-        Convert input string to bytes,
-        send it to the pipeline,
-        return the result converted to utf-8.
+        Send string to the pipeline and return the result.
+        String may be str, bytes or memoryview: the result
+        is str for str and utf-8 encoded bytes otherwise.
+        If the result is not ready in timeout seconds,
+        or pipeline dies, PipelineError is raised.
         """
-        string = string.strip() + '[][\n]'
+        write_input(self.autobil.stdin, b''.join((to_bytes(string), end_marker, b'\0')))
 
-        if type(string) == type(''): 
-            bstring = bytes(string, 'utf-8')
-        else:
-            bstring = string  
+        output = clean_output(read_null_flushed(self.autogen.stdout, timeout, self.processes))
+        if type(string) == type(''):
+            return output.decode('utf-8')
+        return output
 
-        self.autobil.stdin.write(bstring)
-        self.autobil.stdin.write(b'\0')
-        self.autobil.stdin.flush()
+    def translate_batch(self, strings, timeout=None):
+        """
+        Translate a list of strings in one round-trip:
+        send them to the pipeline at once delimited
+        with segment separators, and split the result.
+        """
+        write_input(self.autobil.stdin,
+                    (b' ' + segment_sep + b' ').join(to_bytes(string) for string in strings)
+                        + end_marker + b'\0')
 
-        char = self.autogen.stdout.read(1)
-        output = []
-        while char and char != b'\0':
-            output.append(char)
-            char = self.autogen.stdout.read(1)
+        output = read_null_flushed(self.autogen.stdout, timeout, self.processes)
+        translations = clean_output(output).split(segment_sep)
+        if len(translations) != len(strings):
+            # separators did not survive the pipeline:
+            # fall back to one round-trip per string
+            return [self.translate(string, timeout) for string in strings]
+        translations = [translation.strip(b' ') for translation in translations]
+        if strings != [] and type(strings[0]) == type(''):
+            return [translation.decode('utf-8') for translation in translations]
+        return translations
 
-        return apertium_re.sub('', (b''.join(output)).decode('utf-8').replace('[][\n]',''))
+    def close(self):
+        close_processes(self.processes)
 
 class weightedPartialTranslator():
     """
@@ -104,30 +232,21 @@ class weightedPartialTranslator():
                               binfname + '.autogen.bin'
                              ],
                              stdin = self.postchunk.stdout, stdout = PIPE)
+        self.processes = [self.autobil, self.interchunk, self.postchunk, self.autogen]
 
-    def translate(self, string, wixfname):
+    def translate(self, string, wixfname, timeout=None):
         """
-        Convert input string to bytes,
-        send it to the pipeline,
-        return the result converted to utf-8.
+        Send string to the pipeline using transfer weights
+        from wixfname and return the result. String may be
+        str, bytes or memoryview: the result is str for str
+        and utf-8 encoded bytes otherwise.
+        If the result is not ready in timeout seconds
+        at any stage, or pipeline dies, PipelineError is raised.
         """
-        string = string.strip() + '[][\n]'
-
-        if type(string) == type(''): 
-            bstring = bytes(string, 'utf-8')
-        else:
-            bstring = string  
-
         # start going through null flush pipeline
-        self.autobil.stdin.write(bstring)
-        self.autobil.stdin.write(b'\0')
-        self.autobil.stdin.flush()
+        write_input(self.autobil.stdin, b''.join((to_bytes(string), end_marker, b'\0')))
 
-        char = self.autobil.stdout.read(1)
-        autobil_output = []
-        while char and char != b'\0':
-            autobil_output.append(char)
-            char = self.autobil.stdout.read(1)
+        autobil_output = read_null_flushed(self.autobil.stdout, timeout, self.processes)
 
         # make weighted transfer
         transfer = Popen(['apertium-transfer', '-bw',
@@ -137,17 +256,125 @@ class weightedPartialTranslator():
                          ],
                          stdin = PIPE, stdout = PIPE)
 
-        transfer_output, err = transfer.communicate(b''.join(autobil_output))
+        try:
+            transfer_output, err = transfer.communicate(autobil_output, timeout)
+        except TimeoutExpired:
+            transfer.kill()
+            transfer.communicate()
+            raise PipelineError('no output from transfer in {} seconds'.format(timeout))
+        if transfer.returncode != 0:
+            raise PipelineError('transfer exited with code {}'.format(transfer.returncode))
 
         # resume going through null flush pipeline
-        self.interchunk.stdin.write(transfer_output)
-        self.interchunk.stdin.write(b'\0')
-        self.interchunk.stdin.flush()
+        write_input(self.interchunk.stdin, transfer_output + b'\0')
+
+        output = clean_output(read_null_flushed(self.autogen.stdout, timeout, self.processes))
+        if type(string) == type(''):
+            return output.decode('utf-8')
+        return output
+
+    def close(self):
+        close_processes(self.processes)
+
+class supervisedTranslator():
+    """
+    Supervisor of translator pipelines made by make_translator
+    (e.g., partialTranslator or weightedPartialTranslator).
+    Each request has to be done in timeout seconds. If pipeline
+    dies or stalls, it is replaced with a warm spare one (already
+    started and loaded), and the request is retried once.
+    Inputs which fail the pipeline again are written to reject file,
+    and RejectedInput is raised for them.
+    """
+    def __init__(self, make_translator, timeout=default_timeout,
+                 reject_fname=None, spare=True):
+        self.make_translator = make_translator
+        self.timeout = timeout
+        self.reject_fname = reject_fname
+        self.translator = make_translator()
+        self.spare = make_translator() if spare else None
+        self.counters = {'requests': 0, 'failures': 0, 'restarts': 0,
+                         'recovered': 0, 'rejected': 0}
+
+    def restart(self):
+        """
+        Replace current pipeline with the spare one
+        (or with a new one if spare is not alive),
+        and start a new spare.
+        """
+        self.translator.close()
+        self.counters['restarts'] += 1
+        if self.spare is None:
+            self.translator = self.make_translator()
+            return
+        try:
+            check_alive(self.spare.processes)
+            self.translator = self.spare
+        except PipelineError:
+            self.spare.close()
+            self.translator = self.make_translator()
+        self.spare = self.make_translator()
+
+    def request(self, method, *args):
+        """
+        Call method of current pipeline with args and timeout,
+        restarting pipeline and retrying once on failure.
+        """
+        self.counters['requests'] += 1
+        for attempt in range(2):
+            try:
+                result = getattr(self.translator, method)(*args, timeout=self.timeout)
+                if attempt > 0:
+                    self.counters['recovered'] += 1
+                return result
+            except PipelineError as error:
+                self.counters['failures'] += 1
+                last_error = error
+                self.restart()
+        raise RejectedInput(str(last_error))
+
+    def reject(self, string, error):
+        """
+        Quarantine string which fails the pipeline into reject file.
+        """
+        self.counters['rejected'] += 1
+        if self.reject_fname is not None:
+            if type(string) != type(''):
+                string = bytes(string).decode('utf-8', 'replace')
+            with open(self.reject_fname, 'a', encoding='utf-8') as rfile:
+                print(error, string.replace('\n', ' '), sep='\t', file=rfile)
+
+    def translate(self, string, *args):
+        """
+        Translate string like supervised pipeline does.
+        """
+        try:
+            return self.request('translate', string, *args)
+        except RejectedInput as error:
+            self.reject(string, error)
+            raise
+
+    def translate_batch(self, strings):
+        """
+        Translate strings in one round-trip. If the batch fails,
+        strings are translated one by one to find the ones
+        which fail the pipeline, and None is returned for them.
+        """
+        try:
+            return self.request('translate_batch', strings)
+        except RejectedInput:
+            translations = []
+            for string in strings:
+                try:
+                    translations.append(self.translate(string))
+                except RejectedInput:
+                    translations.append(None)
+            return translations
 
-        char = self.autogen.stdout.read(1)
-        autogen_output = []
-        while char and char != b'\0':
-            autogen_output.append(char)
-            char = self.autogen.stdout.read(1)
+    def report(self):
+        return ', '.join('{} {}'.format(value, name) for name, value in self.counters.items())
 
-        return apertium_re.sub('', (b''.join(autogen_output)).decode('utf-8').replace('[][\n]',''))
+    def close(self):
+        self.translator.close()
+        if self.spare is not None:
+            self.spare.close()
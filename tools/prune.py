@@ -1,6 +1,12 @@
 #! /usr/bin/python3
 
 import sys, os
+from optparse import OptionParser
+
+try: # imported as part of tools package
+    from tools import w1x
+except ImportError: # run from inside tools folder
+    import w1x
 
 try: # see if lxml is installed
     from lxml import etree
@@ -15,9 +21,11 @@ except ImportError: # it is not
               "as it works dramatically faster than xml.etree.")
         using_lxml = False
 
-usage_line = 'Usage: python3 prune.py INPUT_FILE [OUTPUT_FILE]'
+usage_line = 'Usage: python3 prune.py [options] INPUT_FILE [OUTPUT_FILE]'
 
-def prune_xml_transfer_weights(using_lxml, ifname, ofname=None):
+def prune_xml_transfer_weights(using_lxml, ifname, ofname=None,
+                               min_count=1, min_margin=0., top_patterns=0,
+                               collapse_generalized=False):
     """
     Prune the transfer weights file provided in ifname.
 
@@ -31,94 +39,67 @@ def prune_xml_transfer_weights(using_lxml, ifname, ofname=None):
           the rule applied anyway (in fact, we only want
           to weight exceptions from the default rule).
 
+    The remaining patterns can be further reduced:
+      - patterns observed less than min_count times
+        (as given by count attribute, 1 if it is missing) are removed;
+      - patterns where the heaviest weight exceeds the weight
+        of the default rule by less than min_margin (as a share
+        of the total weight of the pattern) are removed;
+      - if top_patterns is not 0, only that many most observed
+        patterns are kept in each rule group;
+      - if collapse_generalized is True, lexicalized patterns
+        are removed if all more generalized patterns left
+        in the rule group pick the same rule (and there is one),
+        and none of the generalized patterns picks the default rule.
+    Each reduction is reported as the number of patterns
+    left and the share of observations still covered.
+
     Write the result to ofname.
     """
+    if ofname is None:
+        ofname = ifname.rsplit('.', maxsplit=1)[0] + '-prunned.w1x'
+
+    # go through rule groups one by one
+    pruner = w1x.Pruner(min_count, min_margin, top_patterns, collapse_generalized)
     try:
-        iroot = etree.parse(ifname).getroot()
+        w1x.transform(ifname, ofname, [pruner], using_lxml)
     except etree.ParseError:
         print('Error parsing weights file \'{}\'. '
               'Is there something wrong with it?'.format(opts.rfname))
         return None
 
-    if ofname is None:
-        ofname = ifname.rsplit('.', maxsplit=1)[0] + '-prunned.w1x'
-
-    # create (empty) output xml tree
-    oroot = etree.Element('transfer-weights')
-    # go through rule-groups
-    for et_rule_group in iroot.findall('rule-group'):
-        # store rule ids in order of their appearance in rule_list
-        # store xml rules in xml_rule_dict with ids as keys
-        rule_list, xml_rule_dict = [], {}
-        # store lists of weights by rule in pattern_rule_dict
-        # with pattern strings as keys
-        # store xml patterns in xml_pattern_dict with pattern strings as keys
-        pattern_rule_dict, xml_pattern_dict = {}, {}
-        for et_rule in et_rule_group.findall('rule'):
-            rule_id = et_rule.attrib['id']
-            rule_list.append(rule_id)
-            xml_rule_dict[rule_id] = et_rule.attrib
-            for et_pattern in et_rule.findall('pattern'):
-                pattern_str = xml_pattern_to_str(et_pattern)
-                pattern_rule_dict.setdefault(pattern_str, [])
-                pattern_rule_dict[pattern_str].append((rule_id, float(et_pattern.attrib['weight'])))
-                xml_pattern_dict[pattern_str] = et_pattern
-        # for each pattern, sort its (rule, weight) list by weight
-        for pattern, weights_list in pattern_rule_dict.items():
-            weights_list.sort(key=lambda x: x[1], reverse=True)
-        # the first rule is default and is therefore should contain no patterns
-        et_new_rule_group = etree.SubElement(oroot, 'rule-group')
-        et_new_rule = etree.SubElement(et_new_rule_group, 'rule')
-        et_new_rule.attrib.update(xml_rule_dict[rule_list[0]])
-        # go through other rules
-        for rule_id in rule_list[1:]:
-            et_new_rule = etree.SubElement(et_new_rule_group, 'rule')
-            et_new_rule.attrib.update(xml_rule_dict[rule_id])
-            for pattern_str, weights_list in pattern_rule_dict.items():
-                # if the heaviest weight for the pattern is for this rule...
-                if weights_list[0][0] == rule_id:
-                    # ... add this pattern to the rule...
-                    et_new_pattern = etree.SubElement(et_new_rule, 'pattern')
-                    # ...with weight=1.0...
-                    et_new_pattern.attrib['weight'] = '1.0'
-                    # ...and add all its pattern-elements
-                    for et_pattern_item in xml_pattern_dict[pattern_str].findall('pattern-item'):
-                        et_new_pattern_item = etree.SubElement(et_new_pattern, 'pattern-item')
-                        et_new_pattern_item.attrib.update(et_pattern_item.attrib)
-
-    if using_lxml:
-        etree.ElementTree(oroot).write(ofname, pretty_print=True, encoding='utf-8', xml_declaration=True)
-    else:
-        etree.ElementTree(oroot).write(ofname, encoding='utf-8', xml_declaration=True)
-
+    pruner.report()
     return ofname
 
-def xml_pattern_to_str(et_pattern):
+def get_options():
     """
-    Convert xml pattern item into pattern string.
+    Parse commandline arguments and options
     """
-    pattern_item_list = []
-    for et_pattern_item in et_pattern:
-        pattern_item_str = '^{}'.format(et_pattern_item.attrib.get('lemma', '*'))
-        tags = et_pattern_item.attrib['tags']
-        if tags != '':
-            pattern_item_str += '<{}>$'.format(tags.replace('.', '><'))
-        else:
-            pattern_item_str += '$'
-        pattern_item_list.append(pattern_item_str)
-    return ' '.join(pattern_item_list)
+    op = OptionParser(usage=usage_line)
 
-if __name__ == "__main__":
-    if len(sys.argv) == 1:
-        print(usage_line)
-        sys.exit(1)
+    op.add_option("--min-count", dest="min_count", type="int", default=1,
+                  help="remove patterns observed less than N times", metavar="N")
+    op.add_option("--min-margin", dest="min_margin", type="float", default=0.,
+                  help="remove patterns where the best rule beats the default one "
+                       "by less than MARGIN share of the pattern weight", metavar="MARGIN")
+    op.add_option("--top", dest="top_patterns", type="int", default=0,
+                  help="keep only N most observed patterns in each rule group", metavar="N")
+    op.add_option("--collapse", dest="collapse_generalized", action="store_true", default=False,
+                  help="remove lexicalized patterns when generalized ones pick the same rule")
+
+    (opts, args) = op.parse_args()
 
-    ifname = sys.argv[1]
-    if not os.path.exists(ifname):
+    if len(args) not in (1, 2):
+        op.error("input file and optional output file are required.")
+
+    if not os.path.exists(args[0]):
         print('Input file not found')
         sys.exit(1)
 
-    if len(sys.argv) == 2:
-        prune_xml_transfer_weights(using_lxml, ifname)
-    else:
-        prune_xml_transfer_weights(using_lxml, ifname, sys.argv[2])
+    return opts, args
+
+if __name__ == "__main__":
+    opts, args = get_options()
+    prune_xml_transfer_weights(using_lxml, args[0], args[1] if len(args) == 2 else None,
+                               opts.min_count, opts.min_margin, opts.top_patterns,
+                               opts.collapse_generalized)
@@ -2,6 +2,11 @@
 
 import sys, os
 
+try: # imported as part of tools package
+    from tools import w1x
+except ImportError: # run from inside tools folder
+    import w1x
+
 try: # see if lxml is installed
     from lxml import etree
     if __name__ == "__main__":
@@ -22,30 +27,17 @@ def remove_generalized(using_lxml, ifname, ofname=None):
     Remove generalized patterns (i.e., the ones without lemmas)
     from ifname xml weights file and output new tree to ofname.
     """
+    if ofname is None:
+        ofname = ifname.rsplit('.', maxsplit=1)[0] + '-remgen.w1x'
+
+    # go through rule groups one by one
     try:
-        root = etree.parse(ifname).getroot()
+        w1x.transform(ifname, ofname, [w1x.remove_generalized], using_lxml)
     except etree.ParseError:
         print('Error parsing weights file \'{}\'. '
               'Is there something wrong with it?'.format(opts.rfname))
         return None
 
-    if ofname is None:
-        ofname = ifname.rsplit('.', maxsplit=1)[0] + '-remgen.w1x'
-
-    for et_rule_group in root.findall('rule-group'):
-        for et_rule in et_rule_group.findall('rule'):
-            for et_pattern in et_rule.findall('pattern'):
-                remove = False
-                for et_pattern_item in et_pattern.findall('pattern-item'):
-                    remove = remove or (et_pattern_item.attrib.get('lemma', '') == '')
-                if remove:
-                    et_rule.remove(et_pattern)
-
-    if using_lxml:
-        etree.ElementTree(root).write(ofname, pretty_print=True, encoding='utf-8', xml_declaration=True)
-    else:
-        etree.ElementTree(root).write(ofname, encoding='utf-8', xml_declaration=True)
-
     return ofname
 
 if __name__ == "__main__":
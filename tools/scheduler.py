@@ -0,0 +1,135 @@
+import resource, traceback
+import multiprocessing
+from multiprocessing.connection import wait as wait_sentinels
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import perf_counter as clock
+
+# how often (in seconds) running stages are checked
+poll_interval = 0.1
+
+class Stage:
+    """
+    Stage of a job graph: a call of func with args.
+    Stages found among args are dependencies: the stage
+    is run when they are done, with their results as args.
+    Isolated stages run in forked processes
+    (so they share the results of previous stages
+    copy-on-write) with resource limits applied.
+    """
+    def __init__(self, name, func, args=(), isolated=False):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.deps = [arg for arg in args if isinstance(arg, Stage)]
+        self.isolated = isolated
+
+    def run(self, results):
+        """
+        Call stage function with results of dependencies put in place.
+        """
+        return self.func(*[results[arg.name] if isinstance(arg, Stage) else arg
+                                for arg in self.args])
+
+def limit_resources(memory=None, cpu=None):
+    """
+    Limit address space (in megabytes) and cpu time (in seconds)
+    of current process and of all processes started by it.
+    """
+    if memory is not None:
+        memory_bytes = memory * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+    if cpu is not None:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu))
+
+def run_isolated(stage, results, memory, cpu):
+    """
+    Run stage in a forked process with resource limits.
+    """
+    limit_resources(memory, cpu)
+    stage.run(results)
+
+def run_graph(stages, workers=1, memory=None, cpu=None):
+    """
+    Run stages respecting their dependencies
+    with at most workers stages running at once.
+    Shared stages run in threads, isolated stages
+    run in forked processes limited to memory megabytes
+    of address space and cpu seconds of processor time.
+    Return dict of shared stage results and set of failed stage names.
+    """
+    context = multiprocessing.get_context('fork')
+    results, failed, timings = {}, set(), {}
+    pending = list(stages)
+    running_threads, running_processes = {}, {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running_threads or running_processes:
+            # drop stages that depend on failed ones
+            for stage in [stage for stage in pending
+                                    if any(dep.name in failed for dep in stage.deps)]:
+                print('Skipping {} as its dependencies failed.'.format(stage.name))
+                failed.add(stage.name)
+                pending.remove(stage)
+
+            # start stages which are ready while there are free workers
+            for stage in [stage for stage in pending
+                                    if all(dep.name in results for dep in stage.deps)]:
+                if len(running_threads) + len(running_processes) >= workers:
+                    break
+                if stage.isolated:
+                    # fork only when no other stage runs in a thread
+                    if running_threads:
+                        continue
+                    process = context.Process(target=run_isolated,
+                                              args=(stage, results, memory, cpu))
+                    process.start()
+                    running_processes[process] = stage
+                else:
+                    running_threads[executor.submit(stage.run, results)] = stage
+                timings[stage.name] = clock()
+                pending.remove(stage)
+
+            if not running_threads and not running_processes:
+                # nothing can be started: should never happen with acyclic graph
+                print('Stages {} can not be run.'.format(', '.join(stage.name for stage in pending)))
+                failed.update(stage.name for stage in pending)
+                break
+
+            # wait for some stage to finish
+            if running_threads:
+                done, not_done = wait(running_threads, timeout=poll_interval,
+                                      return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running_threads.pop(future)
+                    timings[stage.name] = clock() - timings[stage.name]
+                    if future.exception() is None:
+                        results[stage.name] = future.result()
+                    else:
+                        print('Stage {} failed:'.format(stage.name))
+                        traceback.print_exception(type(future.exception()), future.exception(),
+                                                  future.exception().__traceback__)
+                        failed.add(stage.name)
+            if running_processes:
+                wait_sentinels([process.sentinel for process in running_processes],
+                               timeout=0 if running_threads else poll_interval)
+                for process in [process for process in running_processes
+                                            if process.exitcode is not None]:
+                    stage = running_processes.pop(process)
+                    process.join()
+                    timings[stage.name] = clock() - timings[stage.name]
+                    if process.exitcode == 0:
+                        results[stage.name] = None
+                    else:
+                        print('Stage {} failed with exit code {}.'.format(stage.name, process.exitcode))
+                        failed.add(stage.name)
+
+    # print out summary
+    print('\nStage summary:')
+    for stage in stages:
+        if stage.name in failed:
+            status = 'failed' if stage.name in timings else 'skipped'
+        else:
+            status = 'done in {:.2f}'.format(timings[stage.name])
+        print('{}: {}'.format(stage.name, status))
+
+    return results, failed
@@ -2,15 +2,18 @@
 
 import sys, re
 
-# regexes used to normalize lines
+# regexes and tables used to normalize lines
 # for scoring them against language model
 # or for sending them to language model training
-beforepunc_re = re.compile(r'([¿("/])(\w)')
-afterpunc_re = re.compile(r'(\w)([;:,.!?)"/—])')
-quot_re = re.compile("[«»`'“”„‘’‛]|&quot;")
+quot_table = str.maketrans(dict.fromkeys("«»`'“”„‘’‛", '"'))
 numfix_re = re.compile('([0-9]) ([,.:][0-9])')
-beforedash_re = re.compile(r'(\W)-(\w)')
-afterdash_re = re.compile(r'(\w)-(\W)')
+
+# only the places to insert spaces are matched (no groups to expand),
+# and hyphens and punctuation are looked for before the context around them
+afterdash_re = re.compile(r'-(?<=\w-)(?=\W)')
+beforedash_re = re.compile(r'-(?<=\W-)(?=\w)')
+afterpunc_re = re.compile(r'(?=[;:,.!?)"/—])(?<=\w)')
+beforepunc_re = re.compile(r'(?<=[¿("/])(?=\w)')
 
 def normalize(line):
     """
@@ -19,14 +22,25 @@ def normalize(line):
     or for sending it to language model training.
     """
     line = line.lower().replace('--', '—').replace(' - ', ' — ')
-    line = quot_re.sub('"', line)
-    line = beforedash_re.sub(r'\1— \2', afterdash_re.sub(r'\1 —\2', line))
-    line = beforepunc_re.sub(r'\1 \2', afterpunc_re.sub(r'\1 \2', line))
-    line = numfix_re.sub(r'\1\2', line)
-    return line.lower()
+    line = line.translate(quot_table).replace('&quot;', '"')
+    if '-' in line:
+        line = beforedash_re.sub('— ', afterdash_re.sub(' —', line))
+    line = beforepunc_re.sub(' ', afterpunc_re.sub(' ', line))
+    return numfix_re.sub(r'\1\2', line)
+
+def normalize_many(lines):
+    """
+    Normalize a list of lines.
+    Lines are not joined to be normalized at once: a single
+    non-latin char makes the whole joined str wide,
+    which makes regexes slower than on separate lines.
+    """
+    return [normalize(line) for line in lines]
 
 if __name__ == "__main__":
-    with open(sys.argv[1], 'r', encoding='utf-8') as ifile,\
-         open(sys.argv[2], 'w', encoding='utf-8') as ofile:
-        for line in ifile:
-            ofile.write(normalize(line))
+    # normalize file on all processors
+    try: # imported as part of tools package
+        from tools import lmcorpus
+    except ImportError: # run from inside tools folder
+        import lmcorpus
+    lmcorpus.prepare_corpus([sys.argv[1]], sys.argv[2])
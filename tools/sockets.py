@@ -0,0 +1,85 @@
+import struct
+
+# frame: payload length (little-endian uint32), then payload
+frame_header = struct.Struct('<I')
+
+# maximum payload length accepted from the other side
+max_frame_size = 256 * 1024 * 1024
+
+# list of strings in payload: number of strings, then length
+# and bytes of each string (missing strings have no_string length)
+length_struct = struct.Struct('<I')
+no_string = 0xffffffff
+
+def recv_exactly(sock, size):
+    """
+    Receive exactly size bytes from sock.
+    Return None if connection is closed before the first byte.
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        received_now = sock.recv_into(view[received:])
+        if received_now == 0:
+            if received == 0:
+                return None
+            raise ConnectionError('Connection closed in the middle of a frame')
+        received += received_now
+    return bytes(buf)
+
+def send_frame(sock, payload):
+    """
+    Send payload bytes as one frame.
+    """
+    sock.sendall(frame_header.pack(len(payload)) + payload)
+
+def recv_frame(sock):
+    """
+    Receive one frame and return its payload,
+    or None if connection is closed between frames.
+    """
+    header = recv_exactly(sock, frame_header.size)
+    if header is None:
+        return None
+    size, = frame_header.unpack(header)
+    if size > max_frame_size:
+        raise ConnectionError('Frame of {} bytes is too big'.format(size))
+    if size == 0:
+        return b''
+    payload = recv_exactly(sock, size)
+    if payload is None:
+        raise ConnectionError('Connection closed in the middle of a frame')
+    return payload
+
+def pack_strings(strings):
+    """
+    Pack list of byte strings (or None) into payload.
+    """
+    parts = [length_struct.pack(len(strings))]
+    for string in strings:
+        if string is None:
+            parts.append(length_struct.pack(no_string))
+        else:
+            parts.append(length_struct.pack(len(string)))
+            parts.append(bytes(string))
+    return b''.join(parts)
+
+def unpack_strings(payload, pos=0):
+    """
+    Unpack list of byte strings (or None) from payload from pos on.
+    """
+    count, = length_struct.unpack_from(payload, pos)
+    pos += length_struct.size
+    strings = []
+    for i in range(count):
+        length, = length_struct.unpack_from(payload, pos)
+        pos += length_struct.size
+        if length == no_string:
+            strings.append(None)
+        else:
+            if pos + length > len(payload):
+                raise ValueError('String list is cut short')
+            strings.append(payload[pos:pos + length])
+            pos += length
+    return strings
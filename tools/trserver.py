@@ -0,0 +1,426 @@
+#! /usr/bin/python3
+
+import sys, os, stat, signal, socket, socketserver, threading, queue
+from optparse import OptionParser
+from time import perf_counter as clock
+
+try: # imported as part of tools package
+    from tools.pipelines import partialTranslator, weightedPartialTranslator, \
+                                supervisedTranslator, RejectedInput, \
+                                default_timeout, pair_paths, to_bytes
+    from tools.sockets import send_frame, recv_frame, pack_strings, unpack_strings
+except ImportError: # run from inside tools folder
+    from pipelines import partialTranslator, weightedPartialTranslator, \
+                          supervisedTranslator, RejectedInput, \
+                          default_timeout, pair_paths, to_bytes
+    from sockets import send_frame, recv_frame, pack_strings, unpack_strings
+
+usage_line = 'Usage: python3 trserver.py [options] PAIR_DATA SOURCE TARGET SOCKET_FILE'
+
+# requests (one frame each), strings are packed with pack_strings:
+#   identity: command, answered with base paths of the pair files
+#             and generation of pipelines (number of reloads)
+#   translate batch: command, generation, strings, answered with their
+#                    default translations (missing for rejected strings)
+#   translate: command, generation, string, answered with its default translation
+#   weighted translate: command, generation, string and path of weights file,
+#                       answered with its weighted translation
+# translation requests fail with stale status, if pipelines of the generation
+# the client got at identity request have been reloaded since
+# answers start with status: rejected answers and error answers carry the message
+identity_command, batch_command, translate_command, weighted_command = b'I', b'B', b'T', b'W'
+ok_status, rejected_status, error_status, stale_status = b'+', b'!', b'-', b'~'
+
+# compiled pair files which make pipelines reload when they change
+pair_bin_suffixes = ('.autobil.bin', '.t1x.bin', '.t2x.bin', '.autogen.bin')
+
+# default number of pipelines of each kind
+default_workers = 2
+
+# default number of seconds between checks of pair files
+default_check_interval = 5.
+
+class StaleGeneration(RuntimeError):
+    """
+    Pipelines were reloaded with changed pair files
+    since the client got identity of the server.
+    """
+
+def pair_mtimes(binfname):
+    """
+    Get modification times of compiled pair files
+    (None for missing files).
+    """
+    mtimes = []
+    for suffix in pair_bin_suffixes:
+        try:
+            mtimes.append(os.stat(binfname + suffix).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+class TranslatorPool:
+    """
+    Warm supervised pipelines made by make_translator, each used
+    by one request at a time. When pool is reloaded, idle pipelines
+    are replaced at once and busy ones are closed when they are returned.
+    """
+    def __init__(self, make_translator, size, timeout):
+        self.make_translator = make_translator
+        self.size, self.timeout = size, timeout
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.idle = queue.Queue()
+        # counters of closed pipelines
+        self.closed_counters = {}
+        for i in range(size):
+            self.idle.put((self.generation, self.start()))
+
+    def start(self):
+        return supervisedTranslator(self.make_translator, self.timeout, spare=False)
+
+    def close_translator(self, translator):
+        for name, value in translator.counters.items():
+            self.closed_counters[name] = self.closed_counters.get(name, 0) + value
+        translator.close()
+
+    def get(self):
+        return self.idle.get()
+
+    def put(self, item):
+        generation, translator = item
+        with self.lock:
+            if generation == self.generation:
+                self.idle.put(item)
+                return
+            self.close_translator(translator)
+
+    def reload(self, generation):
+        """
+        Start new pipelines of generation
+        and replace the old ones with them.
+        """
+        new_translators = [self.start() for i in range(self.size)]
+        with self.lock:
+            self.generation = generation
+            while True:
+                try:
+                    generation, translator = self.idle.get_nowait()
+                except queue.Empty:
+                    break
+                self.close_translator(translator)
+            for translator in new_translators:
+                self.idle.put((self.generation, translator))
+
+    def report(self):
+        with self.lock:
+            counters = dict(self.closed_counters)
+            translators = list(self.idle.queue)
+        for generation, translator in translators:
+            for name, value in translator.counters.items():
+                counters[name] = counters.get(name, 0) + value
+        return ', '.join('{} {}'.format(value, name) for name, value in counters.items())
+
+    def close(self):
+        with self.lock:
+            self.generation += 1
+            while not self.idle.empty():
+                generation, translator = self.idle.get_nowait()
+                self.close_translator(translator)
+
+class TranslationHandler(socketserver.BaseRequestHandler):
+    """
+    Answer requests of one client until it disconnects.
+    """
+    def handle(self):
+        server = self.server
+        while True:
+            request = recv_frame(self.request)
+            if request is None:
+                break
+            try:
+                answer = ok_status + server.answer(request)
+            except RejectedInput as e:
+                answer = rejected_status + str(e).encode('utf-8')
+            except StaleGeneration as e:
+                answer = stale_status + str(e).encode('utf-8')
+            except Exception as e:
+                answer = error_status + str(e).encode('utf-8')
+            send_frame(self.request, answer)
+
+class TranslationServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Translator server keeping warm pools of translator pipelines
+    for default and for weighted translation, one thread per client.
+    Pipelines are reloaded when compiled pair files change,
+    each reload makes new generation of them.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_fname, tixfname, binfname,
+                 workers=default_workers, timeout=default_timeout):
+        self.tixfname, self.binfname = tixfname, binfname
+        self.identity = '{}\t{}'.format(os.path.abspath(tixfname),
+                                        os.path.abspath(binfname)).encode('utf-8')
+        self.mtimes = pair_mtimes(binfname)
+        self.pools = {
+            'default': TranslatorPool(lambda: partialTranslator(tixfname, binfname),
+                                      workers, timeout),
+            'weighted': TranslatorPool(lambda: weightedPartialTranslator(tixfname, binfname),
+                                       workers, timeout),
+        }
+        self.reloads = 0
+        super().__init__(socket_fname, TranslationHandler)
+
+    def call(self, kind, generation, method, *args):
+        """
+        Call method of supervised pipeline from pool of kind,
+        if the pipeline is of generation the client expects.
+        """
+        pool = self.pools[kind]
+        item = pool.get()
+        try:
+            if item[0] != generation:
+                raise StaleGeneration('pipelines were reloaded with changed pair files '
+                                      '(generation {}, client expects {})'.format(item[0], generation))
+            return getattr(item[1], method)(*args)
+        finally:
+            pool.put(item)
+
+    def answer(self, request):
+        command = request[:1]
+        if command == identity_command:
+            return pack_strings([self.identity, str(self.reloads).encode('utf-8')])
+        strings = unpack_strings(request, 1)
+        generation, strings = int(strings[0]), strings[1:]
+        if command == batch_command:
+            return pack_strings(self.call('default', generation, 'translate_batch', strings))
+        if command == translate_command:
+            return self.call('default', generation, 'translate', strings[0])
+        if command == weighted_command:
+            return self.call('weighted', generation, 'translate', strings[0], strings[1].decode('utf-8'))
+        raise ValueError('Unknown command {!r}'.format(command))
+
+    def reload_if_changed(self):
+        """
+        Reload pipelines if compiled pair files have changed
+        (and are all in place) since the last check.
+        """
+        mtimes = pair_mtimes(self.binfname)
+        if mtimes == self.mtimes or None in mtimes:
+            return
+        print('Pair files changed, reloading pipelines.')
+        btime = clock()
+        for pool in self.pools.values():
+            pool.reload(self.reloads + 1)
+        self.mtimes = mtimes
+        self.reloads += 1
+        print('Done in {:.2f}'.format(clock() - btime))
+        sys.stdout.flush()
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+
+class RemoteTranslator:
+    """
+    Client of translator server with the interface
+    of supervisedTranslator: kind is either default
+    or weighted. Inputs rejected by the server
+    are written to local reject file.
+    Translations are requested from the generation
+    of pipelines the server had at connection: when pair
+    files change and the server reloads its pipelines,
+    requests fail with StaleGeneration instead of
+    getting translations made with other pair files.
+    """
+    def __init__(self, socket_fname, kind, reject_fname=None):
+        self.socket_fname, self.kind = socket_fname, kind
+        self.reject_fname = reject_fname
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_fname)
+        self.counters = {'requests': 0, 'rejected': 0}
+        self.pair_identity, self.generation = unpack_strings(self.request(identity_command))
+
+    def request(self, command, strings=None):
+        self.counters['requests'] += 1
+        if strings is None:
+            send_frame(self.sock, command)
+        else:
+            send_frame(self.sock, command + pack_strings([self.generation] + strings))
+        answer = recv_frame(self.sock)
+        if answer is None:
+            raise ConnectionError('Translator server {} closed connection'.format(self.socket_fname))
+        if answer[:1] == rejected_status:
+            raise RejectedInput(answer[1:].decode('utf-8', 'replace'))
+        if answer[:1] == stale_status:
+            raise StaleGeneration('Translator server {}: {}'.format(
+                                      self.socket_fname, answer[1:].decode('utf-8', 'replace')))
+        if answer[:1] != ok_status:
+            raise RuntimeError('Translator server {} failed: {}'.format(
+                                   self.socket_fname, answer[1:].decode('utf-8', 'replace')))
+        return answer[1:]
+
+    def identity(self):
+        """
+        Return base paths of pair files the server translates with.
+        """
+        return self.pair_identity
+
+    def reject(self, string, error):
+        self.counters['rejected'] += 1
+        if self.reject_fname is not None:
+            if type(string) != type(''):
+                string = bytes(string).decode('utf-8', 'replace')
+            with open(self.reject_fname, 'a', encoding='utf-8') as rfile:
+                print(error, string.replace('\n', ' '), sep='\t', file=rfile)
+
+    def translate(self, string, *args):
+        """
+        Translate string (with weights file from args
+        for weighted translation) like supervised pipeline does.
+        """
+        if self.kind == 'weighted':
+            command = weighted_command
+            args = [os.path.abspath(args[0]).encode('utf-8')]
+        else:
+            command = translate_command
+        try:
+            translation = self.request(command, [to_bytes(string)] + list(args))
+        except RejectedInput as error:
+            self.reject(string, error)
+            raise
+        if type(string) == type(''):
+            return translation.decode('utf-8')
+        return translation
+
+    def translate_batch(self, strings):
+        """
+        Translate strings in one round-trip,
+        None is returned for the rejected ones.
+        """
+        translations = unpack_strings(self.request(batch_command,
+                                                   [to_bytes(string) for string in strings]))
+        for string, translation in zip(strings, translations):
+            if translation is None:
+                self.reject(string, 'rejected by translator server')
+        if strings != [] and type(strings[0]) == type(''):
+            return [None if translation is None else translation.decode('utf-8')
+                        for translation in translations]
+        return translations
+
+    def report(self):
+        return '{} (translator server {})'.format(
+                   ', '.join('{} {}'.format(value, name) for name, value in self.counters.items()),
+                   self.socket_fname)
+
+    def close(self):
+        self.sock.close()
+
+def connect(socket_fname, tixfname, binfname, reject_fname=None, default=True):
+    """
+    Connect to translator server, check that it translates
+    with the same pair files, and return translators
+    like start_translators in the learner does.
+    """
+    kinds = ['default', 'weighted'] if default else ['weighted']
+    translators = [RemoteTranslator(socket_fname, kind, reject_fname) for kind in kinds]
+    identity = '{}\t{}'.format(os.path.abspath(tixfname), os.path.abspath(binfname)).encode('utf-8')
+    if translators[0].identity() != identity:
+        for translator in translators:
+            translator.close()
+        raise ValueError('Translator server {} does not translate with {}'.format(socket_fname,
+                                                                                  binfname))
+    if len(set(translator.generation for translator in translators)) > 1:
+        for translator in translators:
+            translator.close()
+        raise StaleGeneration('Translator server {} reloaded pipelines while connecting'.format(
+                                  socket_fname))
+    return translators
+
+def serve(pair_data, source, target, socket_fname, workers=default_workers,
+          timeout=default_timeout, check_interval=default_check_interval):
+    """
+    Start pipelines and answer translation requests
+    on socket_fname until interrupted.
+    """
+    tixfname, binfname = pair_paths(pair_data, source, target)
+
+    # remove socket left by server that was not shut down
+    if os.path.exists(socket_fname) and stat.S_ISSOCK(os.stat(socket_fname).st_mode):
+        os.remove(socket_fname)
+
+    print('Starting translator pipelines.')
+    btime = clock()
+    server = TranslationServer(socket_fname, tixfname, binfname, workers, timeout)
+    print('Done in {:.2f}'.format(clock() - btime))
+    stop = threading.Event()
+
+    def check_periodically():
+        while not stop.wait(check_interval):
+            try:
+                server.reload_if_changed()
+            except Exception as e:
+                # pair is probably being recompiled, try again at next check
+                print('Reloading pipelines failed: {}'.format(e))
+                sys.stdout.flush()
+
+    if check_interval > 0:
+        threading.Thread(target=check_periodically, daemon=True).start()
+
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+
+    # shut down the same way on kill as on ctrl+c
+    signal.signal(signal.SIGTERM, interrupt)
+
+    print('Serving {}-{} translation on {}.'.format(source, target, socket_fname))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        os.remove(socket_fname)
+
+    print('Pipelines reloaded {} times'.format(server.reloads))
+    print('Translator pipelines: {}'.format(server.pools['default'].report()))
+    print('Weighted translator pipelines: {}'.format(server.pools['weighted'].report()))
+    server.close()
+
+def get_options():
+    """
+    Parse commandline arguments and options
+    """
+    op = OptionParser(usage=usage_line)
+    op.add_option("-w", "--workers", dest="workers", type="int",
+                  default=default_workers,
+                  help="keep N pipelines of each kind (default {})".format(default_workers),
+                  metavar="N")
+    op.add_option("-t", "--timeout", dest="timeout", type="float",
+                  default=default_timeout,
+                  help="time limit for one request to pipeline in seconds "
+                       "(default {:g})".format(default_timeout),
+                  metavar="SECONDS")
+    op.add_option("-i", "--check-interval", dest="check_interval", type="float",
+                  default=default_check_interval,
+                  help="check compiled pair files for changes every N seconds, "
+                       "0 never reloads pipelines (default {:g})".format(default_check_interval),
+                  metavar="N")
+
+    (opts, args) = op.parse_args()
+    if len(args) != 4:
+        op.error("wrong number of arguments.")
+    if opts.workers < 1:
+        op.error("number of workers must be positive.")
+    if not os.path.isdir(args[0]):
+        op.error('pair data folder "{}" not found.'.format(args[0]))
+
+    return opts, args
+
+if __name__ == "__main__":
+    opts, args = get_options()
+    serve(*args, workers=opts.workers, timeout=opts.timeout,
+          check_interval=opts.check_interval)
@@ -0,0 +1,560 @@
+#! /usr/bin/python3
+
+import sys, os
+from itertools import product
+from optparse import OptionParser
+
+try: # see if lxml is installed
+    from lxml import etree
+    using_lxml = True
+except ImportError: # it is not
+    import xml.etree.ElementTree as etree
+    using_lxml = False
+
+# streaming operations on transfer weights files:
+# rule groups are read one by one with iterparse, passed through
+# operations and written out, so only one rule group
+# (one per input file when merging or diffing files which list
+# the groups in the same order) is kept in memory
+
+usage_line = """USAGE: python3 %prog [options] filter INPUT_FILE OUTPUT_FILE
+       python3 %prog [options] merge OUTPUT_FILE INPUT_FILE [INPUT_FILE ...]
+       python3 %prog [options] diff OLD_FILE NEW_FILE"""
+
+commands = ('filter', 'merge', 'diff')
+
+def iter_rule_groups(fname):
+    """
+    Go through rule-group elements of weights file fname,
+    dropping each of them from the tree when the next one is read.
+    """
+    root = None
+    for event, element in etree.iterparse(fname, events=('start', 'end')):
+        if root is None:
+            root = element
+        elif event == 'end' and element.tag == 'rule-group':
+            yield element
+            root.clear()
+
+class W1xWriter:
+    """
+    Writer of weights file rule group by rule group.
+    The file is written under temporary name and
+    is renamed to ofname only when it is complete.
+    """
+    def __init__(self, ofname, pretty_print=using_lxml):
+        self.ofname = ofname
+        self.tmp_fname = '{}.{}.tmp'.format(ofname, os.getpid())
+        self.pretty_print = pretty_print
+
+    def __enter__(self):
+        self.ofile = open(self.tmp_fname, 'wb')
+        self.ofile.write(b"<?xml version='1.0' encoding='UTF-8'?>\n<transfer-weights>\n")
+        return self
+
+    def write(self, et_rule_group):
+        et_rule_group.tail = '\n'
+        if self.pretty_print:
+            self.ofile.write(etree.tostring(et_rule_group, encoding='unicode',
+                                            pretty_print=True).encode('utf-8'))
+        else:
+            self.ofile.write(etree.tostring(et_rule_group, encoding='unicode').encode('utf-8'))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.ofile.write(b'</transfer-weights>\n')
+        self.ofile.close()
+        if exc_type is None:
+            os.replace(self.tmp_fname, self.ofname)
+        else:
+            os.remove(self.tmp_fname)
+
+def rule_key(et_rule):
+    """
+    Identify rule by its id and md5 sum of its text.
+    """
+    return et_rule.attrib.get('id', ''), et_rule.attrib.get('md5', '')
+
+def group_key(et_rule_group):
+    """
+    Identify rule group by the ids of its rules, which stay
+    the same when rules of the group are edited, added or removed.
+    """
+    return frozenset(et_rule.attrib.get('id', '') for et_rule in et_rule_group.findall('rule'))
+
+def xml_pattern_items(et_pattern):
+    """
+    Convert xml pattern into a list of (lemma, tags)
+    pieces of pattern string, lemma is '*' if it is missing.
+    """
+    pattern_items = []
+    for et_pattern_item in et_pattern:
+        tags = et_pattern_item.attrib['tags']
+        if tags != '':
+            tags = '<{}>$'.format(tags.replace('.', '><'))
+        else:
+            tags = '$'
+        pattern_items.append((et_pattern_item.attrib.get('lemma', '*'), tags))
+    return pattern_items
+
+def xml_pattern_to_str(et_pattern):
+    """
+    Convert xml pattern item into pattern string.
+    """
+    return ' '.join('^' + lemma + tags for lemma, tags in xml_pattern_items(et_pattern))
+
+def generalized_patterns(et_pattern):
+    """
+    Make strings of all patterns more generalized than xml pattern,
+    i.e., the ones with some of its lemmas removed.
+    """
+    pattern_items = xml_pattern_items(et_pattern)
+    for mask in product([1, 0], repeat=len(pattern_items)):
+        if all(mask_pos == 1 or lemma == '*' for mask_pos, (lemma, tags) in zip(mask, pattern_items)):
+            # no lemmas removed
+            continue
+        yield ' '.join('^' + (lemma if mask_pos == 1 else '*') + tags
+                           for mask_pos, (lemma, tags) in zip(mask, pattern_items))
+
+def copy_pattern(et_rule, et_pattern, weight, count=1):
+    """
+    Add a copy of xml pattern to xml rule
+    with new weight and observation count.
+    """
+    et_new_pattern = etree.SubElement(et_rule, 'pattern')
+    et_new_pattern.attrib['weight'] = str(weight)
+    if count != 1:
+        et_new_pattern.attrib['count'] = str(count)
+    for et_pattern_item in et_pattern.findall('pattern-item'):
+        et_new_pattern_item = etree.SubElement(et_new_pattern, 'pattern-item')
+        et_new_pattern_item.attrib.update(et_pattern_item.attrib)
+    return et_new_pattern
+
+def remove_generalized(et_rule_group):
+    """
+    Remove generalized patterns (i.e., the ones without lemmas)
+    from xml rule group.
+    """
+    for et_rule in et_rule_group.findall('rule'):
+        for et_pattern in et_rule.findall('pattern'):
+            if any(et_pattern_item.attrib.get('lemma', '') == ''
+                       for et_pattern_item in et_pattern.findall('pattern-item')):
+                et_rule.remove(et_pattern)
+    return et_rule_group
+
+class Pruner:
+    """
+    Pruner of xml rule groups (see prune.py for the details),
+    which also reduces the remaining patterns if asked to,
+    and sums up the size/coverage statistics of each reduction.
+    """
+    def __init__(self, min_count=1, min_margin=0., top_patterns=0,
+                 collapse_generalized=False):
+        self.min_count, self.min_margin = min_count, min_margin
+        self.top_patterns, self.collapse_generalized = top_patterns, collapse_generalized
+
+        self.reductions = []
+        if min_count > 1:
+            self.reductions.append('min count {}'.format(min_count))
+        if min_margin > 0.:
+            self.reductions.append('min margin {}'.format(min_margin))
+        if top_patterns > 0:
+            self.reductions.append('top {} patterns'.format(top_patterns))
+        if collapse_generalized:
+            self.reductions.append('collapse generalized')
+
+        # patterns and observations left before and after each reduction
+        self.patterns = [0] * (len(self.reductions) + 1)
+        self.observations = [0] * (len(self.reductions) + 1)
+
+    def add_statistics(self, step, chosen_rules, collapsed_observations=0):
+        self.patterns[step] += len(chosen_rules)
+        self.observations[step] += collapsed_observations + \
+                                   sum(count for rule_id, count, margin in chosen_rules.values())
+
+    def reduce(self, chosen_rules, xml_pattern_dict, default_patterns=()):
+        """
+        Remove patterns from chosen rules dict of rule group
+        (with (rule, count, margin) values and pattern string keys).
+        Default patterns are the patterns of the group
+        whose heaviest rule is the default one.
+        """
+        step, collapsed_observations = 0, 0
+        self.add_statistics(step, chosen_rules)
+
+        if self.min_count > 1:
+            for pattern_str in [pattern_str for pattern_str, (rule_id, count, margin)
+                                                in chosen_rules.items() if count < self.min_count]:
+                del chosen_rules[pattern_str]
+            step += 1
+            self.add_statistics(step, chosen_rules)
+
+        if self.min_margin > 0.:
+            for pattern_str in [pattern_str for pattern_str, (rule_id, count, margin)
+                                                in chosen_rules.items() if margin < self.min_margin]:
+                del chosen_rules[pattern_str]
+            step += 1
+            self.add_statistics(step, chosen_rules)
+
+        if self.top_patterns > 0:
+            # most observed patterns first, then the ones with bigger margin
+            ranked = sorted(chosen_rules.items(), key=lambda x: (x[1][1], x[1][2]), reverse=True)
+            for pattern_str, value in ranked[self.top_patterns:]:
+                del chosen_rules[pattern_str]
+            step += 1
+            self.add_statistics(step, chosen_rules)
+
+        if self.collapse_generalized:
+            collapsed = []
+            for pattern_str, (rule_id, count, margin) in chosen_rules.items():
+                # generalized patterns which pick the default rule compete too,
+                # as without the lexicalized pattern the chunk may go to the default rule
+                rules = set()
+                for general_str in generalized_patterns(xml_pattern_dict[pattern_str]):
+                    if general_str in chosen_rules:
+                        rules.add(chosen_rules[general_str][0])
+                    elif general_str in default_patterns:
+                        rules.add(None)
+                if rules == {rule_id}:
+                    collapsed.append(pattern_str)
+            for pattern_str in collapsed:
+                # observations of collapsed patterns are still covered by generalized ones
+                collapsed_observations += chosen_rules.pop(pattern_str)[1]
+            step += 1
+            self.add_statistics(step, chosen_rules, collapsed_observations)
+
+    def __call__(self, et_rule_group):
+        # store rule ids in order of their appearance in rule_list
+        # store xml rules in xml_rule_dict with ids as keys
+        rule_list, xml_rule_dict = [], {}
+        # store lists of weights by rule in pattern_rule_dict
+        # with pattern strings as keys
+        # store xml patterns in xml_pattern_dict with pattern strings as keys
+        pattern_rule_dict, xml_pattern_dict = {}, {}
+        for et_rule in et_rule_group.findall('rule'):
+            rule_id = et_rule.attrib['id']
+            rule_list.append(rule_id)
+            xml_rule_dict[rule_id] = et_rule.attrib
+            for et_pattern in et_rule.findall('pattern'):
+                pattern_str = xml_pattern_to_str(et_pattern)
+                pattern_rule_dict.setdefault(pattern_str, [])
+                pattern_rule_dict[pattern_str].append((rule_id, float(et_pattern.attrib['weight']),
+                                                       int(et_pattern.attrib.get('count', 1))))
+                xml_pattern_dict[pattern_str] = et_pattern
+
+        # for each pattern, sort its (rule, weight, count) list by weight
+        # and keep the heaviest rule unless it is the default one,
+        # with observation count and margin over the default rule
+        chosen_rules, default_patterns = {}, set()
+        for pattern_str, weights_list in pattern_rule_dict.items():
+            weights_list.sort(key=lambda x: x[1], reverse=True)
+            if weights_list[0][0] == rule_list[0]:
+                default_patterns.add(pattern_str)
+            else:
+                total = sum(weight for rule_id, weight, count in weights_list)
+                default_weight = sum(weight for rule_id, weight, count in weights_list
+                                         if rule_id == rule_list[0])
+                chosen_rules[pattern_str] = (weights_list[0][0],
+                                             max(count for rule_id, weight, count in weights_list),
+                                             (weights_list[0][1] - default_weight) / total
+                                                 if total > 0 else 0.)
+        self.reduce(chosen_rules, xml_pattern_dict, default_patterns)
+
+        # the first rule is default and is therefore should contain no patterns
+        et_new_rule_group = etree.Element('rule-group')
+        et_new_rule = etree.SubElement(et_new_rule_group, 'rule')
+        et_new_rule.attrib.update(xml_rule_dict[rule_list[0]])
+        # go through other rules
+        for rule_id in rule_list[1:]:
+            et_new_rule = etree.SubElement(et_new_rule_group, 'rule')
+            et_new_rule.attrib.update(xml_rule_dict[rule_id])
+            for pattern_str in pattern_rule_dict:
+                # if the heaviest weight for the pattern is for this rule
+                # (and the pattern survived reductions), add it with weight=1.0
+                if pattern_str in chosen_rules and chosen_rules[pattern_str][0] == rule_id:
+                    copy_pattern(et_new_rule, xml_pattern_dict[pattern_str], 1.0)
+        return et_new_rule_group
+
+    def report(self):
+        """
+        Print size/coverage trade-off of each reduction.
+        """
+        if self.reductions == []:
+            return
+        print('Pruned weights: {} patterns, {} observations'.format(self.patterns[0],
+                                                                    self.observations[0]))
+        for step, reduction in enumerate(self.reductions, 1):
+            print('{}: {} patterns left ({:.2%}), {:.2%} of observations covered'.format(
+                      reduction, self.patterns[step], self.patterns[step] / max(self.patterns[0], 1),
+                      self.observations[step] / max(self.observations[0], 1)))
+
+def transform(ifname, ofname, operations, pretty_print=using_lxml):
+    """
+    Pass rule groups of weights file ifname through operations
+    (functions taking and returning xml rule group) in order,
+    and write the result to ofname.
+    """
+    with W1xWriter(ofname, pretty_print) as writer:
+        for et_rule_group in iter_rule_groups(ifname):
+            for operation in operations:
+                et_rule_group = operation(et_rule_group)
+            writer.write(et_rule_group)
+    return ofname
+
+def merged_group_order(fnames):
+    """
+    Make common order of rule groups from weights files fnames,
+    each of which may lack some of the groups. Groups of different
+    files which share any rule id are the same group (which gained
+    or lost rules between the files), so each group in the order
+    is the set of rule ids of the group in all the files.
+    Return the order and the list of group keys of each file.
+    """
+    order, file_keys = [], []
+    for fname in fnames:
+        prev = -1
+        file_keys.append([])
+        for et_rule_group in iter_rule_groups(fname):
+            key = group_key(et_rule_group)
+            if not key:
+                # group without rules is not merged with anything
+                continue
+            file_keys[-1].append(key)
+            matches = [i for i, rule_ids in enumerate(order) if rule_ids & key]
+            if matches != []:
+                # group may join groups of other files which share no rules
+                prev = matches[0]
+                for i in reversed(matches[1:]):
+                    order[prev] |= order.pop(i)
+                order[prev] |= key
+            else:
+                prev += 1
+                order.insert(prev, set(key))
+    return order, file_keys
+
+def iter_aligned_groups(fnames):
+    """
+    Go through weights files fnames together, yielding
+    lists of the same rule group from each of them
+    (None for the files where the group is missing).
+    Files may list the groups in different order, and may split
+    a group of the other files into several ones: all groups
+    of a file under the same merged group are joined into one.
+    Groups which come earlier than in the merged order
+    are kept in memory until their turn.
+    """
+    order, file_keys = merged_group_order(fnames)
+    key_numbers = {rule_id: number for number, rule_ids in enumerate(order)
+                       for rule_id in rule_ids}
+    # number of groups of each file under each merged group
+    counts = []
+    for keys in file_keys:
+        counts.append({})
+        for key in keys:
+            number = key_numbers[next(iter(key))]
+            counts[-1][number] = counts[-1].get(number, 0) + 1
+
+    iterators = [iter_rule_groups(fname) for fname in fnames]
+    pending = [{} for fname in fnames]
+    for number in range(len(order)):
+        groups = []
+        for iterator, file_pending, file_counts in zip(iterators, pending, counts):
+            while len(file_pending.get(number, [])) < file_counts.get(number, 0):
+                et_rule_group = next(iterator)
+                key = group_key(et_rule_group)
+                if key:
+                    file_pending.setdefault(key_numbers[next(iter(key))], []).append(et_rule_group)
+            file_groups = file_pending.pop(number, [])
+            if file_groups == []:
+                groups.append(None)
+            elif len(file_groups) == 1:
+                groups.append(file_groups[0])
+            else:
+                et_rule_group = etree.Element('rule-group')
+                for et_file_group in file_groups:
+                    for et_rule in et_file_group.findall('rule'):
+                        et_rule_group.append(et_rule)
+                groups.append(et_rule_group)
+        yield groups
+
+def merge_rule_groups(groups):
+    """
+    Merge the same xml rule group from several weights files
+    (None where it is missing). Weight of each pattern of each rule
+    is averaged over the files where the pattern is observed
+    in the group and the rule is in the group, and observation
+    counts are summed up. Merged group has all rules of the group in any of the files,
+    in order of their first appearance (a rule edited between
+    the files is kept in each version, told apart by md5).
+    """
+    rule_patterns, xml_pattern_dict, pattern_files = {}, {}, {}
+    et_rules = []
+    for et_rule_group in groups:
+        if et_rule_group is None:
+            continue
+        group_rules, group_patterns = [], set()
+        for et_rule in et_rule_group.findall('rule'):
+            if rule_key(et_rule) not in rule_patterns:
+                et_rules.append(et_rule)
+            group_rules.append(rule_key(et_rule))
+            pattern_weights = rule_patterns.setdefault(rule_key(et_rule), {})
+            for et_pattern in et_rule.findall('pattern'):
+                pattern_str = xml_pattern_to_str(et_pattern)
+                weight_count = pattern_weights.setdefault(pattern_str, [0., 0])
+                weight_count[0] += float(et_pattern.attrib['weight'])
+                weight_count[1] += int(et_pattern.attrib.get('count', 1))
+                xml_pattern_dict.setdefault(pattern_str, et_pattern)
+                group_patterns.add(pattern_str)
+        for key in product(group_rules, group_patterns):
+            pattern_files[key] = pattern_files.get(key, 0) + 1
+
+    et_new_rule_group = etree.Element('rule-group')
+    for et_rule in et_rules:
+        et_new_rule = etree.SubElement(et_new_rule_group, 'rule')
+        et_new_rule.attrib.update(et_rule.attrib)
+        for pattern_str, (weight, count) in rule_patterns[rule_key(et_rule)].items():
+            copy_pattern(et_new_rule, xml_pattern_dict[pattern_str],
+                         weight / pattern_files[(rule_key(et_rule), pattern_str)], count)
+    return et_new_rule_group
+
+def merge(ifnames, ofname, operations=(), pretty_print=using_lxml):
+    """
+    Merge weights files ifnames (unpruned ones, since pruning
+    drops weights of default rules) keyed by rule id and md5,
+    pass merged rule groups through operations, and write them to ofname.
+    """
+    with W1xWriter(ofname, pretty_print) as writer:
+        for groups in iter_aligned_groups(ifnames):
+            et_rule_group = merge_rule_groups(groups)
+            for operation in operations:
+                et_rule_group = operation(et_rule_group)
+            writer.write(et_rule_group)
+    return ofname
+
+def group_weights(et_rule_group):
+    """
+    Make dict with (rule id, pattern string) keys
+    and weights of patterns in xml rule group as values.
+    """
+    weights = {}
+    if et_rule_group is not None:
+        for et_rule in et_rule_group.findall('rule'):
+            for et_pattern in et_rule.findall('pattern'):
+                weights[(et_rule.attrib.get('id', ''), xml_pattern_to_str(et_pattern))] = \
+                    float(et_pattern.attrib['weight'])
+    return weights
+
+def best_rules(weights):
+    """
+    Find the heaviest rule for each pattern in weights dict.
+    """
+    best = {}
+    for (rule_id, pattern_str), weight in weights.items():
+        if pattern_str not in best or weight > best[pattern_str][1]:
+            best[pattern_str] = (rule_id, weight)
+    return {pattern_str: rule_id for pattern_str, (rule_id, weight) in best.items()}
+
+def diff(old_fname, new_fname, tolerance=1e-9, ofile=sys.stdout):
+    """
+    Compare weights files by pattern and print the differences:
+    patterns of rules only in old file (-) or only in new one (+),
+    patterns with weight changed by more than tolerance (~),
+    and patterns with changed heaviest rule (!).
+    Return the number of differences of each kind
+    and the number of patterns in both files (=).
+    """
+    counts = {'-': 0, '+': 0, '~': 0, '!': 0, '=': 0}
+    for old_group, new_group in iter_aligned_groups([old_fname, new_fname]):
+        old_weights, new_weights = group_weights(old_group), group_weights(new_group)
+        for key, weight in old_weights.items():
+            if key not in new_weights:
+                counts['-'] += 1
+                print('-', key[0], key[1], weight, sep='\t', file=ofile)
+            elif abs(new_weights[key] - weight) > tolerance:
+                counts['~'] += 1
+                print('~', key[0], key[1], '{} -> {}'.format(weight, new_weights[key]),
+                      sep='\t', file=ofile)
+        for key, weight in new_weights.items():
+            if key not in old_weights:
+                counts['+'] += 1
+                print('+', key[0], key[1], weight, sep='\t', file=ofile)
+        old_best, new_best = best_rules(old_weights), best_rules(new_weights)
+        for pattern_str, rule_id in old_best.items():
+            if pattern_str in new_best:
+                counts['='] += 1
+            if pattern_str in new_best and new_best[pattern_str] != rule_id:
+                counts['!'] += 1
+                print('!', pattern_str, '{} -> {}'.format(rule_id, new_best[pattern_str]),
+                      sep='\t', file=ofile)
+    return counts
+
+def get_options():
+    """
+    Parse commandline arguments and options
+    """
+    op = OptionParser(usage=usage_line)
+
+    op.add_option("--remgen", dest="remgen", action="store_true", default=False,
+                  help="remove generalized patterns (filter and merge)")
+    op.add_option("--prune", dest="prune", action="store_true", default=False,
+                  help="prune patterns (filter and merge)")
+    op.add_option("--min-count", dest="min_count", type="int", default=1,
+                  help="when pruning, remove patterns observed less than N times", metavar="N")
+    op.add_option("--min-margin", dest="min_margin", type="float", default=0.,
+                  help="when pruning, remove patterns where the best rule beats "
+                       "the default one by less than MARGIN share of the pattern weight",
+                  metavar="MARGIN")
+    op.add_option("--top", dest="top_patterns", type="int", default=0,
+                  help="when pruning, keep only N most observed patterns in each rule group",
+                  metavar="N")
+    op.add_option("--collapse", dest="collapse_generalized", action="store_true", default=False,
+                  help="when pruning, remove lexicalized patterns "
+                       "when generalized ones pick the same rule")
+    op.add_option("--tolerance", dest="tolerance", type="float", default=1e-9,
+                  help="report weights which differ by more than TOLERANCE (diff)",
+                  metavar="TOLERANCE")
+
+    (opts, args) = op.parse_args()
+
+    if args == [] or args[0] not in commands:
+        op.error("command must be one of {}.".format(', '.join(commands)))
+    opts.command, args = args[0], args[1:]
+
+    if opts.command in ('filter', 'diff') and len(args) != 2:
+        op.error("{} takes two files.".format(opts.command))
+    if opts.command == 'merge' and len(args) < 2:
+        op.error("merge takes output file and at least one input file.")
+
+    inputs = args[1:] if opts.command == 'merge' else args[:1] if opts.command == 'filter' else args
+    missing = [fname for fname in inputs if not os.path.exists(fname)]
+    if missing != []:
+        op.error("files not found: {}".format(', '.join(missing)))
+
+    return opts, args
+
+if __name__ == "__main__":
+    opts, args = get_options()
+
+    if opts.command == 'diff':
+        counts = diff(args[0], args[1], opts.tolerance)
+        print('{} removed, {} added, {} changed weights, {} changed heaviest rules '
+              'of {} common patterns'.format(counts['-'], counts['+'], counts['~'],
+                                             counts['!'], counts['=']))
+        sys.exit(1 if any(counts[kind] for kind in '-+~!') else 0)
+
+    operations, pruner = [], None
+    if opts.remgen:
+        operations.append(remove_generalized)
+    if opts.prune or opts.min_count > 1 or opts.min_margin > 0. or \
+       opts.top_patterns > 0 or opts.collapse_generalized:
+        pruner = Pruner(opts.min_count, opts.min_margin, opts.top_patterns,
+                        opts.collapse_generalized)
+        operations.append(pruner)
+
+    if opts.command == 'filter':
+        transform(args[0], args[1], operations)
+    else:
+        merge(args[1:], args[0], operations)
+
+    if pruner is not None:
+        pruner.report()
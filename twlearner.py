@@ -1,27 +1,64 @@
 #! /usr/bin/python3
 
-import re, sys, os, pipes, gc, hashlib
+import re, io, sys, os, pipes, json, shutil, hashlib
 from optparse import OptionParser
 from configparser import ConfigParser
 from time import perf_counter as clock
 from math import exp
 from itertools import product
-# language model handling
-import kenlm
+from concurrent.futures import ThreadPoolExecutor, Future
 # module for coverage calculation
 from tools import coverage
+# memory-mapped corpus reading
+from tools.corpus import map_corpus, iter_tagged_sentences, iter_lines
+# compressed and multi-file corpus reading
+from tools.corpus import corpus_files, is_plain_file, can_decompress, \
+                         open_corpus, iter_aligned_lines, \
+                         default_block_size as corpus_block_size
 # apertium translator pipelines
-from tools.pipelines import partialTranslator, weightedPartialTranslator
+from tools.pipelines import partialTranslator, weightedPartialTranslator, \
+                            supervisedTranslator, RejectedInput, default_timeout, \
+                            pair_paths
+# translator pipelines shared by several learners
+from tools import trserver
 from tools.simpletok import normalize
+# incremental language model scoring of sentence variants
+from tools.lmscore import VariantScorer, ScoreCache, default_cache_size, \
+                          import_kenlm, prefault, model_identity
+# language model shared by several learners
+from tools import lmserver
 from tools.prune import prune_xml_transfer_weights
+# chunk weights statistics files
+from tools import chunkweights
+from tools import ambindex
+# early stopping for patterns with stable winning rule
+from tools.convergence import ConvergenceTracker, default_min_observations
+# deduplication of corpus lines
+from tools import dedup
+# memory use of stages, memory budget and garbage collector tuning
+from tools import memory
+from tools.memory import budget
+# weights file written rule group by rule group
+from tools.w1x import W1xWriter
+# statistics of unchanged rule groups reused between runs
+from tools import incremental
 
 default_confname = 'default.ini'
-tmpweights_fname = 'tmpweights.w1x'
+tmpweights_suffix = '-tmpweights.w1x'
+manifest_suffix = '-shards.json'
+chunk_weights_suffix = '-chunk-weights'
+partial_suffix = '-partial'
+rejected_suffix = '-rejected.txt'
+index_suffix = '-ambiguous-index.bin'
+counts_suffix = '-unique-counts.bin'
+# first field of the line starting a sentence in ambiguous sentences file
+sentence_header = '#'
+shard_commands = ('shard', 'work', 'merge')
+default_batch_size = 100
 mono_mode = 'mono'
 parl_mode = 'parallel'
-
-# regular expression to cut out a sentence 
-sent_re = re.compile('.*?<sent>\$|.+?$')
+text_format = 'text'
+binary_format = 'binary'
 
 # anything between $ and ^
 inter_re = re.compile(r'\$.*?\^')
@@ -29,15 +66,23 @@ inter_re = re.compile(r'\$.*?\^')
 # apertium token (anything between ^ and $)
 apertium_token_re = re.compile(r'\^(.*?)\$')
 
-whitespace_re = re.compile('\s')
+# learning options which statistics of rule groups depend on
+incremental_options = ('mode', 'generalize', 'context window', 'weights format',
+                       'convergence z', 'convergence min observations', 'convergence cap')
+
+# glob characters and compression extensions removed from corpus names in prefix
+glob_chars_re = re.compile(r'[*?\[\]]')
+compressed_extension_re = re.compile(r'\.(gz|bz2|xz|zst)$')
 
+# start of the run, for reporting time to first translated sentence
+start_time = clock()
+
+@budget.stage('loading rules')
 def load_rules(pair_data, source, target):
     """
     Load t1x transfer rules file from pair_data folder in source-target direction.
     """
-    tixbasename = '{}.{}-{}'.format(os.path.basename(pair_data), source, target)
-    tixbasepath = os.path.join(pair_data, tixbasename)
-    binbasepath = os.path.join(pair_data, '{}-{}'.format(source, target))
+    tixbasepath, binbasepath = pair_paths(pair_data, source, target)
     tixfname = '.'.join((tixbasepath, 't1x'))
     cat_dict, rules, ambiguous_rules, rule_id_map, rule_xmls = coverage.prepare(tixfname)
     pattern_FST = coverage.FST(rules)
@@ -52,17 +97,35 @@ def make_prefix(config):
         return os.path.join(config.get('LEARNING', 'data'),
                             config.get('LEARNING', 'prefix'))
 
-    source_basename = os.path.basename(config.get('LEARNING', 'source corpus'))
+    source_basename = corpus_basename(config.get('LEARNING', 'source corpus'))
     if config.get('LEARNING', 'mode') == mono_mode:
         basename = source_basename
     else:
-        target_basename = os.path.basename(config.get('LEARNING', 'target corpus'))
+        target_basename = corpus_basename(config.get('LEARNING', 'target corpus'))
         basename = '{}-{}'.format(source_basename, target_basename)
     return os.path.join(config.get('LEARNING', 'data'), basename)
 
-def tag_corpus(pair_data, source, target, corpus, prefix, data_folder):
+def corpus_basename(corpus):
+    """
+    Make base name of intermediate files from corpus option:
+    base name of its first file name or pattern
+    without glob characters and compression extension.
+    Corpora of several files or patterns also get a part
+    of md5 sum of all their file names, so that corpora
+    with the same first pattern get different names.
     """
-    Take source language corpus.
+    basename = glob_chars_re.sub('', os.path.basename(corpus.split()[0]))
+    basename = compressed_extension_re.sub('', basename) or 'corpus'
+    if len(corpus.split()) == 1 and not glob_chars_re.search(corpus):
+        return basename
+    fnames = '\n'.join(os.path.abspath(fname) for fname in corpus_files(corpus))
+    return '{}-{}'.format(basename, hashlib.md5(fnames.encode('utf-8')).hexdigest()[:8])
+
+@budget.stage('tagging')
+def tag_corpus(pair_data, source, target, corpus, prefix, data_folder, jobs=1):
+    """
+    Take source language corpus (one or more possibly compressed files,
+    see corpus.open_corpus, decompressed by jobs threads).
     Tag it but do not translate.
     """
     print('Tagging source corpus.')
@@ -77,146 +140,392 @@ def tag_corpus(pair_data, source, target, corpus, prefix, data_folder):
     pipe.append('apertium-pretransfer', '--')
     
     # tag
-    pipe.copy(corpus, ofname)
+    if is_plain_file(corpus):
+        pipe.copy(corpus_files(corpus)[0], ofname)
+    else:
+        with open_corpus(corpus, jobs) as ifile, \
+             pipe.open(ofname, 'w') as ofile:
+            shutil.copyfileobj(ifile, ofile.buffer, corpus_block_size)
 
     print('Done in {:.2f}'.format(clock() - btime))    
     return ofname
 
-def search_ambiguous(ambiguous_rules, coverage):
+@budget.stage('deduplicating')
+def ingest_corpus(config, prefix, corpora):
+    """
+    Take list of corpus file names (source, and target in parallel mode).
+    If deduplication is on in config, copy their unique lines
+    and count occurrences of each of them. Return list of corpus
+    file names to learn from and the name of counts file
+    (None if corpus is not deduplicated).
+    """
+    if config.get('LEARNING', 'deduplicate', fallback='no') != 'yes':
+        return corpora, None
+
+    unique_fnames = ['{}-unique-{}.txt'.format(prefix, side)
+                         for side in ('source', 'target')[:len(corpora)]]
+    counts_fname = prefix + counts_suffix
+    dedup.dedup_corpus(corpora, unique_fnames, counts_fname,
+                       config.getint('LEARNING', 'deduplicate max lines',
+                                     fallback=dedup.default_max_lines),
+                       decompression_jobs(config))
+    return unique_fnames, counts_fname
+
+def tag_ingested_corpus(pair_data, source, target, ingested, prefix, data_folder, jobs=1):
+    """
+    Tag source corpus returned by ingest_corpus.
+    """
+    return tag_corpus(pair_data, source, target, ingested[0][0], prefix, data_folder, jobs)
+
+def load_counts(ingested):
+    """
+    Load counts of lines of corpus returned by ingest_corpus
+    if it was deduplicated, otherwise return None.
+    """
+    corpora, counts_fname = ingested
+    if counts_fname is None:
+        return None
+    return dedup.load_counts(counts_fname)
+
+def search_ambiguous(ambiguous_rules, coverage_item):
     """
     Look for patterns covered by one of the ambiguous rules in ambiguous_rules.
-    If found, return the rules and their patterns.
+    If found, return the token spans of the chunks, their rules and patterns.
     """
-    pattern_list = []
-    for i, part in enumerate(coverage):
-        if part[1] in ambiguous_rules:
-            pattern_list.append((i, part[1], tuple(part[0])))
-    return pattern_list
+    return make_pattern_list(coverage.find_ambiguous(ambiguous_rules, coverage_item),
+                             coverage_item)
 
+def make_pattern_list(chunks, coverage_item):
+    """
+    Add patterns to (start, end, rule group number) spans of ambiguous chunks.
+    """
+    return [(start, end, rule_number, tuple(coverage_item.tokens[start:end]))
+                for start, end, rule_number in chunks]
+
+@budget.stage('detecting and translating')
 def detect_ambiguous_mono(corpus, prefix, 
                      cat_dict, pattern_FST, ambiguous_rules,
-                     tixfname, binfname, rule_id_map):
+                     tixfname, binfname, rule_id_map,
+                     batch_size=default_batch_size, timeout=default_timeout,
+                     index_fname=None, tracker=None, scorer=None, translators=None,
+                     context_window=0, counts=None):
     """
-    Find sentences that contain ambiguous chunks.
-    Translate them in all possible ways.
-    Store the results.
+    Find sentences that contain ambiguous chunks
+    (or take them from index_fname made by pre-scan).
+    Translate them in all possible ways (or only windows
+    of at least context_window tokens around each chunk, if it is not 0).
+    Store the results (with the number of occurrences of the line
+    of each sentence, if counts of deduplicated corpus lines are provided).
+    Inputs which fail translator pipelines are skipped
+    and stored in rejected file.
+    If convergence tracker is provided, variants are scored with scorer
+    right away, and chunks of converged patterns are skipped.
+    Translators already started by start_translators may be provided.
     """
     print('Looking for ambiguous sentences and translating them.')
     btime = clock()
 
-    # make output file name
+    # make output and temporary weights file names
     ofname = prefix + '-ambiguous.txt'
+    tmpweights_fname = prefix + tmpweights_suffix
+
+    # initialize supervised translators
+    # for translation with no weights and for weighted translation
+    if translators is None:
+        translators = start_translators(tixfname, binfname, prefix, timeout)
+    translator, weighted_translator = translators
 
-    # initialize translators
-    # for translation with no weights
-    translator = partialTranslator(tixfname, binfname)
-    # for weighted translation
-    weighted_translator = weightedPartialTranslator(tixfname, binfname)
+    # corpus is read as utf-8 encoded bytes, so categories are matched against bytes
+    bytes_cat_dict = coverage.get_bytes_cat_dict(cat_dict)
 
     # initialize statistics
     lines_count, total_sents_count, ambig_sents_count, ambig_chunks_count = 0, 0, 0, 0
     botched_coverages = 0
     lbtime = clock()
 
-    with open(corpus, 'r', encoding='utf-8') as ifile, \
-         open(ofname, 'w', encoding='utf-8') as ofile:
-        for line in ifile:
-
-            # look at each sentence in line
-            for sent_match in sent_re.finditer(line.strip()):
-                if sent_match.group(0) != '':
-                    total_sents_count += 1
+    # segmented sentences waiting to be translated
+    batch = []
+    first_sentence_done = False
+
+    def report_first_sentence():
+        nonlocal first_sentence_done
+        if not first_sentence_done and ofile.tell() > 0:
+            print('First ambiguous sentence translated {:.2f} after start'.format(clock() - start_time))
+            first_sentence_done = True
+
+    def translate_batch():
+        """
+        Translate and output the batch.
+        """
+        translate_ambiguous_batch(batch, ambiguous_rules, rule_id_map,
+                                  translator, weighted_translator,
+                                  tmpweights_fname, ofile, tracker, scorer)
+        batch.clear()
+        report_first_sentence()
+
+    def translate_windows(pattern_list, coverage_item, count):
+        """
+        Translate and output each ambiguous chunk
+        in a window of context around it instead of the whole sentence.
+        """
+        for start, end, rule_group_number, pattern in pattern_list:
+            window_start, window_end = coverage.context_window(coverage_item, start, end,
+                                                               context_window)
+            # window is a sentence of one segment,
+            # which touches sentence edges only at the ends of the sentence
+            translate_ambiguous_sentence([[rule_group_number, pattern,
+                                           coverage_item.segment(window_start, window_end), b'']],
+                                         ambiguous_rules, rule_id_map,
+                                         weighted_translator, tmpweights_fname, ofile,
+                                         tracker, scorer,
+                                         (window_start == 0, window_end == len(coverage_item.tokens)),
+                                         count)
+        report_first_sentence()
+
+    def add_to_batch(pattern_list, coverage_item, line_number):
+        """
+        Segment the sentence and add it to the batch,
+        translate the batch if it is full, and output it.
+        """
+        count = 1 if counts is None else counts[line_number]
+        if tracker is not None:
+            # leave out chunks of converged patterns
+            pattern_list = [(start, end, rule_group_number, pattern)
+                                for start, end, rule_group_number, pattern in pattern_list
+                                    if not tracker.skip((rule_group_number, pattern),
+                                                        len(ambiguous_rules[rule_group_number]),
+                                                        count)]
+            if pattern_list == []:
+                return
+        if context_window > 0:
+            translate_windows(pattern_list, coverage_item, count)
+            return
+        batch.append((segment_ambiguous_sentence(pattern_list, coverage_item), count))
+        if len(batch) >= batch_size:
+            translate_batch()
+
+    def print_progress():
+        print('\n{} total lines\n{} total sentences'.format(lines_count, total_sents_count))
+        print('{} ambiguous sentences\n{} ambiguous chunks'.format(ambig_sents_count, ambig_chunks_count))
+        print('{} botched coverages\nanother {:.4f} elapsed'.format(botched_coverages, clock() - lbtime))
+
+    with map_corpus(corpus) as ibuf, \
+         open(ofname, 'wb') as ofile:
+
+        if index_fname is None:
+            # look at each sentence in corpus
+            for line_number, sentence in iter_tagged_sentences(ibuf):
+                total_sents_count += 1
 
                 # get coverages
-                coverage_list = pattern_FST.get_lrlm(sent_match.group(0), cat_dict)
+                coverage_list = pattern_FST.get_lrlm(sentence, bytes_cat_dict)
                 if coverage_list == []:
                     botched_coverages += 1
                 else:
-                    # look for ambiguous chunks...
+                    # look for ambiguous chunks
                     coverage_item = coverage_list[0]
                     pattern_list = search_ambiguous(ambiguous_rules, coverage_item)
                     if pattern_list != []:
-                        # ...translate them, and output them
                         ambig_sents_count += 1
-                        ambig_chunks_count = translate_ambiguous_sentence(pattern_list, coverage_item, ambig_chunks_count,
-                                                                          ambiguous_rules, rule_id_map,
-                                                                          translator, weighted_translator, ofile)
-            lines_count += 1
-            if lines_count % 1000 == 0:
-                print('\n{} total lines\n{} total sentences'.format(lines_count, total_sents_count))
-                print('{} ambiguous sentences\n{} ambiguous chunks'.format(ambig_sents_count, ambig_chunks_count))
-                print('{} botched coverages\nanother {:.4f} elapsed'.format(botched_coverages, clock() - lbtime))
-                gc.collect()
-                lbtime = clock()
+                        ambig_chunks_count += len(pattern_list)
+                        add_to_batch(pattern_list, coverage_item, line_number)
+
+                if line_number // 1000 > lines_count // 1000:
+                    lines_count = line_number
+                    print_progress()
+                    lbtime = clock()
+        else:
+            # go straight to ambiguous sentences found by pre-scan
+            stats, records = ambindex.read_index(index_fname)
+            total_sents_count, botched_coverages = stats['sentences'], stats['botched']
+            ttime = clock()
+            for line_number, offset, length, chunks in records:
+                if context_window > 0:
+                    # windows are cut at chunk boundaries, so full coverage is needed
+                    coverage_item = pattern_FST.get_lrlm(ibuf[offset:offset+length], bytes_cat_dict)[0]
+                else:
+                    coverage_item = ambindex.make_coverage(ibuf[offset:offset+length])
+                ambig_sents_count += 1
+                ambig_chunks_count += len(chunks)
+                add_to_batch(make_pattern_list(chunks, coverage_item), coverage_item, line_number)
+
+                if line_number // 1000 > lines_count // 1000:
+                    lines_count = line_number
+                    print_progress()
+                    # predict the rest of the run from the weighted translations done so far
+                    translations_done = weighted_translator.counters['requests']
+                    if tracker is not None:
+                        translations_done += tracker.saved_translations
+                    if translations_done > 0:
+                        print('{} of {} weighted translations done, about {:.0f} s left'.format(
+                                  translations_done, stats['translations'],
+                                  (clock() - ttime) / translations_done *
+                                      max(stats['translations'] - translations_done, 0)))
+                    lbtime = clock()
+
+        # translate the last incomplete batch
+        if batch != []:
+            translate_batch()
 
     # clean up temporary weights file
     if os.path.exists(tmpweights_fname):
         os.remove(tmpweights_fname)
 
+    print('Translator pipelines: {}'.format(translator.report()))
+    print('Weighted translator pipelines: {}'.format(weighted_translator.report()))
+    if tracker is not None:
+        print('Convergence: {}'.format(tracker.report()))
+    translator.close()
+    weighted_translator.close()
+
     print('Done in {:.2f}'.format(clock() - btime))
     return ofname
 
-def translate_ambiguous_sentence(pattern_list, coverage_item, ambig_chunks_count,
-                                 ambiguous_rules, rule_id_map,
-                                 translator, weighted_translator, ofile):
+def segment_ambiguous_sentence(pattern_list, coverage_item):
     """
-    Segment sentence into parts each containing one ambiguous chunk,
-    translate them in every possible way, then make sentence variants
-    where one segment is translated in every possible way, and the rest
-    is translated with default rules.
+    Segment sentence into parts each containing one ambiguous chunk.
+    Return a list of [rule group number, pattern, segment] lists,
+    where segment is a slice of the sentence.
     """
+    tokens = coverage_item.tokens
     sentence_segments, prev = [], 0
-    for i, rule_group_number, pattern in pattern_list:
-        ambig_chunks_count += 1
-        list_with_chunk = sum([chunk[0] for chunk in coverage_item[prev:i+1]], [])
-        piece_of_line = '^' + '$ ^'.join(list_with_chunk) + '$'
+    for start, end, rule_group_number, pattern in pattern_list:
+        # segment spans from the end of previous segment to the end of the chunk,
+        # the last one also takes up the tail of the sentence
+        if len(sentence_segments) == len(pattern_list) - 1:
+            end = len(tokens)
+        piece_of_line = coverage_item.segment(prev, end)
         sentence_segments.append([rule_group_number, pattern, piece_of_line])
-        prev = i+1
-
-    if sentence_segments != []:
-        if prev <= len(coverage_item):
-            # add up the tail of the sentence
-            list_with_chunk = sum([chunk[0] for chunk in coverage_item[prev:]], [])
-            piece_of_line = ' ^' + '$ ^'.join(list_with_chunk) + '$'
-            sentence_segments[-1][2] += piece_of_line
-
-        # first, translate each segment with default rules
-        for sentence_segment in sentence_segments:
-            sentence_segment.append(translator.translate(sentence_segment[2]))
-
-        # second, translate each segment with each of the rules,
-        # and make full sentence, where other segments are translated with default rules
-        for j, sentence_segment in enumerate(sentence_segments):
+        prev = end
+
+    return sentence_segments
+
+def translate_ambiguous_batch(batch, ambiguous_rules, rule_id_map,
+                              translator, weighted_translator,
+                              tmpweights_fname, ofile, tracker=None, scorer=None):
+    """
+    Translate segments of all sentences in batch (pairs of sentence segments
+    and the number of occurrences of the sentence) with default rules
+    in one pipeline round-trip, then translate and store
+    the variants of each sentence.
+    """
+    segments = [sentence_segment for sentence_segments, count in batch
+                                    for sentence_segment in sentence_segments]
+    translations = translator.translate_batch([sentence_segment[2]
+                                                  for sentence_segment in segments])
+    for sentence_segment, translation in zip(segments, translations):
+        sentence_segment.append(translation)
+
+    for sentence_segments, count in batch:
+        if any(sentence_segment[3] is None for sentence_segment in sentence_segments):
+            # part of the sentence was rejected by translator
+            continue
+        translate_ambiguous_sentence(sentence_segments, ambiguous_rules, rule_id_map,
+                                     weighted_translator, tmpweights_fname, ofile,
+                                     tracker, scorer, count=count)
+
+def translate_ambiguous_sentence(sentence_segments, ambiguous_rules, rule_id_map,
+                                 weighted_translator, tmpweights_fname, ofile,
+                                 tracker=None, scorer=None, edges=(True, True), count=1):
+    """
+    Take sentence segments already translated with default rules,
+    translate each segment in every possible way, and store
+    default translations of the segments once, followed by
+    the translations of each segment in every possible way
+    (see make_variants for the sentence variants they stand for).
+    Sentences of one segment are stored as full sentence variants.
+    Edges tell if the sentence has its beginning and end (it may be
+    a window of context instead), so that they are scored as such,
+    and count is the number of times the sentence occurs in corpus.
+    Segments, translations and output file are utf-8 encoded bytes.
+    If convergence tracker is provided, variants are scored with scorer
+    and added to its estimates.
+    """
+    default_translations = [sentence_segment[3] for sentence_segment in sentence_segments]
+    header_written = False
+
+    for j, sentence_segment in enumerate(sentence_segments):
+        if tracker is not None and \
+           tracker.skip((sentence_segment[0], sentence_segment[1]),
+                        len(ambiguous_rules[sentence_segment[0]]), count):
+            # pattern converged while the sentence was waiting in the batch
+            continue
+        try:
             translation_list = translate_ambiguous_segment(weighted_translator,
                                                            ambiguous_rules[sentence_segment[0]],
                                                            sentence_segment[1],
-                                                           sentence_segment[2], rule_id_map)
-            output_list = []
-            for rule, translation in translation_list:
-                translated_sentence = ' '.join(sentence_segment[3]
-                                                    for sentence_segment
-                                                        in sentence_segments[:j]) +\
-                                      ' ' + translation + ' ' +\
-                                      ' '.join(sentence_segment[3]
-                                                    for sentence_segment
-                                                        in sentence_segments[j+1:])
-                output_list.append('{}\t{}'.format(rule, translated_sentence.strip(' ')))
-
-            # store results to file
-            # first, print rule group number, pattern, and number of rules in the group
-            print('{}\t^{}$\t{}'.format(sentence_segment[0], '$ ^'.join(sentence_segment[1]), len(output_list)), file=ofile)
+                                                           sentence_segment[2], rule_id_map,
+                                                           tmpweights_fname)
+        except RejectedInput:
+            # segment was rejected by translator, skip its variants
+            continue
+
+        # store results to file
+        if len(sentence_segments) == 1 and edges == (True, True) and count == 1:
+            # segment variants are sentence variants:
+            # print rule group number, pattern, and number of rules in the group,
             # then, output all the translations in the following way: rule number, then translated sentence
-            print('\n'.join(output_list), file=ofile)
-
-    return ambig_chunks_count
+            ofile.write(b'%s\t^%s$\t%d\n' % (sentence_segment[0].encode(),
+                                              b'$ ^'.join(sentence_segment[1]),
+                                              len(translation_list)))
+            ofile.write(b''.join(b'%s\t%s\n' % (rule.encode(), translation.strip(b' '))
+                                     for rule, translation in translation_list))
+        else:
+            # first, print number of segments and their default translations,
+            # once per sentence
+            # (and whether they have sentence beginning and end, if not both,
+            # and the number of occurrences of the sentence, if it is not 1)
+            if not header_written:
+                ofile.write(b'%s\t%d' % (sentence_header.encode(), len(default_translations)))
+                if edges != (True, True) or count != 1:
+                    ofile.write(b'\t%d\t%d' % edges)
+                if count != 1:
+                    ofile.write(b'\t%d' % count)
+                ofile.write(b'\n')
+                ofile.write(b''.join(translation + b'\n' for translation in default_translations))
+                header_written = True
+            # then, print rule group number, pattern, number of rules in the group and segment number,
+            # then, output all the translations in the following way: rule number, then translated segment
+            ofile.write(b'%s\t^%s$\t%d\t%d\n' % (sentence_segment[0].encode(),
+                                                  b'$ ^'.join(sentence_segment[1]),
+                                                  len(translation_list), j))
+            ofile.write(b''.join(b'%s\t%s\n' % (rule.encode(), translation)
+                                     for rule, translation in translation_list))
+
+        if tracker is not None:
+            # scores land in the cache, so scoring them again later is cheap
+            variants = make_variants([translation.decode('utf-8')
+                                          for translation in default_translations], j,
+                                     [translation.decode('utf-8')
+                                          for rule, translation in translation_list])
+            weights = normalized_scores(scorer, [normalize(variant) for variant in variants], *edges)
+            tracker.add((sentence_segment[0], sentence_segment[1]),
+                        zip((rule for rule, translation in translation_list), weights), count)
+
+def make_variants(default_translations, j, segment_translations):
+    """
+    Make full sentence variants where segment j is translated
+    in each of the ways from segment_translations,
+    and the rest is translated with default rules.
+    """
+    head = ' '.join(default_translations[:j])
+    tail = ' '.join(default_translations[j+1:])
+    return [(head + ' ' + translation + ' ' + tail).strip(' ')
+                for translation in segment_translations]
 
 def translate_ambiguous_segment(weighted_translator, rule_group,
-                                pattern, sent_line, rule_id_map):
+                                pattern, sent_line, rule_id_map,
+                                tmpweights_fname):
     """
-    Translate sent_line for each rule in rule_group.
+    Translate sent_line for each rule in rule_group
+    using temporary weights file tmpweights_fname.
     """
     translation_list = []
 
+    # pattern tokens may come as utf-8 encoded bytes
+    pattern = [token.decode('utf-8') if type(token) == bytes else token
+                    for token in pattern]
+
     #for each rule
     for focus_rule in rule_group:
         # create weights file favoring that rule
@@ -236,46 +545,86 @@ def translate_ambiguous_segment(weighted_translator, rule_group,
 
     return translation_list
 
-def score_sentences(ambig_sentences_fname, model, prefix, generalize=False):
+def normalized_scores(scorer, sentences, bos=True, eos=True):
+    """
+    Score variants of a sentence and normalize
+    their scores to add up to 1.
+    """
+    scores = [exp(score) for score in scorer.score(sentences, bos, eos)]
+    total = sum(scores)
+    return [score / total for score in scores]
+
+@budget.stage('scoring')
+def score_sentences(ambig_sentences_fname, model, prefix, generalize=False, binary=False,
+                    cache=None, tracker=None):
     """
-    Score translated sentences against language model.
+    Score translated sentences against language model
+    (only those missing from cache if it is provided)
+    and store chunk weights in text or binary format.
+    Ambiguous sentences file may list either full sentence variants
+    or default translations of segments of each sentence
+    followed by segment variants (of sentences which may lack
+    beginning or end when they are windows of context, and may
+    stand for several occurrences of the sentence in corpus).
+    If convergence tracker is provided, chunks skipped by it
+    are added with frozen weights of their patterns.
     """
     print('Scoring ambiguous sentences.')
     btime, chunk_counter, sentence_counter = clock(), 0, 0
+    scorer = VariantScorer(model, cache)
 
     # make output file name
-    ofname = prefix + '-chunk-weights.txt'
+    ofname = chunkweights.make_fname(prefix + chunk_weights_suffix, binary)
 
     with open(ambig_sentences_fname, 'r', encoding='utf-8') as ifile, \
-         open(ofname, 'w', encoding='utf-8') as ofile:
-        reading = True
+         chunkweights.open_writer(ofname, binary) as writer:
+        reading, default_translations, sentence_edges, sentence_count = True, [], (True, True), 1
         while reading:
             try:
                 line = ifile.readline()
-                rule_group_number, pattern, rulecount = line.rstrip('\n').split('\t')
-                weights_list, total = [], 0.
+                fields = line.rstrip('\n').split('\t')
+                if fields[0] == sentence_header:
+                    # new sentence: read default translations of its segments
+                    default_translations = [ifile.readline().rstrip('\n')
+                                                for i in range(int(fields[1]))]
+                    sentence_edges = (True, True) if len(fields) == 2 else \
+                                     tuple(field == '1' for field in fields[2:4])
+                    sentence_count = 1 if len(fields) < 5 else int(fields[4])
+                    continue
+                if len(fields) == 4:
+                    # segment variants of the current sentence
+                    rule_group_number, pattern, rulecount, segment_number = fields
+                    edges, count = sentence_edges, sentence_count
+                else:
+                    # full sentence variants
+                    rule_group_number, pattern, rulecount = fields
+                    segment_number, edges, count = None, (True, True), 1
+                rule_numbers, sentences = [], []
 
-                # read and process as much following lines as specified by rulecount
+                # read as much following lines as specified by rulecount
                 for i in range(int(rulecount)):
                     line = ifile.readline()
                     rule_number, sentence = line.rstrip('\n').split('\t')
-
-                    # score and add up
-                    score = exp(model.score(normalize(sentence), bos = True, eos = True))
-                    weights_list.append((rule_number, score))
-                    total += score
+                    rule_numbers.append(rule_number)
+                    sentences.append(sentence)
                     sentence_counter += 1
+                if segment_number is not None:
+                    sentences = make_variants(default_translations, int(segment_number), sentences)
+                sentences = [normalize(sentence) for sentence in sentences]
+
+                # score all variants at once
+                weights_list = list(zip(rule_numbers, normalized_scores(scorer, sentences, *edges)))
 
                 # normalize and print out
                 if generalize:
                     divided_pattern = divide_pattern(pattern)
                     mask_patterns = list(product([1, 0], repeat=len(divided_pattern)))
-                for rule_number, score in weights_list:
-                    print(rule_group_number, rule_number, pattern, score / total, sep='\t', file=ofile)
+                for rule_number, weight in weights_list:
+                    writer.add(rule_group_number, rule_number, pattern, weight * count, count)
                     if generalize:
                         print_generalized_patterns(divided_pattern, mask_patterns,
                                                    rule_group_number, rule_number,
-                                                   score / total, ofile)
+                                                   weight * count, writer, count)
                 chunk_counter += 1
 
             except ValueError:
@@ -285,19 +634,29 @@ def score_sentences(ambig_sentences_fname, model, prefix, generalize=False):
             except EOFError:
                 reading = False
 
+        if tracker is not None:
+            add_skipped_chunks(tracker, writer, generalize)
+
     print('Scored {} chunks, {} sentences in {:.2f}'.format(chunk_counter, sentence_counter, clock() - btime))
+    print('Language model scored {} of {} words'.format(scorer.words_scored, scorer.words_total))
+    if cache is not None:
+        print('Score cache hit rate {:.2%} ({} hits, {} misses)'.format(cache.hit_rate(),
+                                                                      cache.hits, cache.misses))
     return ofname
 
-def make_et_pattern(et_rule, tokens, weight=1.):
+def make_et_pattern(et_rule, tokens, weight=1., count=1):
     """
     Make pattern element for xml tree
     with pattern-item elements.
+    Observation count is stored only if it is not 1.
     """
     if type(tokens) == type(''):
         # if tokens is str, tokenize it
         tokens = apertium_token_re.findall(tokens)
     et_pattern = etree.SubElement(et_rule, 'pattern')
     et_pattern.attrib['weight'] = str(weight)
+    if count != 1:
+        et_pattern.attrib['count'] = str(count)
     for token in tokens:
         et_pattern_item = etree.SubElement(et_pattern, 'pattern-item')
         parts = token.split('<', maxsplit=1) + ['']
@@ -318,14 +677,24 @@ def make_et_rule(rule_number, et_rulegroup, rule_map, rule_xmls=None):
         et_rule.attrib.update(rule_xmls[rule_number].attrib)
         # calculate md5 sum of rule text without whitespace
         # and add it as rule attribute
-        rule_text = etree.tostring(rule_xmls[rule_number], encoding='unicode')
-        clean_rule_text = whitespace_re.sub('', rule_text)
-        et_rule.attrib['md5'] = hashlib.md5(clean_rule_text.encode()).hexdigest()
+        et_rule.attrib['md5'] = incremental.rule_md5(rule_xmls[rule_number])
     else:
         # this part is used for temporary weights file
         et_rule.attrib['id'] = rule_map[rule_number]
     return et_rule
 
+def make_empty_weights(ofname, btime):
+    """
+    Write weights file without rule groups, when there are no chunk weights
+    (no ambiguous chunks were found, or all of them were skipped).
+    """
+    with W1xWriter(ofname, using_lxml):
+        pass
+    print('No chunk weights, weights file is empty.')
+    print('Done in {:.2f}'.format(clock() - btime))
+    return ofname
+
+@budget.stage('summing up weights')
 def make_xml_transfer_weights_mono(scores_fname, prefix, rule_map, rule_xmls):
     """
     Sum up the weights for each rule-pattern pair,
@@ -335,56 +704,55 @@ def make_xml_transfer_weights_mono(scores_fname, prefix, rule_map, rule_xmls):
     btime = clock()
 
     # make output file names
-    sorted_scores_fname = prefix + '-chunk-weights-sorted.txt'
+    sorted_scores_fname = prefix + chunk_weights_suffix + '-sorted.txt'
     ofname = prefix + '-rule-weights.w1x'
 
-    # create pipeline
-    pipe = pipes.Template()
-    pipe.append('sort $IN > $OUT', 'ff')
-    pipe.copy(scores_fname, sorted_scores_fname)
+    # get rows sorted by rule group, rule and pattern
+    rows = chunkweights.read_sorted(scores_fname, sorted_scores_fname)
+    first_row = next(rows, None)
+    if first_row is None:
+        return make_empty_weights(ofname, btime)
 
-    # create empty output xml tree
-    oroot = etree.Element('transfer-weights')
-    et_newrulegroup = etree.SubElement(oroot, 'rule-group')
+    # rule groups are written out as soon as they are complete,
+    # so only one of them is kept in memory
+    with W1xWriter(ofname, using_lxml) as writer:
+        et_newrulegroup = etree.Element('rule-group')
 
-    with open(sorted_scores_fname, 'r', encoding='utf-8') as ifile:
-        # read and process the first line
-        prev_group_number, prev_rule_number, prev_pattern, weight = ifile.readline().rstrip('\n').split('\t')
-        total_pattern_weight = float(weight)
+        # process the first row
+        prev_group_number, prev_rule_number, prev_pattern, weight, count = first_row
+        total_pattern_weight, total_pattern_count = weight, count
         et_newrule = make_et_rule(prev_rule_number, et_newrulegroup, rule_map, rule_xmls)
 
-        # read and process other lines
-        for line in ifile:
-            group_number, rule_number, pattern, weight = line.rstrip('\n').split('\t')
+        # read and process other rows
+        for group_number, rule_number, pattern, weight, count in rows:
             if group_number != prev_group_number:
-                # rule group changed: flush pattern, close previuos, open new
-                et_newpattern = make_et_pattern(et_newrule, prev_pattern, total_pattern_weight)
-                et_newrulegroup = etree.SubElement(oroot, 'rule-group')
+                # rule group changed: flush pattern, write out previuos, open new
+                et_newpattern = make_et_pattern(et_newrule, prev_pattern,
+                                                total_pattern_weight, total_pattern_count)
+                writer.write(et_newrulegroup)
+                et_newrulegroup = etree.Element('rule-group')
                 et_newrule = make_et_rule(rule_number, et_newrulegroup, rule_map, rule_xmls)
-                total_pattern_weight = 0.
+                total_pattern_weight, total_pattern_count = 0., 0
             elif rule_number != prev_rule_number:
                 # rule changed: flush previous pattern, create new rule
-                et_newpattern = make_et_pattern(et_newrule, prev_pattern, total_pattern_weight)
+                et_newpattern = make_et_pattern(et_newrule, prev_pattern,
+                                                total_pattern_weight, total_pattern_count)
                 et_newrule = make_et_rule(rule_number, et_newrulegroup, rule_map, rule_xmls)
-                total_pattern_weight = 0.
+                total_pattern_weight, total_pattern_count = 0., 0
             elif pattern != prev_pattern:
                 # pattern changed: flush previous
-                et_newpattern = make_et_pattern(et_newrule, prev_pattern, total_pattern_weight)
-                total_pattern_weight = 0.
-            # add up rule-pattern weights
-            total_pattern_weight += float(weight)
+                et_newpattern = make_et_pattern(et_newrule, prev_pattern,
+                                                total_pattern_weight, total_pattern_count)
+                total_pattern_weight, total_pattern_count = 0., 0
+            # add up rule-pattern weights and observation counts
+            total_pattern_weight += weight
+            total_pattern_count += count
             prev_group_number, prev_rule_number, prev_pattern = group_number, rule_number, pattern
 
         # flush the last rule-pattern
-        et_newpattern = make_et_pattern(et_newrule, prev_pattern, total_pattern_weight)
-
-    if using_lxml:
-        # lxml supports pretty print
-        etree.ElementTree(oroot).write(ofname, pretty_print=True,
-                                       encoding='utf-8', xml_declaration=True)
-    else:
-        etree.ElementTree(oroot).write(ofname,
-                                       encoding='utf-8', xml_declaration=True)
+        et_newpattern = make_et_pattern(et_newrule, prev_pattern,
+                                        total_pattern_weight, total_pattern_count)
+        writer.write(et_newrulegroup)
 
     print('Done in {:.2f}'.format(clock() - btime))
     return ofname
@@ -401,48 +769,90 @@ def divide_pattern(pattern):
     return divided_pattern
 
 def print_generalized_patterns(divided_pattern, mask_patterns,
-                               rule_group_number, rule_number, weight, ofile):
+                               rule_group_number, rule_number, weight, writer, count=1):
     for mask in mask_patterns[1:]:
         generalized_pattern = []
         for mask_pos, (lemma, tags) in zip(mask, divided_pattern):
             generalized_pattern.append(('*' if mask_pos == 0 else lemma) + tags)
         genpattern_chunk = '^' + '$ ^'.join(generalized_pattern) + '$'
-        print(rule_group_number, rule_number, genpattern_chunk, weight, sep='\t', file=ofile)
+        writer.add(rule_group_number, rule_number, genpattern_chunk, weight, count)
 
+def add_skipped_chunks(tracker, writer, generalize=False):
+    """
+    Add chunks of converged patterns skipped by convergence tracker
+    with frozen mean weights of their rules, so that weights
+    and counts of frequent patterns (and of their generalized
+    patterns) still grow with all of their occurrences.
+    """
+    for (rule_group_number, pattern), rule_weights, count in tracker.iter_skipped():
+        pattern_chunk = '^' + '$ ^'.join(token.decode('utf-8') for token in pattern) + '$'
+        if generalize:
+            divided_pattern = divide_pattern(pattern_chunk)
+            mask_patterns = list(product([1, 0], repeat=len(divided_pattern)))
+        for rule_number, weight in rule_weights.items():
+            # rules with zero weight have no rows in parallel mode statistics either
+            if weight == 0.:
+                continue
+            writer.add(rule_group_number, rule_number, pattern_chunk, weight * count, count)
+            if generalize:
+                print_generalized_patterns(divided_pattern, mask_patterns,
+                                           rule_group_number, rule_number,
+                                           weight * count, writer, count)
+
+@budget.stage('detecting, translating and scoring')
 def detect_ambiguous_parallel(source_corpus, target_corpus, prefix, 
                               cat_dict, pattern_FST, ambiguous_rules,
                               tixfname, binfname, rule_id_map,
-                              generalize=False):
+                              generalize=False, binary=False, timeout=default_timeout,
+                              tracker=None, translators=None, counts=None, jobs=1):
     """
     Find ambiguous chunks.
     Translate them in all possible ways.
-    Score them, and store the results.
+    Score them, and store the results
+    in text or binary format.
+    Chunks which fail translator pipeline are skipped
+    and stored in rejected file.
+    If convergence tracker is provided,
+    chunks of converged patterns are skipped.
+    Translator already started by start_translators may be provided.
+    If counts of deduplicated corpus lines are provided,
+    chunks of each line are scored as many times as it occurs.
+    Target corpus may be several possibly compressed files,
+    decompressed by jobs threads, which must have as many lines
+    as tagged source corpus.
     """
     print('Looking for ambiguous chunks, translating and scoring them.')
     btime = clock()
 
-    # make output file name
-    ofname = prefix + '-chunk-weights.txt'
+    # make output and temporary weights file names
+    ofname = chunkweights.make_fname(prefix + chunk_weights_suffix, binary)
+    tmpweights_fname = prefix + tmpweights_suffix
 
-    # initialize translators
-    # for translation with no weights
-    translator = partialTranslator(tixfname, binfname)
-    # for weighted translation
-    weighted_translator = weightedPartialTranslator(tixfname, binfname)
+    # initialize supervised translator for weighted translation
+    if translators is None:
+        translators = start_translators(tixfname, binfname, prefix, timeout, default=False)
+    weighted_translator, = translators
 
     # initialize statistics
     lines_count, ambig_chunks_count = 0, 0
     botched_coverages = 0
     lbtime = clock()
+    first_chunk_done = False
+
+    # source corpus is read as utf-8 encoded bytes, so categories are matched against bytes
+    bytes_cat_dict = coverage.get_bytes_cat_dict(cat_dict)
 
-    with open(source_corpus, 'r', encoding='utf-8') as sfile, \
-         open(target_corpus, 'r', encoding='utf-8') as tfile, \
-         open(ofname, 'w', encoding='utf-8') as ofile:
+    with map_corpus(source_corpus) as sbuf, \
+         open_corpus(target_corpus, jobs) as tbuf, \
+         io.TextIOWrapper(tbuf, encoding='utf-8') as tfile, \
+         chunkweights.open_writer(ofname, binary) as writer:
 
-        for sl_line, tl_line in zip(sfile, tfile):
+        for sl_line, tl_line in iter_aligned_lines([iter_lines(sbuf), tfile],
+                                                   ['Tagged source corpus', 'Target corpus']):
+            count = 1 if counts is None else counts[lines_count]
 
             # get coverages
-            coverage_list = pattern_FST.get_lrlm(sl_line.strip(), cat_dict)
+            coverage_list = pattern_FST.get_lrlm(sl_line.strip(), bytes_cat_dict)
             if coverage_list == []:
                 botched_coverages += 1
             else:
@@ -451,48 +861,77 @@ def detect_ambiguous_parallel(source_corpus, target_corpus, prefix,
                 pattern_list = search_ambiguous(ambiguous_rules, coverage_item)
 
                 # translate each chunk with each of the relevant rules
-                for i, rule_group_number, pattern in pattern_list:
+                for start, end, rule_group_number, pattern in pattern_list:
                     ambig_chunks_count += 1
-                    pattern_chunk = '^' + '$ ^'.join(pattern) + '$'
-                    translation_list = translate_ambiguous_segment(weighted_translator,
-                                                                   ambiguous_rules[rule_group_number],
-                                                                   pattern_chunk, pattern_chunk,
-                                                                   rule_id_map)
+                    if tracker is not None and \
+                       tracker.skip((rule_group_number, pattern),
+                                    len(ambiguous_rules[rule_group_number]), count):
+                        continue
+                    pattern_chunk = b'^' + b'$ ^'.join(pattern) + b'$'
+                    try:
+                        translation_list = translate_ambiguous_segment(weighted_translator,
+                                                                       ambiguous_rules[rule_group_number],
+                                                                       pattern, pattern_chunk,
+                                                                       rule_id_map, tmpweights_fname)
+                    except RejectedInput:
+                        # chunk was rejected by translator
+                        continue
+                    # decode for comparison with target text
+                    pattern_chunk = pattern_chunk.decode('utf-8')
                     tl_line = normalize(tl_line)
+                    rule_weights = []
                     for rule_number, translation in translation_list:
-                        translation = normalize(translation)
+                        translation = normalize(translation.decode('utf-8'))
+                        rule_weights.append((rule_number, 1.0 if translation in tl_line else 0.))
                         if (translation in tl_line):
                             #print('{} IN {}'.format(translation, tl_line))
-                            print(rule_group_number, rule_number, pattern_chunk, '1.0',
-                                  sep='\t', file=ofile)
+                            writer.add(rule_group_number, rule_number, pattern_chunk, float(count), count)
                             if generalize:
-                                divided_pattern = divide_pattern(pattern)
+                                divided_pattern = divide_pattern(pattern_chunk)
                                 mask_patterns = list(product([1, 0], repeat=len(pattern)))
                                 print_generalized_patterns(divided_pattern, mask_patterns,
                                                            rule_group_number, rule_number,
-                                                           1.0, ofile)
+                                                           float(count), writer, count)
                         else:
                             #print('{} NOT IN {}'.format(translation, tl_line))
                             pass                            
+                    if tracker is not None:
+                        tracker.add((rule_group_number, pattern), rule_weights, count)
+                    if not first_chunk_done:
+                        print('First ambiguous chunk translated {:.2f} after start'.format(clock() - start_time))
+                        first_chunk_done = True
 
             lines_count += 1
             if lines_count % 1000 == 0:
                 print('\n{} total lines\n{} ambiguous chunks'.format(lines_count, ambig_chunks_count))
                 print('{} botched coverages\nanother {:.4f} elapsed'.format(botched_coverages, clock() - lbtime))
-                gc.collect()
                 lbtime = clock()
 
+        if tracker is not None:
+            add_skipped_chunks(tracker, writer, generalize)
+
     # clean up temporary weights file
     if os.path.exists(tmpweights_fname):
         os.remove(tmpweights_fname)
 
+    print('Weighted translator pipelines: {}'.format(weighted_translator.report()))
+    if tracker is not None:
+        print('Convergence: {}'.format(tracker.report()))
+    weighted_translator.close()
+
     print('Done in {:.2f}'.format(clock() - btime))
     return ofname
 
-def make_et_rule_group(et_rulegroup, pattern_rule_weights, rule_map, rule_xmls):
+def make_et_rule_group(et_rulegroup, pattern_rule_weights, rule_map, rule_xmls,
+                       pattern_rule_counts=None):
     """
-    Add a rule-group element to xml tree with normalized pattern weights.
+    Add a rule-group element to xml tree with normalized pattern weights
+    (and observation counts of patterns if pattern_rule_counts is provided).
     """
+    # a chunk is matched by translations of one or more rules,
+    # so the pattern is observed at least as many times as its most matched rule
+    pattern_counts = {pattern: max(rule_counts.values())
+                          for pattern, rule_counts in (pattern_rule_counts or {}).items()}
     rule_pattern_weights = {}
     for pattern, rule_weights in pattern_rule_weights.items():
         total = sum(weight for rule_number, weight in rule_weights.items())
@@ -506,8 +945,10 @@ def make_et_rule_group(et_rulegroup, pattern_rule_weights, rule_map, rule_xmls):
     for rule_number, pattern_weights in sorted(rule_pattern_weights.items(), key=lambda x: int(x[0])):
         et_newrule = make_et_rule(rule_number, et_rulegroup, rule_map, rule_xmls)
         for pattern, weight in pattern_weights:
-            et_newpattern = make_et_pattern(et_newrule, pattern, weight)
+            et_newpattern = make_et_pattern(et_newrule, pattern, weight,
+                                            pattern_counts.get(pattern, 1))
 
+@budget.stage('summing up weights')
 def make_xml_transfer_weights_parallel(scores_fname, prefix, rule_map, rule_xmls):
     """
     Sum up the weights for each rule-pattern pair,
@@ -517,145 +958,771 @@ def make_xml_transfer_weights_parallel(scores_fname, prefix, rule_map, rule_xmls
     btime = clock()
 
     # make output file names
-    sorted_scores_fname = prefix + '-chunk-weights-sorted.txt'
+    sorted_scores_fname = prefix + chunk_weights_suffix + '-sorted.txt'
     ofname = prefix + '-rule-weights.w1x'
 
-    # create pipeline
-    pipe = pipes.Template()
-    pipe.append('sort $IN > $OUT', 'ff')
-    pipe.copy(scores_fname, sorted_scores_fname)
+    # get rows sorted by rule group, rule and pattern
+    rows = chunkweights.read_sorted(scores_fname, sorted_scores_fname)
+    first_row = next(rows, None)
+    if first_row is None:
+        return make_empty_weights(ofname, btime)
 
-    # create empty output xml tree
-    oroot = etree.Element('transfer-weights')
-    et_newrulegroup = etree.SubElement(oroot, 'rule-group')
-    pattern_rule_weights = {}
+    # rule groups are written out as soon as they are complete,
+    # so only one of them is kept in memory
+    with W1xWriter(ofname, using_lxml) as writer:
+        et_newrulegroup = etree.Element('rule-group')
+        pattern_rule_weights, pattern_rule_counts = {}, {}
 
-    with open(sorted_scores_fname, 'r', encoding='utf-8') as ifile:
-        # read and process the first line
-        prev_group_number, rule_number, pattern, weight = ifile.readline().rstrip('\n').split('\t')
+        # process the first row
+        prev_group_number, rule_number, pattern, weight, count = first_row
         pattern_rule_weights[pattern] = {}
-        pattern_rule_weights[pattern][rule_number] = float(weight)
-
-        # read and process other lines
-        for line in ifile:
-            group_number, rule_number, pattern, weight = line.rstrip('\n').split('\t')
+        pattern_rule_weights[pattern][rule_number] = weight
+        pattern_rule_counts[pattern] = {}
+        pattern_rule_counts[pattern][rule_number] = count
 
+        # read and process other rows
+        for group_number, rule_number, pattern, weight, count in rows:
             if group_number != prev_group_number:
                 # rule group changed: flush previuos
                 make_et_rule_group(et_newrulegroup, pattern_rule_weights,
-                                   rule_map, rule_xmls)
-                et_newrulegroup = etree.SubElement(oroot, 'rule-group')
-                pattern_rule_weights = {}
+                                   rule_map, rule_xmls, pattern_rule_counts)
+                writer.write(et_newrulegroup)
+                et_newrulegroup = etree.Element('rule-group')
+                pattern_rule_weights, pattern_rule_counts = {}, {}
 
             pattern_rule_weights.setdefault(pattern, {})
             pattern_rule_weights[pattern].setdefault(rule_number, 0.)
-            pattern_rule_weights[pattern][rule_number] += float(weight)
+            pattern_rule_weights[pattern][rule_number] += weight
+            pattern_rule_counts.setdefault(pattern, {})
+            pattern_rule_counts[pattern].setdefault(rule_number, 0)
+            pattern_rule_counts[pattern][rule_number] += count
 
             prev_group_number = group_number
 
         # flush the last rule-pattern
         make_et_rule_group(et_newrulegroup, pattern_rule_weights,
-                           rule_map, rule_xmls)
-
-    if using_lxml:
-        # lxml supports pretty print
-        etree.ElementTree(oroot).write(ofname, pretty_print=True,
-                                       encoding='utf-8', xml_declaration=True)
-    else:
-        etree.ElementTree(oroot).write(ofname,
-                                       encoding='utf-8', xml_declaration=True)
+                           rule_map, rule_xmls, pattern_rule_counts)
+        writer.write(et_newrulegroup)
 
     print('Done in {:.2f}'.format(clock() - btime))
     return ofname
 
-def learn_from_monolingual(config):
+def load_language_model(lm_fname):
     """
-    Learn rule weights from monolingual corpus
-    using pretrained language model.
+    Load kenlm language model from lm_fname.
     """
-    print('Learning rule weights from monolingual corpus with pretrained language model.')
+    print('Loading language model.')
+    btime = clock()
+    model = import_kenlm().LanguageModel(lm_fname)
+    print('Done in {:.2f}'.format(clock() - btime))
+    return model
 
-    prefix = make_prefix(config)
+def preload_language_model(lm_fname):
+    """
+    Read language model file into page cache and load it.
+    Return the model and loading time.
+    """
+    btime = clock()
+    prefault(lm_fname)
+    model = import_kenlm().LanguageModel(lm_fname)
+    return model, clock() - btime
+
+def load_language_model_in_background(lm_fname):
+    """
+    Start loading language model in background thread,
+    so that it overlaps with tagging and starting translators.
+    Only reading the model file into page cache releases
+    the interpreter lock: while kenlm parses the model
+    (which is long for ARPA models), other python threads wait.
+    Return future of the model for wait_for_language_model.
+    """
+    print('Loading language model in background.')
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(preload_language_model, lm_fname)
+    executor.shutdown(wait=False)
+    return future
+
+def get_language_model(config):
+    """
+    Connect to language model server if it is set in config,
+    otherwise start loading language model in background.
+    """
+    lm_fname = config.get('LEARNING', 'language model')
+    if not config.has_option('LEARNING', 'language model server'):
+        return load_language_model_in_background(lm_fname)
+    socket_fname = config.get('LEARNING', 'language model server')
+    print('Connecting to language model server {}.'.format(socket_fname))
+    return lmserver.connect(socket_fname, lm_fname)
+
+def wait_for_language_model(model):
+    """
+    Get language model, waiting for it
+    if it is still being loaded in background.
+    """
+    if not isinstance(model, Future):
+        return model
+    btime = clock()
+    model, load_time = model.result()
+    print('Language model loaded in {:.2f} in background, '
+          'waited {:.2f} for it'.format(load_time, clock() - btime))
+    return model
+
+def start_translators(tixfname, binfname, prefix, timeout=default_timeout, default=True):
+    """
+    Start supervised translator pipelines for translation
+    with default rules (unless default is False) and for weighted translation.
+    Pipelines load pair data in their own processes,
+    so they are started before rules are loaded.
+    """
+    translators = []
+    if default:
+        translators.append(supervisedTranslator(lambda: partialTranslator(tixfname, binfname),
+                                                timeout, prefix + rejected_suffix))
+    translators.append(supervisedTranslator(lambda: weightedPartialTranslator(tixfname, binfname),
+                                            timeout, prefix + rejected_suffix))
+    return translators
+
+def get_rules(config):
+    """
+    Load rules for pair and direction specified in config.
+    """
+    return load_rules(config.get('APERTIUM', 'pair data'),
+                      config.get('DIRECTION', 'source'), 
+                      config.get('DIRECTION', 'target'))
+
+def get_translators(config, prefix, default=True):
+    """
+    Start translator pipelines for pair and direction specified in config,
+    or connect to translator server if it is set in config.
+    """
+    tixbasepath, binbasepath = pair_paths(config.get('APERTIUM', 'pair data'),
+                                          config.get('DIRECTION', 'source'),
+                                          config.get('DIRECTION', 'target'))
+    if config.has_option('LEARNING', 'translator server'):
+        socket_fname = config.get('LEARNING', 'translator server')
+        print('Connecting to translator server {}.'.format(socket_fname))
+        return trserver.connect(socket_fname, tixbasepath, binbasepath,
+                                prefix + rejected_suffix, default)
+    return start_translators(tixbasepath, binbasepath, prefix,
+                             translation_timeout(config), default)
+
+def binary_weights(config):
+    """
+    Check if chunk weights are to be stored in binary format.
+    """
+    return config.get('LEARNING', 'weights format', fallback=text_format) == binary_format
+
+def translation_timeout(config):
+    """
+    Get time limit (in seconds) for one request to translator pipeline.
+    """
+    return config.getfloat('LEARNING', 'translation timeout', fallback=default_timeout)
+
+def decompression_jobs(config):
+    """
+    Get number of corpus files decompressed at once.
+    """
+    return config.getint('LEARNING', 'decompression jobs', fallback=1)
+
+def convergence_tracker(config):
+    """
+    Make tracker for early stopping of converged patterns
+    if it is enabled in config, otherwise return None.
+    """
+    tracker = ConvergenceTracker(config.getfloat('LEARNING', 'convergence z', fallback=0.),
+                                 config.getint('LEARNING', 'convergence min observations',
+                                               fallback=default_min_observations),
+                                 config.getint('LEARNING', 'convergence cap', fallback=0))
+    return tracker if tracker.enabled() else None
+
+def load_score_cache(config, lm_fname, unbounded=False):
+    """
+    Make score cache of size specified in config
+    and fill it from score cache file if there is one.
+    Unbounded cache is made even if the size is 0,
+    and is left to be cut down to that size before saving.
+    """
+    cache = None
+    cache_size = config.getint('LEARNING', 'score cache size', fallback=default_cache_size)
+    if cache_size > 0 or unbounded:
+        cache = ScoreCache(cache_size)
+        if config.has_option('LEARNING', 'score cache') and \
+           cache.load(config.get('LEARNING', 'score cache'), lm_fname):
+            print('Loaded {} scores from score cache.'.format(len(cache.scores)))
+        if unbounded:
+            cache.resize(float('inf'))
+    return cache
+
+def collect_monolingual(config, prefix, corpus,
+                        tagged_fname=None, rules=None, model=None, translators=None,
+                        ingested=None):
+    """
+    Deduplicate and tag corpus, find and translate sentences
+    with ambiguous chunks, and score them against language model.
+    Language model may be provided either loaded or being loaded
+    in background, and translators may be provided already started.
+    Tagged corpus is taken as not deduplicated,
+    unless it is provided with the result of ingest_corpus.
+    Return the name of the file with chunk weights.
+    """
+    # start loading language model and translators,
+    # so that they are ready by the time they are needed
+    lm_fname = config.get('LEARNING', 'language model')
+    if model is None:
+        model = get_language_model(config)
+    if translators is None:
+        translators = get_translators(config, prefix)
+
+    # deduplicate corpus
+    if ingested is None:
+        ingested = ingest_corpus(config, prefix, [corpus]) if tagged_fname is None \
+                       else ([corpus], None)
 
     # tag corpus
-    tagged_fname = tag_corpus(config.get('APERTIUM', 'pair data'), 
-                              config.get('DIRECTION', 'source'),
-                              config.get('DIRECTION', 'target'), 
-                              config.get('LEARNING', 'source corpus'),
-                              prefix,
-                              config.get('LEARNING', 'data'))
+    if tagged_fname is None:
+        tagged_fname = tag_ingested_corpus(config.get('APERTIUM', 'pair data'), 
+                                           config.get('DIRECTION', 'source'),
+                                           config.get('DIRECTION', 'target'), 
+                                           ingested,
+                                           prefix,
+                                           config.get('LEARNING', 'data'),
+                                           decompression_jobs(config))
 
     # load rules, build rule FST
+    if rules is None:
+        rules = get_rules(config)
     tixbasepath, binbasepath, cat_dict, pattern_FST, \
-    ambiguous_rules, rule_id_map, rule_xmls = \
-                            load_rules(config.get('APERTIUM', 'pair data'),
-                                       config.get('DIRECTION', 'source'), 
-                                       config.get('DIRECTION', 'target'))
+    ambiguous_rules, rule_id_map, rule_xmls = rules
+
+    # find sentences with ambiguity before translating them, if asked to
+    index_fname = None
+    prescan_jobs = config.getint('LEARNING', 'prescan jobs', fallback=0)
+    if prescan_jobs > 0:
+        index_fname = prefix + index_suffix
+        with budget.stage('pre-scanning'):
+            ambindex.prescan(tagged_fname, index_fname, cat_dict, pattern_FST,
+                             ambiguous_rules, prescan_jobs)
+
+    # rules and language model live through detection,
+    # so garbage collector does not need to look at them
+    memory.tune_gc()
+
+    # get language model and score cache before detection
+    # if variants have to be scored during it for early stopping,
+    # cache is not bounded for the run, so that the variants
+    # are not scored again after detection
+    tracker, scorer = convergence_tracker(config), None
+    if tracker is not None:
+        model = wait_for_language_model(model)
+        cache = load_score_cache(config, lm_fname, unbounded=True)
+        scorer = VariantScorer(model, cache)
 
     # detect and store sentences with ambiguity
     ambig_sentences_fname = detect_ambiguous_mono(tagged_fname, prefix, 
                                                   cat_dict, pattern_FST,
                                                   ambiguous_rules,
                                                   tixbasepath, binbasepath,
-                                                  rule_id_map)
-
-    # load language model
-    print('Loading language model.')
-    btime = clock()
-    model = kenlm.LanguageModel(config.get('LEARNING', 'language model'))
-    print('Done in {:.2f}'.format(clock() - btime))
+                                                  rule_id_map,
+                                                  config.getint('LEARNING', 'batch size',
+                                                                fallback=default_batch_size),
+                                                  translation_timeout(config),
+                                                  index_fname, tracker, scorer, translators,
+                                                  config.getint('LEARNING', 'context window',
+                                                                fallback=0),
+                                                  load_counts(ingested))
+
+    if tracker is None:
+        # get language model
+        model = wait_for_language_model(model)
+        # load score cache
+        cache = load_score_cache(config, lm_fname)
 
     # estimate rule weights for each ambiguous chunk
     scores_fname = score_sentences(ambig_sentences_fname, model, prefix,
-                                   config.get('LEARNING', 'generalize') == 'yes')
+                                   config.get('LEARNING', 'generalize') == 'yes',
+                                   binary_weights(config), cache, tracker)
 
-    # sum up weights for rule-pattern and make unprunned xml
-    weights_fname = make_xml_transfer_weights_mono(scores_fname, prefix, 
-                                                   rule_id_map, rule_xmls)
+    # store score cache for next runs with the same language model
+    cache_size = config.getint('LEARNING', 'score cache size', fallback=default_cache_size)
+    if cache_size > 0 and config.has_option('LEARNING', 'score cache'):
+        cache.resize(cache_size)
+        cache.save(config.get('LEARNING', 'score cache'), lm_fname)
 
-    # prune weights file
-    prunned_fname = prune_xml_transfer_weights(using_lxml, weights_fname)
+    return scores_fname
 
-def learn_from_parallel(config):
+def collect_parallel(config, prefix, source_corpus, target_corpus,
+                     tagged_fname=None, rules=None, translators=None, ingested=None):
     """
-    Learn rule weights from parallel corpus (no language model required).
+    Deduplicate corpus, tag source corpus, find and translate
+    ambiguous chunks, and score them against target corpus.
+    Translators may be provided already started.
+    Tagged corpus is taken as not deduplicated,
+    unless it is provided with the result of ingest_corpus.
+    Return the name of the file with chunk weights.
     """
-    print('Learning rule weights from parallel corpus.')
+    # start translator, so that it is ready by the time it is needed
+    if translators is None:
+        translators = get_translators(config, prefix, default=False)
 
-    prefix = make_prefix(config)
+    # deduplicate pairs of source and target lines
+    if ingested is None:
+        ingested = ingest_corpus(config, prefix, [source_corpus, target_corpus]) \
+                       if tagged_fname is None else ([source_corpus, target_corpus], None)
+    (source_corpus, target_corpus), counts_fname = ingested
 
     # tag corpus
-    tagged_fname = tag_corpus(config.get('APERTIUM', 'pair data'), 
-                              config.get('DIRECTION', 'source'),
-                              config.get('DIRECTION', 'target'), 
-                              config.get('LEARNING', 'source corpus'),
-                              prefix,
-                              config.get('LEARNING', 'data'))
+    if tagged_fname is None:
+        tagged_fname = tag_ingested_corpus(config.get('APERTIUM', 'pair data'), 
+                                           config.get('DIRECTION', 'source'),
+                                           config.get('DIRECTION', 'target'), 
+                                           ingested,
+                                           prefix,
+                                           config.get('LEARNING', 'data'),
+                                           decompression_jobs(config))
 
     # load rules, build rule FST
+    if rules is None:
+        rules = get_rules(config)
     tixbasepath, binbasepath, cat_dict, pattern_FST, \
-    ambiguous_rules, rule_id_map, rule_xmls = \
-                            load_rules(config.get('APERTIUM', 'pair data'),
-                                       config.get('DIRECTION', 'source'), 
-                                       config.get('DIRECTION', 'target'))
+    ambiguous_rules, rule_id_map, rule_xmls = rules
+
+    # rules live through detection,
+    # so garbage collector does not need to look at them
+    memory.tune_gc()
 
     # detect, score and store chunks with ambiguity
-    scores_fname = detect_ambiguous_parallel(tagged_fname,
-                                             config.get('LEARNING', 'target corpus'),
-                                             prefix,
-                                             cat_dict, pattern_FST,
-                                             ambiguous_rules,
-                                             tixbasepath, binbasepath,
-                                             rule_id_map,
-                                             config.get('LEARNING', 'generalize') == 'yes')
+    return detect_ambiguous_parallel(tagged_fname,
+                                     target_corpus,
+                                     prefix,
+                                     cat_dict, pattern_FST,
+                                     ambiguous_rules,
+                                     tixbasepath, binbasepath,
+                                     rule_id_map,
+                                     config.get('LEARNING', 'generalize') == 'yes',
+                                     binary_weights(config),
+                                     translation_timeout(config),
+                                     convergence_tracker(config),
+                                     translators,
+                                     load_counts(ingested),
+                                     decompression_jobs(config))
+
+def make_weights(config, prefix, scores_fname, rules=None, statistics=None):
+    """
+    Sum up weights for rule-pattern pairs from scores_fname,
+    make unprunned xml weights file, and prune it.
+    If group statistics are provided, statistics of unchanged
+    rule groups are added to scores_fname first, and all of them
+    are kept for the next run.
+    """
+    if rules is None:
+        rules = get_rules(config)
+    tixbasepath, binbasepath, cat_dict, pattern_FST, \
+    ambiguous_rules, rule_id_map, rule_xmls = rules
 
-    # sum up and normalize weights for rule-pattern and make unprunned xml
-    weights_fname = make_xml_transfer_weights_parallel(scores_fname, prefix, 
-                                              rule_id_map, rule_xmls)
+    if statistics is not None:
+        statistics.add_reused(scores_fname)
+        statistics.store(scores_fname)
 
-    # prune xml weights file
-    prunned_fname = prune_xml_transfer_weights(using_lxml, weights_fname)
+    if config.get('LEARNING', 'mode') == mono_mode:
+        # sum up weights for rule-pattern and make unprunned xml
+        weights_fname = make_xml_transfer_weights_mono(scores_fname, prefix, 
+                                                       rule_id_map, rule_xmls)
+    else:
+        # sum up and normalize weights for rule-pattern and make unprunned xml
+        weights_fname = make_xml_transfer_weights_parallel(scores_fname, prefix, 
+                                                           rule_id_map, rule_xmls)
+
+    # prune xml weights file, reducing it if asked to
+    with budget.stage('pruning'):
+        return prune_xml_transfer_weights(using_lxml, weights_fname,
+                                          min_count=config.getint('LEARNING', 'min count', fallback=1),
+                                          min_margin=config.getfloat('LEARNING', 'min margin', fallback=0.),
+                                          top_patterns=config.getint('LEARNING', 'top patterns', fallback=0),
+                                          collapse_generalized=config.get('LEARNING', 'collapse generalized',
+                                                                          fallback='no') == 'yes')
+
+def incremental_setup(config, tixbasepath, binbasepath, cat_dict,
+                      ambiguous_rules, rule_xmls):
+    """
+    Describe what statistics of rule groups depend on
+    besides their own rules: pair, its compiled files,
+    the rest of its transfer rules, default rules and patterns
+    of all rule groups and def-cats, corpus files
+    (by their size and modification time), language model
+    and learning options.
+    """
+    setup = {option: config.get('LEARNING', option, fallback='')
+                 for option in incremental_options}
+    setup['pair'] = [os.path.abspath(config.get('APERTIUM', 'pair data')),
+                     config.get('DIRECTION', 'source'), config.get('DIRECTION', 'target')]
+    setup['pair files'] = incremental.pair_identity(tixbasepath, binbasepath)
+    setup['other rules'] = incremental.transfer_md5(tixbasepath + '.t1x', ambiguous_rules)
+    setup['default rules and patterns'] = incremental.shared_md5(ambiguous_rules, rule_xmls, cat_dict)
+    sides = ['source'] if config.get('LEARNING', 'mode') == mono_mode else ['source', 'target']
+    for side in sides:
+        setup[side + ' corpus'] = [incremental.file_identity(fname)
+                                       for fname in corpus_files(config.get('LEARNING',
+                                                                            side + ' corpus'))]
+    if config.get('LEARNING', 'mode') == mono_mode:
+        setup['language model'] = model_identity(config.get('LEARNING', 'language model')).decode('utf-8')
+    return setup
+
+def incremental_on(config):
+    """
+    Check if only rule groups changed since the last run are to be learned.
+    """
+    return config.get('LEARNING', 'incremental', fallback='no') == 'yes'
+
+def plan_incremental(config, prefix, rules):
+    """
+    If incremental learning is on in config, find rule groups
+    changed since the last run, whose statistics can not be reused.
+    Return group statistics (None if incremental learning is off)
+    and rules with only the changed groups as ambiguous
+    (None if there are none of them).
+    """
+    if not incremental_on(config):
+        return None, rules
+    tixbasepath, binbasepath, cat_dict, pattern_FST, \
+    ambiguous_rules, rule_id_map, rule_xmls = rules
+
+    setup = incremental_setup(config, tixbasepath, binbasepath, cat_dict,
+                              ambiguous_rules, rule_xmls)
+    statistics = incremental.GroupStatistics(prefix, setup, binary_weights(config))
+    learned_ambiguous_rules = statistics.plan(ambiguous_rules, rule_xmls, cat_dict)
+    print('Incremental learning: {}'.format(statistics.report()))
+    if learned_ambiguous_rules == {}:
+        return statistics, None
+    return statistics, (tixbasepath, binbasepath, cat_dict, pattern_FST,
+                        learned_ambiguous_rules, rule_id_map, rule_xmls)
+
+def empty_scores(config, prefix):
+    """
+    Make empty chunk weights file, when there is nothing to learn.
+    """
+    scores_fname = chunkweights.make_fname(prefix + chunk_weights_suffix, binary_weights(config))
+    open(scores_fname, 'wb').close()
+    return scores_fname
+
+def learn_from_monolingual(config, tagged_fname=None, rules=None, model=None,
+                           ingested=None):
+    """
+    Learn rule weights from monolingual corpus
+    using pretrained language model.
+    Tagged corpus file name, loaded rules and language model
+    (and deduplicated corpus) may be provided if they are shared
+    with other configs.
+    """
+    print('Learning rule weights from monolingual corpus with pretrained language model.')
+
+    # language model and translators are loaded in background
+    # while rules are loaded, unless incremental learning
+    # may find out that there is nothing to learn
+    prefix = make_prefix(config)
+    translators = None
+    if not incremental_on(config):
+        if model is None:
+            model = get_language_model(config)
+        translators = get_translators(config, prefix)
+    if rules is None:
+        rules = get_rules(config)
+
+    # learn only rule groups changed since the last run, if asked to
+    statistics, learned_rules = plan_incremental(config, prefix, rules)
+    if learned_rules is None:
+        scores_fname = empty_scores(config, prefix)
+    else:
+        if translators is None:
+            if model is None:
+                model = get_language_model(config)
+            translators = get_translators(config, prefix)
+        scores_fname = collect_monolingual(config, prefix,
+                                           config.get('LEARNING', 'source corpus'),
+                                           tagged_fname, learned_rules, model, translators,
+                                           ingested)
+    make_weights(config, prefix, scores_fname, rules, statistics)
+
+def learn_from_parallel(config, tagged_fname=None, rules=None, ingested=None):
+    """
+    Learn rule weights from parallel corpus (no language model required).
+    Tagged corpus file name and loaded rules (and deduplicated corpus)
+    may be provided if they are shared with other configs.
+    """
+    print('Learning rule weights from parallel corpus.')
+
+    # translator is loaded in background while rules are loaded,
+    # unless incremental learning may find out that there is nothing to learn
+    prefix = make_prefix(config)
+    translators = None
+    if not incremental_on(config):
+        translators = get_translators(config, prefix, default=False)
+    if rules is None:
+        rules = get_rules(config)
+
+    # learn only rule groups changed since the last run, if asked to
+    statistics, learned_rules = plan_incremental(config, prefix, rules)
+    if learned_rules is None:
+        scores_fname = empty_scores(config, prefix)
+    else:
+        if translators is None:
+            translators = get_translators(config, prefix, default=False)
+        scores_fname = collect_parallel(config, prefix,
+                                        config.get('LEARNING', 'source corpus'),
+                                        config.get('LEARNING', 'target corpus'),
+                                        tagged_fname, learned_rules, translators, ingested)
+    make_weights(config, prefix, scores_fname, rules, statistics)
+
+def make_shards(config, shards_count):
+    """
+    Split corpus (both sides of it in parallel mode)
+    into shards_count shards of consecutive lines,
+    and write shards manifest.
+    """
+    print('Splitting corpus into {} shards.'.format(shards_count))
+    btime = clock()
+
+    prefix = make_prefix(config)
+    sides = ['source']
+    if config.get('LEARNING', 'mode') == parl_mode:
+        sides.append('target')
+
+    # count lines to make shards of roughly equal size
+    jobs = decompression_jobs(config)
+    with open_corpus(config.get('LEARNING', 'source corpus'), jobs) as ifile:
+        lines_count = sum(1 for line in ifile)
+    shard_size = max(1, -(-lines_count // shards_count))
+
+    manifest = {'mode': config.get('LEARNING', 'mode'),
+                'lines': lines_count,
+                'shards': []}
+    for i in range(shards_count):
+        shard_prefix = '{}-shard-{:03d}'.format(prefix, i)
+        manifest['shards'].append({'prefix': shard_prefix,
+                                   'first line': i * shard_size,
+                                   'lines': max(0, min(shard_size, lines_count - i * shard_size)),
+                                   'partial': chunkweights.make_fname(shard_prefix + partial_suffix,
+                                                                      binary_weights(config))})
+        for side in sides:
+            manifest['shards'][-1][side] = '{}-{}.txt'.format(shard_prefix, side)
+
+    for side in sides:
+        with open_corpus(config.get('LEARNING', side + ' corpus'), jobs) as ifile:
+            side_lines_count = 0
+            for shard in manifest['shards']:
+                with open(shard[side], 'wb') as ofile:
+                    for i, line in zip(range(shard['lines']), ifile):
+                        ofile.write(line)
+                        side_lines_count += 1
+            side_lines_count += sum(1 for line in ifile)
+        # shards of both sides must stay aligned
+        if side_lines_count != lines_count:
+            print('Source corpus has {} lines, but {} corpus has {}.'.format(lines_count, side,
+                                                                             side_lines_count))
+            sys.exit(1)
+
+    with open(prefix + manifest_suffix, 'w', encoding='utf-8') as mfile:
+        json.dump(manifest, mfile, indent=2)
+
+    print('Done in {:.2f}'.format(clock() - btime))
+    return prefix + manifest_suffix
+
+def load_manifest(config):
+    """
+    Load shards manifest made by make_shards.
+    """
+    manifest_fname = make_prefix(config) + manifest_suffix
+    if not os.path.exists(manifest_fname):
+        print('Shards manifest "{}" not found. '
+              'Please make shards first.'.format(manifest_fname))
+        sys.exit(1)
+    with open(manifest_fname, 'r', encoding='utf-8') as mfile:
+        manifest = json.load(mfile)
+    if manifest['mode'] != config.get('LEARNING', 'mode'):
+        print('Shards were made for {} mode.'.format(manifest['mode']))
+        sys.exit(1)
+    return manifest
+
+def work_on_shard(config, shard_number):
+    """
+    Collect chunk weights from one shard
+    and store them as partial statistics file.
+    """
+    manifest = load_manifest(config)
+    if not 0 <= shard_number < len(manifest['shards']):
+        print('There is no shard {}.'.format(shard_number))
+        sys.exit(1)
+    shard = manifest['shards'][shard_number]
+    print('Working on shard {}.'.format(shard_number))
+
+    if config.get('LEARNING', 'mode') == mono_mode:
+        scores_fname = collect_monolingual(config, shard['prefix'], shard['source'])
+    else:
+        scores_fname = collect_parallel(config, shard['prefix'],
+                                        shard['source'], shard['target'])
+
+    # partial file appears only when the shard is complete,
+    # so a lost shard is just rerun
+    os.replace(scores_fname, shard['partial'])
+    return shard['partial']
+
+def merge_shards(config, partial_fnames=None):
+    """
+    Merge partial statistics files (all shards from the manifest
+    by default) and make pruned weights file out of them.
+    """
+    if partial_fnames is None or partial_fnames == []:
+        partial_fnames = [shard['partial'] for shard in load_manifest(config)['shards']]
+
+    missing = [fname for fname in partial_fnames if not os.path.exists(fname)]
+    if missing != []:
+        print('Missing partial statistics files:\n{}'.format('\n'.join(missing)))
+        sys.exit(1)
+
+    print('Merging {} partial statistics files.'.format(len(partial_fnames)))
+    btime = clock()
+
+    # both text and binary files may be merged by concatenation,
+    # but not with each other (empty files fit either format)
+    binary = [chunkweights.is_binary(fname) for fname in partial_fnames
+                    if os.path.getsize(fname) > 0]
+    if len(set(binary)) > 1:
+        print('Partial statistics files are in different formats.')
+        sys.exit(1)
+
+    prefix = make_prefix(config)
+    scores_fname = chunkweights.make_fname(prefix + chunk_weights_suffix, any(binary))
+    with open(scores_fname, 'wb') as ofile:
+        for fname in partial_fnames:
+            with open(fname, 'rb') as ifile:
+                shutil.copyfileobj(ifile, ofile)
+
+    print('Done in {:.2f}'.format(clock() - btime))
+    return make_weights(config, prefix, scores_fname)
 
+def learn_batch(configs, workers=1, job_memory=None, job_cpu=None):
+    """
+    Learn rule weights for several configs at once.
+    Stages shared between configs (tagging of the same corpus
+    for the same pair and direction, loading of the same rules,
+    loading of the same language model) are run only once,
+    then each config is learned in a separate process
+    with job_memory megabytes and job_cpu seconds limits.
+    """
+    # scheduler (and multiprocessing) is needed only here
+    from tools import scheduler
+
+    separate_prefixes(configs)
+    stages = {}
+
+    def shared_stage(name, func, *args):
+        # make stage only if identical one does not exist yet
+        if name not in stages:
+            stages[name] = scheduler.Stage(name, func, args)
+        return stages[name]
+
+    for config_fname, config in configs:
+        pair_data = config.get('APERTIUM', 'pair data')
+        source = config.get('DIRECTION', 'source')
+        target = config.get('DIRECTION', 'target')
+        corpus = config.get('LEARNING', 'source corpus')
+        prefix = make_prefix(config)
+
+        if config.get('LEARNING', 'deduplicate', fallback='no') == 'yes':
+            corpora = [corpus]
+            if config.get('LEARNING', 'mode') != mono_mode:
+                corpora.append(config.get('LEARNING', 'target corpus'))
+            ingesting = shared_stage('deduplicating {}'.format(' '.join(corpora)),
+                                     ingest_corpus, config, prefix, corpora)
+            tagging = shared_stage('tagging deduplicated {} with {} {}-{}'.format(corpus, pair_data, source, target),
+                                   tag_ingested_corpus, pair_data, source, target, ingesting,
+                                   prefix, config.get('LEARNING', 'data'))
+        else:
+            ingesting = None
+            tagging = shared_stage('tagging {} with {} {}-{}'.format(corpus, pair_data, source, target),
+                                   tag_corpus, pair_data, source, target, corpus,
+                                   prefix, config.get('LEARNING', 'data'))
+        rules = shared_stage('loading rules from {} {}-{}'.format(pair_data, source, target),
+                             load_rules, pair_data, source, target)
+
+        job_name = 'learning with {}'.format(config_fname)
+        if config.get('LEARNING', 'mode') == mono_mode:
+            lm_fname = config.get('LEARNING', 'language model')
+            if config.has_option('LEARNING', 'language model server'):
+                # each job connects to the server itself
+                model = None
+            else:
+                model = shared_stage('loading language model {}'.format(lm_fname),
+                                     load_language_model, lm_fname)
+            stages[job_name] = scheduler.Stage(job_name, run_job,
+                                               (learn_from_monolingual,
+                                                config, tagging, rules, model, ingesting),
+                                               isolated=True)
+        else:
+            stages[job_name] = scheduler.Stage(job_name, run_job,
+                                               (learn_from_parallel,
+                                                config, tagging, rules, ingesting),
+                                               isolated=True)
+
+    results, failed = scheduler.run_graph(list(stages.values()), workers, job_memory, job_cpu)
+    return failed == set()
+
+def separate_prefixes(configs):
+    """
+    Make sure that configs learned in one batch do not share
+    prefix of intermediate files (e.g. configs for several pairs
+    or directions with the same corpus): prefixes made from corpus
+    names get md5 sum of their config, same prefix options are rejected.
+    """
+    by_prefix = {}
+    for config_fname, config in configs:
+        by_prefix.setdefault(make_prefix(config), []).append((config_fname, config))
+
+    for prefix, prefix_configs in by_prefix.items():
+        if len(prefix_configs) == 1:
+            continue
+        explicit = [config_fname for config_fname, config in prefix_configs
+                        if config.has_option('LEARNING', 'prefix')]
+        if explicit != []:
+            print('Configs {} use the same prefix "{}".'.format(
+                      ', '.join('"{}"'.format(config_fname) for config_fname, config in prefix_configs),
+                      prefix))
+            sys.exit(1)
+        for config_fname, config in prefix_configs:
+            config_text = io.StringIO()
+            config.write(config_text)
+            config_md5 = hashlib.md5(config_text.getvalue().encode('utf-8')).hexdigest()
+            config.set('LEARNING', 'prefix',
+                       '{}-{}'.format(os.path.basename(prefix), config_md5[:8]))
+
+def run_job(learn, *args):
+    """
+    Run learning function with args in batch job
+    and report memory use of the stages run by it.
+    """
+    first_stage = len(budget.stages)
+    learn(*args)
+    budget.report(first_stage)
+
+def validate_corpus(corpus, name):
+    """
+    Check that all files of corpus option exist and can be decompressed.
+    """
+    try:
+        fnames = corpus_files(corpus)
+    except ValueError as e:
+        print('{}: {}'.format(name, e))
+        sys.exit(1)
+    if fnames == []:
+        print('{} is empty.'.format(name))
+        sys.exit(1)
+    for fname in fnames:
+        if not os.path.exists(fname):
+            print('{} "{}" not found'.format(name, fname))
+            sys.exit(1)
+        if not can_decompress(fname):
+            print('{} "{}" is compressed with zstd, but neither zstandard library '
+                  'nor zstd command is found.'.format(name, fname))
+            sys.exit(1)
 
 def validate_config(config_fname):
     """
@@ -685,9 +1752,7 @@ def validate_config(config_fname):
         print('Undefined source language corpus for learning.')
         sys.exit(1)
 
-    if not os.path.exists(config.get('LEARNING', 'source corpus')):
-        print('Source language corpus "{}" not found'.format(config.get('LEARNING', 'source corpus')))
-        sys.exit(1)
+    validate_corpus(config.get('LEARNING', 'source corpus'), 'Source language corpus')
 
     if config.get('LEARNING', 'mode') == mono_mode:
         if not config.has_option('LEARNING', 'language model'):
@@ -696,13 +1761,19 @@ def validate_config(config_fname):
         if not os.path.exists(config.get('LEARNING', 'language model')):
             print('Language model "{}" not found'.format(config.get('LEARNING', 'language model')))
             sys.exit(1)
+        if config.has_option('LEARNING', 'language model server'):
+            socket_fname = config.get('LEARNING', 'language model server')
+            if not os.path.exists(socket_fname):
+                print('Language model server socket "{}" not found'.format(socket_fname))
+                sys.exit(1)
+        elif import_kenlm() is None:
+            print('kenlm library not found. It is required in mono mode.')
+            sys.exit(1)
     elif config.get('LEARNING', 'mode') == parl_mode:
         if not config.has_option('LEARNING', 'target corpus'):
             print('Undefined target language corpus for parallel learning.')
             sys.exit(1)
-        if not os.path.exists(config.get('LEARNING', 'target corpus')):
-            print('Target language corpus "{}" not found'.format(config.get('LEARNING', 'target corpus')))
-            sys.exit(1)
+        validate_corpus(config.get('LEARNING', 'target corpus'), 'Target language corpus')
     else:
         print('Invalid mode {}.'.format(config.get('LEARNING', 'mode')),
               'Please specify either mono or parallel.')
@@ -719,6 +1790,96 @@ def validate_config(config_fname):
         print('Config option generalize must be either yes or no.')
         sys.exit(1)
 
+    if config.has_option('LEARNING', 'batch size') and\
+       (not config.get('LEARNING', 'batch size').isdigit() or\
+        config.getint('LEARNING', 'batch size') == 0):
+        print('Config option batch size must be a positive integer.')
+        sys.exit(1)
+
+    if config.has_option('LEARNING', 'prescan jobs') and\
+       not config.get('LEARNING', 'prescan jobs').isdigit():
+        print('Config option prescan jobs must be a non-negative integer.')
+        sys.exit(1)
+
+    if config.has_option('LEARNING', 'context window') and\
+       not config.get('LEARNING', 'context window').isdigit():
+        print('Config option context window must be a non-negative integer.')
+        sys.exit(1)
+
+    if config.get('LEARNING', 'deduplicate', fallback='no') not in ('yes', 'no'):
+        print('Config option deduplicate must be either yes or no.')
+        sys.exit(1)
+
+    if config.get('LEARNING', 'incremental', fallback='no') not in ('yes', 'no'):
+        print('Config option incremental must be either yes or no.')
+        sys.exit(1)
+
+    if config.has_option('LEARNING', 'deduplicate max lines') and\
+       (not config.get('LEARNING', 'deduplicate max lines').isdigit() or\
+        config.getint('LEARNING', 'deduplicate max lines') == 0):
+        print('Config option deduplicate max lines must be a positive integer.')
+        sys.exit(1)
+
+    if config.has_option('LEARNING', 'decompression jobs') and\
+       (not config.get('LEARNING', 'decompression jobs').isdigit() or\
+        config.getint('LEARNING', 'decompression jobs') == 0):
+        print('Config option decompression jobs must be a positive integer.')
+        sys.exit(1)
+
+    if config.has_option('LEARNING', 'translator server') and\
+       not os.path.exists(config.get('LEARNING', 'translator server')):
+        print('Translator server socket "{}" not found'.format(config.get('LEARNING', 'translator server')))
+        sys.exit(1)
+
+    if config.has_option('LEARNING', 'score cache size') and\
+       not config.get('LEARNING', 'score cache size').isdigit():
+        print('Config option score cache size must be a non-negative integer.')
+        sys.exit(1)
+
+    for option in ('convergence min observations', 'convergence cap'):
+        if config.has_option('LEARNING', option) and\
+           not config.get('LEARNING', option).isdigit():
+            print('Config option {} must be a non-negative integer.'.format(option))
+            sys.exit(1)
+
+    if config.has_option('LEARNING', 'convergence z'):
+        try:
+            if config.getfloat('LEARNING', 'convergence z') < 0:
+                raise ValueError
+        except ValueError:
+            print('Config option convergence z must be a non-negative number.')
+            sys.exit(1)
+
+    if config.has_option('LEARNING', 'translation timeout'):
+        try:
+            if config.getfloat('LEARNING', 'translation timeout') <= 0:
+                raise ValueError
+        except ValueError:
+            print('Config option translation timeout must be a positive number.')
+            sys.exit(1)
+
+    for option in ('min count', 'top patterns'):
+        if config.has_option('LEARNING', option) and\
+           not config.get('LEARNING', option).isdigit():
+            print('Config option {} must be a non-negative integer.'.format(option))
+            sys.exit(1)
+
+    if config.has_option('LEARNING', 'min margin'):
+        try:
+            if not 0. <= config.getfloat('LEARNING', 'min margin') <= 1.:
+                raise ValueError
+        except ValueError:
+            print('Config option min margin must be a number from 0 to 1.')
+            sys.exit(1)
+
+    if config.get('LEARNING', 'collapse generalized', fallback='no') not in ('yes', 'no'):
+        print('Config option collapse generalized must be either yes or no.')
+        sys.exit(1)
+
+    if config.get('LEARNING', 'weights format', fallback=text_format) not in (text_format, binary_format):
+        print('Config option weights format must be either {} or {}.'.format(text_format, binary_format))
+        sys.exit(1)
+
     print("Config file ok.")
     return config
 
@@ -726,27 +1887,58 @@ def get_options():
     """
     Parse commandline arguments and options
     """
-    usage = "USAGE: python3 %prog [--config CONFIG_FILE]"
+    usage = ("USAGE: python3 %prog [--config CONFIG_FILE [--config CONFIG_FILE ...]]\n"
+             "       python3 %prog [--config CONFIG_FILE] shard SHARDS_COUNT\n"
+             "       python3 %prog [--config CONFIG_FILE] work SHARD_NUMBER\n"
+             "       python3 %prog [--config CONFIG_FILE] merge [PARTIAL_FILE ...]")
     op = OptionParser(usage=usage)
 
-    op.add_option("-c", "--config", dest="confname", default=None,
-                  help="use config specified in CONFIG_FILE. Default config is specified in default.ini", metavar="CONFIG_FILE")
+    op.add_option("-c", "--config", dest="confnames", action="append", default=[],
+                  help="use config specified in CONFIG_FILE. Default config is specified in default.ini. "
+                       "If specified several times, all configs are learned in one batch "
+                       "sharing tagged corpora, rules and language models", metavar="CONFIG_FILE")
+    op.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                  help="run at most JOBS stages at once in batch mode", metavar="JOBS")
+    op.add_option("--job-memory", dest="job_memory", type="int", default=None,
+                  help="limit address space of each learning job in batch mode to MB megabytes "
+                       "(shared language models count towards it)", metavar="MB")
+    op.add_option("--job-cpu", dest="job_cpu", type="int", default=None,
+                  help="limit processor time of each learning job in batch mode to SECONDS",
+                  metavar="SECONDS")
+    op.add_option("--max-memory", dest="max_memory", type="int", default=None,
+                  help="spill large structures to disk when resident memory of the learner "
+                       "(of each job in batch mode) gets near MB megabytes", metavar="MB")
+    op.add_option("--trace-memory", dest="trace_memory", action="store_true", default=False,
+                  help="report peak memory allocated by python in each stage "
+                       "(slows learning down)")
 
     (opts, args) = op.parse_args()
 
+    opts.command, opts.command_args = None, []
     if len(args) > 0:
-        op.error("this script gets no arguments.")
-        op.print_help()
-        sys.exit(1)
-
-    return opts.confname
+        opts.command, opts.command_args = args[0], args[1:]
+        if opts.command not in shard_commands:
+            op.error("unknown command {}.".format(opts.command))
+        if len(opts.confnames) > 1:
+            op.error("{} command works with one config only.".format(opts.command))
+        if opts.command in ('shard', 'work'):
+            if len(opts.command_args) != 1 or not opts.command_args[0].isdigit():
+                op.error("{} command gets one number.".format(opts.command))
+            opts.command_args = [int(opts.command_args[0])]
+        if opts.command == 'shard' and opts.command_args[0] < 1:
+            op.error("number of shards must be positive.")
+
+    if opts.jobs < 1:
+        op.error("number of jobs must be positive.")
+    if opts.max_memory is not None and opts.max_memory < 1:
+        op.error("memory budget must be positive.")
+
+    return opts
 
 if __name__ == "__main__":
-    confname = get_options()
-    if confname is not None:
-        config = validate_config(confname)
-    else:
-        config = validate_config(default_confname)
+    opts = get_options()
+    confnames = opts.confnames if opts.confnames != [] else [default_confname]
+    configs = [(confname, validate_config(confname)) for confname in confnames]
 
     print("Checking for lxml library.")
     try: # see if lxml is installed
@@ -761,11 +1953,29 @@ if __name__ == "__main__":
               "Also, it supports pretty print.")
         using_lxml = False
 
+    budget.configure(opts.max_memory, opts.trace_memory)
     tbtime = clock()
 
-    if config.get('LEARNING', 'mode') == mono_mode:
-        learn_from_monolingual(config)
-    elif config.get('LEARNING', 'mode') == parl_mode:
-        learn_from_parallel(config)
-
+    if opts.command == 'shard':
+        make_shards(configs[0][1], *opts.command_args)
+        ok = True
+    elif opts.command == 'work':
+        work_on_shard(configs[0][1], *opts.command_args)
+        ok = True
+    elif opts.command == 'merge':
+        merge_shards(configs[0][1], opts.command_args)
+        ok = True
+    elif len(configs) > 1:
+        ok = learn_batch(configs, opts.jobs, opts.job_memory, opts.job_cpu)
+    else:
+        confname, config = configs[0]
+        if config.get('LEARNING', 'mode') == mono_mode:
+            learn_from_monolingual(config)
+        elif config.get('LEARNING', 'mode') == parl_mode:
+            learn_from_parallel(config)
+        ok = True
+
+    budget.report()
     print('Performed in {:.2f}'.format(clock() - tbtime))
+    if not ok:
+        sys.exit(1)